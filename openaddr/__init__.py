@@ -2,12 +2,14 @@ from __future__ import absolute_import, division, print_function
 import logging; _L = logging.getLogger('openaddr')
 
 from tempfile import mkdtemp, mkstemp
-from os.path import realpath, join, splitext, exists, dirname, abspath, relpath
+from os.path import realpath, join, splitext, exists, dirname, abspath, relpath, getsize
 from shutil import copy, move, rmtree
 from os import close, utime, remove
 from urllib.parse import urlparse
 from datetime import datetime, date
 from calendar import timegm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 from boto.s3.connection import S3Connection
@@ -34,6 +36,11 @@ from .conform import (
 with open(join(dirname(__file__), 'VERSION')) as file:
     __version__ = file.read().strip()
 
+# Processed files to download ahead of the one currently in use,
+# and the most bytes of them to keep waiting on disk.
+PREFETCH_DOWNLOADS = 4
+PREFETCH_BYTES = 2 * 1024 * 1024 * 1024
+
 class S3:
     _bucket = None
 
@@ -199,40 +206,79 @@ def conform(data_source_name, data_source, destdir, extras):
                          attr_flag,
                          attr_name)
 
-def iterate_local_processed_files(runs, sort_on='datetime_tz'):
+def iterate_local_processed_files(runs, sort_on='datetime_tz', mirror=None):
     ''' Yield a stream of local processed result files for a list of runs.
 
-        Used in ci.collect and dotmap processes.
+        Used in ci.collect and dotmap processes. Files are downloaded ahead
+        in the background, up to PREFETCH_DOWNLOADS files or PREFETCH_BYTES
+        of finished downloads, and each is removed once the next is requested.
+
+        With a ci.mirror.ProcessedMirror, files come from the shared mirror.
     '''
     if sort_on == 'source_path':
         reverse, key = False, lambda run: run.source_path
     else:
         reverse, key = True, lambda run: run.datetime_tz or date(1970, 1, 1)
 
-    for run in sorted(runs, key=key, reverse=reverse):
-        source_base, _ = splitext(relpath(run.source_path, 'sources'))
-        processed_url = run.state and run.state.processed
-        run_state = run.state
+    runs = iter([run for run in sorted(runs, key=key, reverse=reverse)
+                 if run.state and run.state.processed])
 
-        if not processed_url:
-            continue
+    with ThreadPoolExecutor(PREFETCH_DOWNLOADS) as executor:
+        pending = deque()
 
         try:
-            filename = download_processed_file(processed_url)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code == 404:
-                continue
-            else:
-                _L.error('HTTP {} while downloading {}: {}'.format(e.response.status_code, processed_url, e))
-                continue
-        except Exception as e:
-            _L.error('Failed to download {}: {}'.format(processed_url, e))
-            continue
-
-        yield LocalProcessedResult(source_base, filename, run_state, run.code_version)
+            while True:
+                while len(pending) < PREFETCH_DOWNLOADS \
+                and (not pending or _prefetched_bytes(pending) < PREFETCH_BYTES):
+                    run = next(runs, None)
+                    if run is None:
+                        break
+                    if mirror is None:
+                        future = executor.submit(download_processed_file, run.state.processed)
+                    else:
+                        future = executor.submit(mirror.link_processed_file, run)
+                    pending.append((run, future))
+
+                if not pending:
+                    break
+
+                run, future = pending.popleft()
+                source_base, _ = splitext(relpath(run.source_path, 'sources'))
+                processed_url = run.state.processed
+
+                try:
+                    filename = future.result()
+                except requests.exceptions.HTTPError as e:
+                    if e.response.status_code == 404:
+                        continue
+                    else:
+                        _L.error('HTTP {} while downloading {}: {}'.format(e.response.status_code, processed_url, e))
+                        continue
+                except Exception as e:
+                    _L.error('Failed to download {}: {}'.format(processed_url, e))
+                    continue
+
+                try:
+                    yield LocalProcessedResult(source_base, filename, run.state, run.code_version)
+                finally:
+                    if filename and exists(filename):
+                        remove(filename)
+
+        finally:
+            # Clean up after downloads nobody asked for.
+            for (_, future) in pending:
+                if future.cancel() or future.exception():
+                    continue
+                if future.result() and exists(future.result()):
+                    remove(future.result())
+
+def _prefetched_bytes(pending):
+    ''' Return total size of finished downloads waiting in pending queue.
+    '''
+    filenames = [future.result() for (_, future) in pending
+                 if future.done() and not future.exception()]
 
-        if filename and exists(filename):
-            remove(filename)
+    return sum(getsize(filename) for filename in filenames if filename and exists(filename))
 
 def download_processed_file(url):
     ''' Download a URL to a local temporary file, return its path.
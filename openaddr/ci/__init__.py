@@ -17,8 +17,11 @@ from urllib.parse import urljoin
 from base64 import b64decode
 from tempfile import mkdtemp
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from collections import OrderedDict
 from shutil import rmtree
 from time import time, sleep
+from select import select
 import threading, sys
 import json, os, re
 import socket
@@ -69,9 +72,33 @@ WORKER_COOLDOWN = timedelta(seconds=5)
 # Time to chill out in find_batch_sources() after failing a request.
 GITHUB_RETRY_DELAY = timedelta(seconds=5)
 
+# Number of simultaneous Github requests in find_batch_sources().
+GITHUB_CONCURRENCY = 8
+
+# Number of set maps to render at once, in separate processes.
+RENDER_CONCURRENCY = 4
+
 # Time to wait between heartbeat pings from workers.
 HEARTBEAT_INTERVAL = timedelta(minutes=5)
 
+# Longest time to wait for a queue notification before checking anyway.
+QUEUE_POLL_INTERVAL = timedelta(seconds=15)
+
+# Largest number of done or due tasks to handle between notifications.
+DEQUEUE_BATCH_SIZE = 100
+
+# Amount of time to reuse merged status of a commit in is_merged_to_master().
+MERGE_STATUS_TIMEOUT = timedelta(minutes=10)
+
+# Largest number of items to remember in GithubCache.
+GITHUB_CACHE_SIZE = 10000
+
+# Time to wait before posting Github updates for a job again, times attempts so far.
+JOB_UPDATE_RETRY_DELAY = timedelta(minutes=1)
+
+# Number of times DequeueBatch tries to post Github updates for a job.
+JOB_UPDATE_ATTEMPTS = 10
+
 # Regexp for a PR comment that requests a re-run.
 RETEST_COMMENT_PAT = re.compile(r'^re-?run this,? please\b', re.IGNORECASE|re.MULTILINE)
 
@@ -481,7 +508,7 @@ def update_success_status(status_url, job_url, filenames, github_auth):
 
     return post_github_status(status_url, status, github_auth)
 
-def find_batch_sources(owner, repository, github_auth, run_times={}):
+def find_batch_sources(owner, repository, github_auth, run_times={}, cache_dir=None):
     ''' Starting with a Github repo API URL, generate a stream of master sources.
 
         Each source is a dict with:
@@ -491,32 +518,73 @@ def find_batch_sources(owner, repository, github_auth, run_times={}):
         - commit_sha: commit hash in OA git repo.
         - blob_sha: blob hash in OA git repo.
         - remain: count of sources to come
+
+        Source contents are requested from the git blobs API in parallel,
+        and kept in optional cache_dir keyed on blob SHA for later batches.
     '''
-    source_urls = list(_find_batch_source_urls(owner, repository, github_auth))
+    source_urls = list(_find_batch_source_urls(owner, repository, github_auth, cache_dir))
 
     # sort with the shortest known runs at the end, keeping the 9999's alphabetical.
     source_urls.sort(key=lambda su: su['path'])
     source_urls.sort(key=lambda su: (run_times.get(su['path']) or '9999'), reverse=True)
 
-    for (index, source_url) in enumerate(source_urls):
-        source_url_url = nice_domain(source_url['url'])
-        _L.debug('Getting source {}'.format(source_url_url))
+    def get_content(source_url):
+        return _get_batch_source_content(source_url, github_auth, cache_dir)
+
+    with ThreadPoolExecutor(GITHUB_CONCURRENCY) as executor:
+        # executor.map() yields contents in the same order as source_urls.
+        contents = executor.map(get_content, source_urls)
+
+        for (index, (source_url, content)) in enumerate(zip(source_urls, contents)):
+            source = dict(content=content)
+            source.update(remain=len(source_urls) - index - 1)
+            source.update(source_url)
+
+            yield source
+
+def _get_batch_source_content(source_url, github_auth, cache_dir):
+    ''' Return base 64 content of one batch source from Github or cache_dir.
+    '''
+    cache_path = cache_dir and join(cache_dir, 'blobs', source_url['blob_sha'])
+
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path) as file:
+            return file.read()
+
+    source_url_url = nice_domain(source_url['url'])
+    _L.debug('Getting source {}'.format(source_url_url))
+    try:
+        more_source = get(source_url_url, auth=github_auth).json()
+    except ConnectionError:
+        _L.info('Retrying to download {}'.format(source_url_url))
         try:
+            sleep(GITHUB_RETRY_DELAY.total_seconds())
             more_source = get(source_url_url, auth=github_auth).json()
         except ConnectionError:
-            _L.info('Retrying to download {}'.format(source_url_url))
-            try:
-                sleep(GITHUB_RETRY_DELAY.total_seconds())
-                more_source = get(source_url_url, auth=github_auth).json()
-            except ConnectionError:
-                _L.error('Failed to download {}'.format(source_url_url))
-                raise
+            _L.error('Failed to download {}'.format(source_url_url))
+            raise
+
+    if more_source.get('encoding') != 'base64':
+        raise ValueError('Unrecognized encoding "{}"'.format(more_source.get('encoding')))
 
-        source = dict(content=more_source['content'])
-        source.update(remain=len(source_urls) - index - 1)
-        source.update(source_url)
+    if cache_path:
+        _write_cache_file(cache_path, more_source['content'])
 
-        yield source
+    return more_source['content']
+
+def _write_cache_file(path, content):
+    ''' Write string content to a cache file, safe for concurrent readers.
+    '''
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Rename into place so a partially-written file is never read.
+    temp_path = '{}.{}'.format(path, uuid4().hex)
+
+    with open(temp_path, 'w') as file:
+        file.write(content)
+
+    os.rename(temp_path, path)
 
 def get_batch_run_times(db, owner, repository):
     ''' Return dictionary of source paths to run time strings like '00:01:23'.
@@ -550,11 +618,13 @@ def get_batch_run_times(db, owner, repository):
 
     return run_times
 
-def _find_batch_source_urls(owner, repository, github_auth):
+def _find_batch_source_urls(owner, repository, github_auth, cache_dir=None):
     ''' Starting with a Github repo API URL, return a list of sources.
 
-        Sources are dictionaries, with keys commit_sha, url to content on Github,
-        blob_sha for git blob, and path like 'sources/xx/yy.json'.
+        Sources are dictionaries, with keys commit_sha, url to blob on Github,
+        blob_sha for git blob, and path like 'sources/xx/yy.json'. The whole
+        tree is listed in one recursive git trees API request, and the list
+        is kept in optional cache_dir keyed on commit SHA.
     '''
     resp = get('https://api.github.com/', auth=github_auth)
     if resp.status_code >= 400:
@@ -563,14 +633,59 @@ def _find_batch_source_urls(owner, repository, github_auth):
 
     _L.info('Starting batch sources at {start_url}'.format(**locals()))
     got = get(start_url, auth=github_auth).json()
-    contents_url, commits_url = got['contents_url'], got['commits_url']
+    trees_url, blobs_url, commits_url = got['trees_url'], got['blobs_url'], got['commits_url']
+    contents_url = got['contents_url']
 
     master_url = expand_uri(commits_url, dict(sha=got['default_branch']))
 
     _L.debug('Getting {ref} branch {master_url}'.format(ref=got['default_branch'], **locals()))
     got = get(master_url, auth=github_auth).json()
-    commit_sha, commit_date = got['sha'], got['commit']['committer']['date']
+    commit_sha, tree_sha = got['sha'], got['commit']['tree']['sha']
+
+    cache_path = cache_dir and join(cache_dir, 'trees', '{}.json'.format(commit_sha))
+
+    if cache_path and os.path.exists(cache_path):
+        _L.debug('Reading sources for {} from {}'.format(commit_sha, cache_path))
+        with open(cache_path) as file:
+            return json.load(file)
+
+    tree_url = expand_uri(trees_url + '{?recursive}', dict(sha=tree_sha, recursive=1))
+    _L.debug('Getting sources tree {}'.format(tree_url))
+    tree = get(tree_url, auth=github_auth).json()
+
+    if tree.get('truncated'):
+        # Github limits the size of recursive tree responses.
+        _L.warning('Truncated tree {}, walking sources directory instead'.format(tree_url))
+        sources_list = _walk_batch_source_urls(contents_url, commit_sha, github_auth)
+    else:
+        sources_list = list()
+
+        for source in tree['tree']:
+            if source['type'] != 'blob':
+                continue
+
+            if relpath(source['path'], 'sources').startswith('..'):
+                # Skip things outside of sources directory.
+                continue
 
+            path_base, ext = splitext(source['path'])
+
+            if ext == '.json':
+                blob_url = expand_uri(blobs_url, dict(sha=source['sha']))
+                sources_list.append(dict(commit_sha=commit_sha, url=blob_url,
+                                         blob_sha=source['sha'], path=source['path']))
+
+    if cache_path:
+        _write_cache_file(cache_path, json.dumps(sources_list))
+
+    return sources_list
+
+def _walk_batch_source_urls(contents_url, commit_sha, github_auth):
+    ''' Walk sources directory with contents API, return a list of sources.
+
+        Requires one request per directory, so only used when a recursive
+        git tree is too large for Github to return in one response.
+    '''
     contents_url += '{?ref}' # So that we are consistently at the same commit.
     sources_urls = [expand_uri(contents_url, dict(path='sources', ref=commit_sha))]
     sources_list = list()
@@ -678,34 +793,51 @@ def render_set_maps(s3, db, the_set):
 
 def _render_and_upload_maps(s3, good_sources, s3_prefix, dirname):
     ''' Render set maps, upload them to S3 and return URLs of rendered files.
+
+        Maps are rendered in parallel processes and each is uploaded as soon
+        as it's ready, while the others are still rendering.
     '''
     urls = dict()
-    areas = (render.WORLD, 'world'), (render.USA, 'usa'), (render.EUROPE, 'europe')
+    coverages = render.load_coverages(dirname)
 
-    key_kwargs = dict(headers={'Content-Type': 'image/png'})
+    renders = [
+        ('render-world.png', 'image/png', render.WORLD),
+        ('render-usa.png', 'image/png', render.USA),
+        ('render-europe.png', 'image/png', render.EUROPE),
+        ('render-world.geojson', 'application/vnd.geo+json', render.WORLD),
+        ]
 
-    for (area, area_name) in areas:
-        png_basename = 'render-{}.png'.format(area_name)
-        png_filename = join(dirname, png_basename)
-        render.render_png(dirname, good_sources, 960, 2, png_filename, area)
+    # Render processes are forked, so open shared geodata before starting them.
+    render.preload_geodata({area for (_, _, area) in renders})
 
-        with open(png_filename, 'rb') as file:
-            render_png_key = s3.new_key(join(s3_prefix, png_basename))
-            render_png_key.set_contents_from_string(file.read(), **key_kwargs)
+    with ProcessPoolExecutor(RENDER_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(_render_map, dirname, good_sources, coverages,
+                            join(dirname, basename), area): (basename, content_type)
+            for (basename, content_type, area) in renders
+            }
 
-        urls[area_name] = util.s3_key_url(render_png_key)
+        for future in as_completed(futures):
+            basename, content_type = futures[future]
+            key_kwargs = dict(headers={'Content-Type': content_type})
 
-    key_kwargs.update(headers={'Content-Type': 'application/vnd.geo+json'})
+            with open(future.result(), 'rb') as file:
+                render_key = s3.new_key(join(s3_prefix, basename))
+                render_key.set_contents_from_string(file.read(), **key_kwargs)
 
-    geojson_filename = join(dirname, 'render-world.geojson')
-    render.render_geojson(dirname, good_sources, geojson_filename, render.WORLD)
+            urls[basename] = util.s3_key_url(render_key)
 
-    with open(geojson_filename, 'rb') as file:
-        render_geojson_key = s3.new_key(join(s3_prefix, 'render-world.geojson'))
-        render_geojson_key.set_contents_from_string(file.read(), **key_kwargs)
-        render_geojson_url = util.s3_key_url(render_geojson_key)
+    return tuple(urls[basename] for (basename, _, _) in renders)
+
+def _render_map(dirname, good_sources, coverages, filename, area):
+    ''' Render one set map to a PNG or GeoJSON file and return its name.
+    '''
+    if filename.endswith('.geojson'):
+        render.render_geojson(dirname, good_sources, filename, area, coverages)
+    else:
+        render.render_png(dirname, good_sources, 960, 2, filename, area, coverages)
 
-    return urls['world'], urls['usa'], urls['europe'], render_geojson_url
+    return filename
 
 def _prepare_render_sources(runs, dirname):
     ''' Dump all non-null set runs into a directory for rendering.
@@ -799,8 +931,11 @@ def is_completed_run(db, run_id, min_datetime):
 
     return bool(completed_run is not None)
 
-def update_job_status(db, job_id, job_url, filename, run_status, results, github_auth):
-    '''
+def update_job_status(db, job_id, job_url, filename, run_status, results, github_auth, post_status=True):
+    ''' Record status of one job file, and post overall job status to Github.
+
+        Return the updated Job. Skip posting if post_status is false, so that
+        a DequeueBatch can post once for several files with post_job_status().
     '''
     job = read_job(db, job_id)
 
@@ -810,7 +945,6 @@ def update_job_status(db, job_id, job_url, filename, run_status, results, github
     if filename not in job.states:
         raise Exception('Unknown file from job {}: "{}"'.format(job.id, filename))
 
-    filenames = list(job.task_files.values())
     job.states[filename] = run_status
     job.file_results[filename] = results
 
@@ -828,12 +962,30 @@ def update_job_status(db, job_id, job_url, filename, run_status, results, github
               job.github_owner, job.github_repository, job.github_status_url,
               job.github_comments_url)
 
+    if post_status:
+        post_job_status(job, job_url, github_auth)
+
+    return job
+
+def post_job_status(job, job_url, github_auth, github_cache=None):
+    ''' Push overall status of a job to Github status API.
+
+        Skip statuses identical to one already posted via github_cache.
+    '''
+    filenames = list(job.task_files.values())
+    bad_files = [name for (name, state) in job.states.items() if state is False]
+
     if not job.github_status_url:
         _L.warning('No status_url to tell about {} status of job {}'.format(job.status, job.id))
         return
 
+    status_key = job.github_status_url, job_url, job.status, tuple(bad_files)
+
+    if github_cache is not None and github_cache.statuses.get(job.id) == status_key:
+        _L.debug('Already posted {} status of job {}'.format(job.status, job.id))
+        return
+
     if job.status is False:
-        bad_files = [name for (name, state) in job.states.items() if state is False]
         update_failing_status(job.github_status_url, job_url, bad_files, filenames, github_auth)
 
     elif job.status is None:
@@ -842,6 +994,9 @@ def update_job_status(db, job_id, job_url, filename, run_status, results, github
     elif job.status is True:
         update_success_status(job.github_status_url, job_url, filenames, github_auth)
 
+    if github_cache is not None:
+        github_cache.statuses[job.id] = status_key
+
 def update_job_comments(db, job_id, run_id, github_auth):
     '''
     '''
@@ -878,8 +1033,10 @@ def update_job_comments(db, job_id, run_id, github_auth):
 
     _L.info('Posted {} to new comment: {url}'.format(run.state.preview, **posted.json()))
 
-def is_merged_to_master(db, set_id, job_id, commit_sha, github_auth):
-    '''
+def is_merged_to_master(db, set_id, job_id, commit_sha, github_auth, github_cache=None):
+    ''' Return True if commit_sha is merged to master, or None if unknown.
+
+        Github responses are reused for a while from optional github_cache.
     '''
     # use objects.read_set and read_job so they can be mocked in testing.
     set, job = objects.read_set(db, set_id), objects.read_job(db, job_id)
@@ -892,15 +1049,33 @@ def is_merged_to_master(db, set_id, job_id, commit_sha, github_auth):
         # Missing set and job means unknown merge status.
         return None
 
+    merge_key = job.github_owner, job.github_repository, commit_sha
+
+    if github_cache is not None:
+        is_merged = github_cache.get_merged(merge_key)
+        if is_merged is not None:
+            return is_merged
+
     try:
-        template1 = get('https://api.github.com/', auth=github_auth).json().get('repository_url')
-        repo_url = expand_uri(template1, dict(owner=job.github_owner, repo=job.github_repository))
+        repo_key = job.github_owner, job.github_repository
+
+        if github_cache is not None and repo_key in github_cache.compare_urls:
+            template2 = github_cache.compare_urls[repo_key]
+        else:
+            template1 = get('https://api.github.com/', auth=github_auth).json().get('repository_url')
+            repo_url = expand_uri(template1, dict(owner=job.github_owner, repo=job.github_repository))
+            template2 = get(repo_url, auth=github_auth).json().get('compare_url')
 
-        template2 = get(repo_url, auth=github_auth).json().get('compare_url')
         compare_url = expand_uri(template2, dict(base=commit_sha, head='master'))
 
         compare = get(compare_url, auth=github_auth).json()
-        return compare['base_commit']['sha'] == compare['merge_base_commit']['sha']
+        is_merged = compare['base_commit']['sha'] == compare['merge_base_commit']['sha']
+
+        if github_cache is not None:
+            github_cache.compare_urls[repo_key] = template2
+            github_cache.set_merged(merge_key, is_merged)
+
+        return is_merged
 
     except Exception as e:
         _L.error('Failed to check merged status of {}/{} {}: {}'\
@@ -910,10 +1085,10 @@ def is_merged_to_master(db, set_id, job_id, commit_sha, github_auth):
 def _worker_id():
     return '{}/{}'.format(socket.gethostname(), os.getpid())
 
-def _wait_for_work_lock(lock, heartbeat_queue):
-    ''' Wait around for worker while sending heartbeat pings.
+def _wait_for_work_lock(lock, heartbeat_queue, progress):
+    ''' Wait around for worker while sending heartbeat pings with work progress.
     '''
-    next_put = time()
+    next_put = time() + HEARTBEAT_INTERVAL.seconds + HEARTBEAT_INTERVAL.days * 86400
 
     while True:
         sleep(.1)
@@ -923,27 +1098,33 @@ def _wait_for_work_lock(lock, heartbeat_queue):
             break
 
         if time() > next_put:
-            # Keep this .enqueue() outside the lock, so threads don't confuse Postgres.
-            beatdata = queuedata.Heartbeat(_worker_id())
-            heartbeat_queue.put(beatdata.asdata())
+            # Keep this update outside the lock, so threads don't confuse Postgres.
+            try:
+                progress.update()
+            except Exception as e:
+                _L.warning('Failed to measure work progress: {}'.format(e))
+
+            beatdata = queuedata.Heartbeat(_worker_id(), progress.source_name,
+                                           progress.rows_processed,
+                                           progress.bytes_downloaded)
+            _send_worker_heartbeat(heartbeat_queue, beatdata)
+
             next_put += HEARTBEAT_INTERVAL.seconds + HEARTBEAT_INTERVAL.days * 86400
 
 def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_queue,
-                            output_dir, mapbox_key):
-    '''
+                            output_dir, mapbox_key, block=True):
+    ''' Look for a task in the task queue and run it, return True if found.
     '''
     with task_queue as db:
-        task = task_queue.get()
+        task = task_queue.get(block=block)
 
         # PQ will return NULL after 1 second timeout if not ask
         if task is None:
-            return
-
-        # On the case!
-        beatdata = queuedata.Heartbeat(_worker_id())
-        heartbeat_queue.put(beatdata.asdata())
+            return False
 
         taskdata = queuedata.Task(**task.data)
+        source_name, _ = splitext(relpath(taskdata.name, 'sources'))
+
         _L.info(u'Got file {} from task queue'.format(taskdata.name))
         passed_on_keys = 'job_id', 'file_id', 'name', 'url', 'content_b64', 'commit_sha', 'set_id', 'rerun'
         passed_on_kwargs = {k: getattr(taskdata, k) for k in passed_on_keys}
@@ -972,6 +1153,9 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
             due_task = queuedata.Due(**passed_on_kwargs)
             due_queue.put(due_task.asdata(), schedule_at=td2str(jobs.JOB_TIMEOUT + DUETASK_DELAY))
 
+    # On the case! Sent after the task is taken, so it can't block task pickup.
+    _send_worker_heartbeat(heartbeat_queue, queuedata.Heartbeat(_worker_id(), source_name))
+
     if previous_run:
         # Re-use result from the previous run.
         run_id, state, status = previous_run
@@ -981,13 +1165,12 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
     else:
         # Run the task.
         work_lock = threading.Lock()
-        work_args = work_lock, heartbeat_queue
+        work_args = work_lock, heartbeat_queue, work.WorkProgress(source_name, output_dir)
         work_wait = threading.Thread(target=_wait_for_work_lock, args=work_args)
 
         with work_lock:
             work_wait.start()
 
-            source_name, _ = splitext(relpath(passed_on_kwargs['name'], 'sources'))
             result = work.do_work(s3, passed_on_kwargs['run_id'], source_name,
                                   passed_on_kwargs['content_b64'],
                                   taskdata.render_preview, output_dir,
@@ -1005,14 +1188,19 @@ def pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_que
     # this helps the next job take advantage of previous run results.
     sleep(WORKER_COOLDOWN.seconds + WORKER_COOLDOWN.days * 86400)
 
-def pop_task_from_donequeue(queue, github_auth):
+    return True
+
+def pop_task_from_donequeue(queue, github_auth, block=True, batch=None):
     ''' Look for a completed job in the "done" task queue, update Github status.
+
+        Return True if a task was found. With a DequeueBatch, Github status
+        and comments are left for batch.post_updates() to coalesce.
     '''
     with queue as db:
-        task = queue.get()
+        task = queue.get(block=block)
 
         if task is None:
-            return
+            return False
 
         # Convert dictionary into RunState
         if 'result' in task.data:
@@ -1035,27 +1223,37 @@ def pop_task_from_donequeue(queue, github_auth):
 
         if is_completed_run(db, run_id, task.enqueued_at):
             # We are too late, this got handled.
-            return
+            return True
 
         run_status = bool(message == work.MAGIC_OK_MESSAGE)
-        is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth)
+        github_cache = batch and batch.github_cache
+        is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth, github_cache)
 
         objects.set_run(db, run_id, filename, file_id, content_b64, run_state,
                         run_status, job_id, worker_id, commit_sha, is_merged, set_id)
 
-        if job_id:
+        if job_id and batch:
+            update_job_status(db, job_id, job_url, filename, run_status, results, github_auth, False)
+            batch.add_job(db, job_id, job_url, run_id if run_status else None)
+
+        elif job_id:
             update_job_status(db, job_id, job_url, filename, run_status, results, github_auth)
             if run_status:
                 update_job_comments(db, job_id, run_id, github_auth)
 
-def pop_task_from_duequeue(queue, github_auth):
-    '''
+    return True
+
+def pop_task_from_duequeue(queue, github_auth, block=True, batch=None):
+    ''' Look for an overdue job in the "due" task queue, update Github status.
+
+        Return True if a task was found. With a DequeueBatch, Github status
+        is left for batch.post_updates() to coalesce.
     '''
     with queue as db:
-        task = queue.get()
+        task = queue.get(block=block)
 
         if task is None:
-            return
+            return False
 
         duedata = queuedata.Due(**task.data)
         _L.info(u'Got file {} from due queue'.format(duedata.name))
@@ -1071,19 +1269,165 @@ def pop_task_from_duequeue(queue, github_auth):
 
         if is_completed_run(db, run_id, task.enqueued_at):
             # Everything's fine, this got handled.
-            return
+            return True
 
         run_status = False
-        is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth)
+        github_cache = batch and batch.github_cache
+        is_merged = is_merged_to_master(db, set_id, job_id, commit_sha, github_auth, github_cache)
 
         set_run(db, run_id, filename, file_id, content_b64, RunState(None), run_status,
                 job_id, worker_id, commit_sha, is_merged, set_id)
 
-        if job_id:
+        if job_id and batch:
+            update_job_status(db, job_id, job_url, filename, run_status, False, github_auth, False)
+            batch.add_job(db, job_id, job_url, None)
+
+        elif job_id:
             update_job_status(db, job_id, job_url, filename, run_status, False, github_auth)
 
+    return True
+
+def drain_queue(pop_function, queue, github_auth, limit=DEQUEUE_BATCH_SIZE, batch=None):
+    ''' Call a pop_task_from_*queue() function until queue is empty, return count.
+
+        Does not block on an empty queue, and handles at most limit tasks
+        so that other queues get a turn.
+    '''
+    for count in range(limit):
+        if not pop_function(queue, github_auth, block=False, batch=batch):
+            return count
+
+    return limit
+
+class GithubCache:
+    ''' Github API results kept between dequeued tasks.
+
+        Merge status of a commit is kept for MERGE_STATUS_TIMEOUT, because
+        a commit can be merged to master after its first run.
+    '''
+    def __init__(self):
+        self.compare_urls, self.statuses, self._merged = dict(), dict(), dict()
+
+    def get_merged(self, key):
+        if key in self._merged:
+            is_merged, expires = self._merged[key]
+            if time() < expires:
+                return is_merged
+
+    def set_merged(self, key, is_merged):
+        if len(self._merged) > GITHUB_CACHE_SIZE:
+            self._merged.clear()
+        self._merged[key] = is_merged, time() + MERGE_STATUS_TIMEOUT.total_seconds()
+
+class DequeueBatch:
+    ''' Job updates from batches of done and due tasks, to post to Github at once.
+
+        Updates wait in the job_updates table, added in the same transaction
+        that takes each task, so a dequeuer restart does not lose them.
+    '''
+    def __init__(self, github_cache):
+        self.github_cache = github_cache
+
+    def add_job(self, db, job_id, job_url, run_id):
+        ''' Remember a job with changed status, and optional successful run.
+        '''
+        db.execute('''INSERT INTO job_updates (job_id, job_url, run_id)
+                      VALUES (%s, %s, %s)''', (job_id, job_url, run_id))
+
+    def post_updates(self, queue, github_auth):
+        ''' Post one status for each job, and comments for its successful runs.
+
+            Each job is posted and removed in its own transaction, so one bad
+            job can't hold up the others. Failed updates are kept and tried
+            again after JOB_UPDATE_RETRY_DELAY times their attempts so far,
+            up to JOB_UPDATE_ATTEMPTS times.
+        '''
+        if len(self.github_cache.statuses) > GITHUB_CACHE_SIZE:
+            self.github_cache.statuses.clear()
+
+        with queue as db:
+            db.execute('''SELECT id, job_id, job_url, run_id
+                          FROM job_updates WHERE next_try <= NOW() ORDER BY id''')
+            rows = db.fetchall()
+
+        updates = OrderedDict()
+
+        for (update_id, job_id, job_url, run_id) in rows:
+            update_ids, _, run_ids = updates.get(job_id, ([], None, []))
+            update_ids.append(update_id)
+            if run_id is not None:
+                run_ids.append(run_id)
+            updates[job_id] = update_ids, job_url, run_ids
+
+        for (job_id, (update_ids, job_url, run_ids)) in updates.items():
+            with queue as db:
+                db.execute('SAVEPOINT job_update')
+
+                try:
+                    self._post_job(db, job_id, job_url, run_ids, github_auth)
+                except Exception:
+                    db.execute('ROLLBACK TO SAVEPOINT job_update')
+                    _L.error('Failed to post Github updates for job {}'.format(job_id), exc_info=True)
+                else:
+                    db.execute('RELEASE SAVEPOINT job_update')
+                    db.execute('''DELETE FROM job_updates WHERE id = ANY(%s)''', (update_ids, ))
+                    continue
+
+                db.execute('''UPDATE job_updates
+                              SET attempts = attempts + 1,
+                                  next_try = NOW() + %s * (attempts + 1)
+                              WHERE id = ANY(%s)''',
+                           (JOB_UPDATE_RETRY_DELAY, update_ids))
+
+                db.execute('''DELETE FROM job_updates
+                              WHERE id = ANY(%s) AND attempts >= %s''',
+                           (update_ids, JOB_UPDATE_ATTEMPTS))
+
+                if db.rowcount:
+                    _L.error('Gave up posting Github updates for job {}'.format(job_id))
+
+    def _post_job(self, db, job_id, job_url, run_ids, github_auth):
+        ''' Post status of one job, and comments for its successful runs.
+        '''
+        job = read_job(db, job_id)
+
+        if job is None:
+            raise Exception('Job {} not found'.format(job_id))
+
+        post_job_status(job, job_url, github_auth, self.github_cache)
+
+        if job.status is True:
+            for run_id in run_ids:
+                update_job_comments(db, job_id, run_id, github_auth)
+
+def send_heartbeat(db, beatdata):
+    ''' Record a worker heartbeat with its progress, one row per worker.
+    '''
+    db.execute('''INSERT INTO heartbeats (worker_id, datetime, source_name,
+                                           rows_processed, bytes_downloaded)
+                  VALUES (%s, NOW(), %s, %s, %s)
+                  ON CONFLICT (worker_id) DO UPDATE
+                  SET datetime = EXCLUDED.datetime, source_name = EXCLUDED.source_name,
+                      rows_processed = EXCLUDED.rows_processed,
+                      bytes_downloaded = EXCLUDED.bytes_downloaded''',
+               (beatdata.worker_id, beatdata.source_name,
+                beatdata.rows_processed, beatdata.bytes_downloaded))
+
+def _send_worker_heartbeat(heartbeat_queue, beatdata):
+    ''' Record a worker heartbeat in its own transaction, logging any failure.
+    '''
+    try:
+        with heartbeat_queue as db:
+            send_heartbeat(db, beatdata)
+    except Exception as e:
+        _L.warning('Failed to send heartbeat: {}'.format(e))
+
 def flush_heartbeat_queue(queue):
     ''' Clear out heartbeat queue, logging each one.
+
+        Workers now write heartbeats directly with send_heartbeat(),
+        but older workers may still be sending them through the queue.
+        A heartbeat that can't be recorded is logged and dropped.
     '''
     with queue as db:
         for task in queue:
@@ -1093,27 +1437,30 @@ def flush_heartbeat_queue(queue):
             beatdata = queuedata.Heartbeat(**task.data)
             _L.info('Got heartbeat {}: {}'.format(task.id, beatdata.worker_id))
 
-            db.execute('''DELETE FROM heartbeats
-                          WHERE worker_id = %s''',
-                       (beatdata.worker_id, ))
+            db.execute('SAVEPOINT heartbeat')
 
-            db.execute('''INSERT INTO heartbeats (worker_id, datetime)
-                          VALUES (%s, NOW())''',
-                       (beatdata.worker_id, ))
+            try:
+                send_heartbeat(db, beatdata)
+            except Exception as e:
+                db.execute('ROLLBACK TO SAVEPOINT heartbeat')
+                _L.warning('Failed to record heartbeat: {}'.format(e))
+            else:
+                db.execute('RELEASE SAVEPOINT heartbeat')
 
-def get_recent_workers(db):
+def get_recent_heartbeats(db):
+    ''' Return list of recent worker heartbeats, with progress.
     '''
-    '''
-    recent_workers = list()
-
-    db.execute('''SELECT worker_id
-                  FROM heartbeats WHERE datetime >= NOW() - INTERVAL %s''',
+    db.execute('''SELECT worker_id, source_name, rows_processed, bytes_downloaded
+                  FROM heartbeats WHERE datetime >= NOW() - INTERVAL %s
+                  ORDER BY worker_id''',
                (HEARTBEAT_INTERVAL * 3, ))
 
-    for (id, ) in db.fetchall():
-        recent_workers.append(id)
+    return [queuedata.Heartbeat(*row) for row in db.fetchall()]
 
-    return recent_workers
+def get_recent_workers(db):
+    '''
+    '''
+    return [beat.worker_id for beat in get_recent_heartbeats(db)]
 
 def db_connect(dsn=None, user=None, password=None, host=None, port=None, database=None, sslmode=None):
     ''' Connect to database.
@@ -1128,6 +1475,34 @@ def db_connect(dsn=None, user=None, password=None, host=None, port=None, databas
 def db_queue(conn, name):
     return PQ(conn, table='queue')[name]
 
+def db_listen(conn, names):
+    ''' Subscribe connection to notifications for new items in named queues.
+
+        PQ sends a Postgres NOTIFY on the queue name with each new item.
+    '''
+    with conn.cursor() as db:
+        for name in names:
+            db.execute('LISTEN "{}"'.format(name))
+
+    # LISTEN takes effect only once committed.
+    conn.commit()
+
+def db_wait_for_notifies(conn, timeout):
+    ''' Wait up to timeout for notifications on a db_listen() connection.
+
+        Return set of queue names with new items, possibly empty. Queues
+        should still be checked after an empty result, because scheduled
+        items become ready without a notification.
+    '''
+    if not conn.notifies:
+        select([conn], [], [], timeout.total_seconds())
+
+    conn.poll()
+    names = set([notify.channel for notify in conn.notifies])
+    del conn.notifies[:]
+
+    return names
+
 def db_cursor(conn):
     return conn.cursor()
 
@@ -1,27 +1,41 @@
 import logging; _L = logging.getLogger('openaddr.ci.collect')
 
 from argparse import ArgumentParser
-from collections import defaultdict
-from os import environ, stat, close, remove
-from zipfile import ZipFile, ZIP_DEFLATED
-from os.path import splitext, exists, basename, join, dirname
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import cpu_count
+from os import environ, stat, close, remove, pread, SEEK_SET, SEEK_CUR, SEEK_END
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, BadZipFile, sizeFileHeader
+from os.path import splitext, exists, basename, join, dirname, relpath
 from urllib.parse import urlparse
 from operator import attrgetter
 from csv import DictReader, DictWriter
 from tempfile import mkstemp, mkdtemp
-from itertools import product
-from io import TextIOWrapper
+from itertools import product, islice
+from io import TextIOWrapper, StringIO
 from datetime import date
-from shutil import rmtree
+from shutil import rmtree, move
 from math import ceil, floor, sqrt
+from base64 import b64encode
+import struct, hashlib, json
 
 from .objects import read_latest_set, read_completed_runs_to_date
 from . import db_connect, db_cursor, setup_logger, log_function_errors
-from .. import S3, iterate_local_processed_files, util
+from .mirror import ProcessedMirror
+from .. import S3, LocalProcessedResult, iterate_local_processed_files, util
 from ..conform import OPENADDR_CSV_SCHEMA
 
 MULTIPART_CHUNK_SIZE = 5 * 1024 * 1024
 
+# Number of CSV rows validated and written at once in add_csv_to_zipfile().
+CSV_BATCH_SIZE = 10000
+
+# Number of multipart upload parts sent to S3 at once.
+UPLOAD_CONCURRENCY = 4
+
+# Number of processes parsing and compressing sources at once.
+COLLECT_CONCURRENCY = cpu_count()
+
 parser = ArgumentParser(description='Run some source files.')
 
 parser.add_argument('-o', '--owner', default='openaddresses',
@@ -36,6 +50,12 @@ parser.add_argument('-b', '--bucket', default=environ.get('AWS_S3_BUCKET', None)
 parser.add_argument('-d', '--database-url', default=environ.get('DATABASE_URL', None),
                     help='Optional connection string for database. Defaults to value of DATABASE_URL environment variable.')
 
+parser.add_argument('--mirror-dir', default=environ.get('PROCESSED_MIRROR_DIR', None),
+                    help='Optional local mirror directory for processed files. Defaults to value of PROCESSED_MIRROR_DIR environment variable.')
+
+parser.add_argument('--incremental', action='store_true',
+                    help='Reuse unchanged sources from previously-published collection zips.')
+
 parser.add_argument('--sns-arn', default=environ.get('AWS_SNS_ARN', None),
                     help='Optional AWS Simple Notification Service (SNS) resource. Defaults to value of AWS_SNS_ARN environment variable.')
 
@@ -77,10 +97,12 @@ def main():
 
     collections = prepare_collections(s3, set, dir, area_tests, sa_tests)
 
-    for result in iterate_local_processed_files(runs):
-        for (collection, test) in collections:
-            if test(result):
-                collection.collect(result)
+    if args.incremental:
+        load_previous_collections(s3, collections, dir)
+        runs = collect_previous_runs(collections, runs)
+
+    mirror = args.mirror_dir and ProcessedMirror(args.mirror_dir)
+    collect_results(collections, iterate_local_processed_files(runs, mirror=mirror), dir)
 
     with db_connect(**db_args) as conn:
         with db_cursor(conn) as db:
@@ -90,6 +112,113 @@ def main():
 
     rmtree(dir)
 
+def collect_results(collections, results, dir):
+    ''' Add each LocalProcessedResult to every matching collection.
+
+        Sources are parsed, filtered and compressed once each by a pool of
+        processes, then the compressed members are copied as-is into
+        matching collection zips by a pool of threads.
+    '''
+    pending = deque()
+
+    def finish_next():
+        result, matches, source_path, future = pending.popleft()
+
+        try:
+            prepared_path = future.result()
+            add = lambda collection: collection.collect_prepared(result, prepared_path)
+            list(threads.map(add, matches))
+            remove(prepared_path)
+        finally:
+            remove(source_path)
+
+    with ProcessPoolExecutor(COLLECT_CONCURRENCY) as processes, \
+         ThreadPoolExecutor(max(1, len(collections))) as threads:
+        for (index, result) in enumerate(results):
+            matches = [collection for (collection, test) in collections if test(result)]
+
+            if not matches:
+                continue
+
+            # Move downloaded file out of the way of the results iterator,
+            # which removes each one when asked for the next.
+            _, ext = splitext(result.filename)
+            source_path = join(dir, 'source-{}{}'.format(index, ext))
+            move(result.filename, source_path)
+
+            future = processes.submit(prepare_source, result.source_base, source_path, dir)
+            pending.append((result, matches, source_path, future))
+
+            while len(pending) > COLLECT_CONCURRENCY:
+                finish_next()
+
+        while pending:
+            finish_next()
+
+def collect_previous_runs(collections, runs):
+    ''' Copy unchanged runs from previous collection zips, return the rest.
+
+        A run is unchanged when every matching collection has members
+        from a previous run with the same process hash.
+    '''
+    remaining_runs = list()
+
+    for run in runs:
+        if not (run.state and run.state.processed):
+            continue
+
+        source_base, _ = splitext(relpath(run.source_path, 'sources'))
+        result = LocalProcessedResult(source_base, None, run.state, run.code_version)
+        matches = [collection for (collection, test) in collections if test(result)]
+
+        if all(collection.has_previous(result) for collection in matches):
+            for collection in matches:
+                collection.collect_previous(result)
+        else:
+            remaining_runs.append(run)
+
+    return remaining_runs
+
+def load_previous_collections(s3, collections, dir):
+    ''' Download previously-published collection zips for reuse of their members.
+
+        Every source in an area collection is also in the global collection
+        with the same license, so just those are downloaded and indexed, once
+        each, and shared by all collections.
+    '''
+    previous = dict()
+
+    for license_attr in sorted({collection.license_attr for (collection, _) in collections}):
+        name = _collection_zip_name('global', license_attr)
+        key = s3.bucket.get_key(name)
+
+        if key is None:
+            continue
+
+        filename = join(dir, 'previous-' + name)
+        _L.info(u'Downloading previous {} to {}'.format(key.name, filename))
+        key.get_contents_to_filename(filename)
+
+        previous_zip = ZipFile(filename, 'r')
+        previous[license_attr] = previous_zip, index_zipfile_members(previous_zip)
+
+    for (collection, _) in collections:
+        if collection.license_attr in previous:
+            collection.load_previous(*previous[collection.license_attr])
+
+def prepare_source(source_base, filename, dir):
+    ''' Write a processed source file to a new zipfile, return its path.
+
+        Members of the returned zipfile are ready to copy into collections.
+    '''
+    handle, prepared_path = mkstemp(prefix='prepared-', suffix='.zip', dir=dir)
+    close(handle)
+
+    with ZipFile(prepared_path, 'w', ZIP_DEFLATED, allowZip64=True) as zip_out:
+        _add_file_to_zipfile(zip_out, source_base, filename)
+
+    return prepared_path
+
 def prepare_collections(s3, set, dir, area_tests, sa_tests):
     '''
     '''
@@ -100,15 +229,18 @@ def prepare_collections(s3, set, dir, area_tests, sa_tests):
         return lambda result: (test1(result) and test2(result))
 
     for ((area_id, area_test), (attr_id, sa_test)) in pairs:
-        area_suffix = ('-' + area_id).rstrip('-')
-        attr_suffix = ('-' + attr_id).rstrip('-')
-        new_name = 'openaddr-collected{}{}.zip'.format(area_suffix, attr_suffix)
+        new_name = _collection_zip_name(area_id, attr_id)
         new_zip = _prepare_zip(set, join(dir, new_name))
         new_collection = CollectorPublisher(s3, new_zip, area_id, attr_id)
         collections.append((new_collection, _and(area_test, sa_test)))
 
     return collections
 
+def _collection_zip_name(area_id, attr_id):
+    area_suffix = ('-' + area_id).rstrip('-')
+    attr_suffix = ('-' + attr_id).rstrip('-')
+    return 'openaddr-collected{}{}.zip'.format(area_suffix, attr_suffix)
+
 def _prepare_zip(set, filename):
     '''
     '''
@@ -139,12 +271,49 @@ class CollectorPublisher:
         self.results = set()
         self.collection_id = collection_id
         self.license_attr = license_attr
+        self.previous_zip = None
+        self.previous_members = dict()
+
+    def load_previous(self, previous_zip, previous_members):
+        ''' Use previously-published collection zip for reuse of its members.
+
+            Zip and member index come from load_previous_collections(),
+            and may be shared with other collections.
+        '''
+        self.previous_zip = previous_zip
+        self.previous_members = previous_members
+
+    def has_previous(self, result):
+        ''' Return true if previous collection zip has members for an unchanged result.
+        '''
+        return _result_member_key(result) in self.previous_members
+
+    def collect_previous(self, result):
+        ''' Add LocalProcessedResult instance to collection zip from previous zip.
+
+            Copies compressed members with matching source and process hash.
+        '''
+        _L.info(u'Reusing {} in {}'.format(result.source_base, self.zip.filename))
+
+        for zipinfo in self.previous_members[_result_member_key(result)]:
+            _copy_zipfile_member(self.previous_zip, zipinfo, self.zip)
 
-    def collect(self, result):
+        self.results.add(result)
+
+    def collect_prepared(self, result, prepared_path):
         ''' Add LocalProcessedResult instance to collection zip.
+
+            Copies compressed members from the zipfile at prepared_path,
+            as returned by prepare_source().
         '''
         _L.info(u'Adding {} to {}'.format(result.source_base, self.zip.filename))
-        add_source_to_zipfile(self.zip, result)
+
+        comment = _result_member_comment(result)
+
+        with ZipFile(prepared_path, 'r') as prepared_zip:
+            for zipinfo in prepared_zip.infolist():
+                _copy_zipfile_member(prepared_zip, zipinfo, self.zip, comment)
+
         self.results.add(result)
 
     def publish(self, db):
@@ -156,6 +325,10 @@ class CollectorPublisher:
         self.zip.close()
         _L.info(u'Finished {}'.format(self.zip.filename))
 
+        if self.previous_zip:
+            # May be shared with other collections, but close() is idempotent.
+            self.previous_zip.close()
+
         zip_key = write_to_s3(self.s3.bucket, self.zip.filename, basename(self.zip.filename))
         _L.info(u'Uploaded {} to {}'.format(self.zip.filename, zip_key.name))
 
@@ -169,19 +342,63 @@ class CollectorPublisher:
                       VALUES (%s, NOW(), true, %s, %s, %s)''',
                    (zip_url, length, self.collection_id, self.license_attr))
 
-def _upload_s3_part(s3_bucket, multipart_id, part_num, source_path, offset, bytes, retries=3):
+class _FilePart:
+    ''' Read-only file-like view of a byte range in a shared open file.
+
+        Uses positional reads, so several parts of one file can be
+        uploaded from different threads without reopening it.
+    '''
+    mode = 'rb'
+
+    def __init__(self, file, offset, size):
+        self.name = file.name
+        self._fileno = file.fileno()
+        self._offset, self._size = offset, size
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            position += self._position
+        elif whence == SEEK_END:
+            position += self._size
+
+        self._position = min(max(position, 0), self._size)
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._size - self._position
+        size = remaining if (size is None or size < 0) else min(size, remaining)
+        data = pread(self._fileno, size, self._offset + self._position)
+        self._position += len(data)
+        return data
+
+    def compute_md5(self):
+        ''' Return hex and base64 MD5 digests of the part, as boto expects them.
+        '''
+        md5 = hashlib.md5()
+        self.seek(0)
+
+        for chunk in iter(lambda: self.read(1024 * 1024), b''):
+            md5.update(chunk)
+
+        self.seek(0)
+        return md5.hexdigest(), b64encode(md5.digest()).decode('ascii')
+
+def _upload_s3_part(mp, part_num, file, offset, bytes, retries=3):
     """ Uploads a part to S3 with retries.
     """
+    part = _FilePart(file, offset, bytes)
+    md5 = part.compute_md5()
+
     while True:
         retries -= 1
         try:
             _L.info('Start uploading part #%d ...', part_num)
-            for mp in s3_bucket.get_all_multipart_uploads():
-                if mp.id == multipart_id:
-                    with open(source_path, 'rb') as fp:
-                        fp.seek(offset)
-                        mp.upload_part_from_file(fp=fp, part_num=part_num, size=bytes)
-                    break
+            part.seek(0)
+            mp.upload_part_from_file(fp=part, part_num=part_num, size=bytes, md5=md5)
         except Exception:
             if retries == 0:
                 _L.info('... Failed uploading part #%d', part_num)
@@ -194,6 +411,9 @@ def write_to_s3(s3_bucket, filename, keyname, policy='private', content_type='ap
     ''' Writes the file at `filename` to the S3 key `keyname` using
         S3's multipart upload functionality.
 
+        Parts are uploaded UPLOAD_CONCURRENCY at a time, each with an MD5
+        checksum for S3 to verify.
+
         Returns the S3 Key object for the file that was uploaded.
     '''
     mp = s3_bucket.initiate_multipart_upload(keyname, headers={'Content-Type': content_type})
@@ -203,12 +423,23 @@ def write_to_s3(s3_bucket, filename, keyname, policy='private', content_type='ap
     bytes_per_chunk = max(int(sqrt(MULTIPART_CHUNK_SIZE) * sqrt(source_size)), MULTIPART_CHUNK_SIZE)
     chunk_count = int(ceil(source_size / float(bytes_per_chunk)))
 
-    for i in range(chunk_count):
-        offset = i * bytes_per_chunk
-        remaining_bytes = source_size - offset
-        bytes = min([bytes_per_chunk, remaining_bytes])
-        part_num = i + 1
-        _upload_s3_part(s3_bucket, mp.id, part_num, filename, offset, bytes)
+    try:
+        with open(filename, 'rb') as file, ThreadPoolExecutor(UPLOAD_CONCURRENCY) as executor:
+            futures = list()
+
+            for i in range(chunk_count):
+                offset = i * bytes_per_chunk
+                remaining_bytes = source_size - offset
+                bytes = min([bytes_per_chunk, remaining_bytes])
+                part_num = i + 1
+                futures.append(executor.submit(_upload_s3_part, mp, part_num,
+                                               file, offset, bytes))
+
+            for future in futures:
+                future.result()
+    except:
+        mp.cancel_upload()
+        raise
 
     if len(mp.get_all_parts()) != chunk_count:
         mp.cancel_upload()
@@ -224,58 +455,71 @@ def write_to_s3(s3_bucket, filename, keyname, policy='private', content_type='ap
 def add_csv_to_zipfile(zip_out, arc_filename, file):
     ''' Write csv to zipfile.
 
-        File is assumed to be open in binary mode.
+        File is assumed to be open in binary mode. Rows are streamed into
+        a temporary CSV file CSV_BATCH_SIZE at a time, counting addresses
+        in integer-indexed grid squares for the spatial summary.
     '''
     handle, tmp_filename = mkstemp(suffix='.csv'); close(handle)
-    size, squares = .1, defaultdict(lambda: 0)
+    size, squares = .1, Counter()
+    in_csv = DictReader(TextIOWrapper(file, 'utf8'))
 
-    with open(tmp_filename, 'w') as output:
-        in_csv = DictReader(TextIOWrapper(file, 'utf8'))
-        out_csv = DictWriter(output, OPENADDR_CSV_SCHEMA, dialect='excel')
-        out_csv.writerow({col: col for col in OPENADDR_CSV_SCHEMA})
+    try:
+        with open(tmp_filename, 'w', encoding='utf8', newline='') as output:
+            out_csv = DictWriter(output, OPENADDR_CSV_SCHEMA, dialect='excel', extrasaction='ignore')
+            out_csv.writeheader()
 
-        for row in in_csv:
-            try:
-                lat, lon = float(row['LAT']), float(row['LON'])
-            except ValueError:
-                continue
+            while True:
+                rows = list(islice(in_csv, CSV_BATCH_SIZE))
 
-            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
-                continue
+                if not rows:
+                    break
 
-            out_csv.writerow({col: row.get(col) for col in OPENADDR_CSV_SCHEMA})
-            key = floor(lat / size) * size, floor(lon / size) * size
-            squares[key] += 1
+                lonlats = [_row_lonlat(row) for row in rows]
+                out_csv.writerows(row for (row, lonlat) in zip(rows, lonlats) if lonlat)
+                squares.update((floor(lat / size), floor(lon / size)) for (lon, lat) in filter(None, lonlats))
 
-    zip_out.write(tmp_filename, arc_filename)
-    remove(tmp_filename)
+        zip_out.write(tmp_filename, arc_filename, ZIP_DEFLATED)
+    finally:
+        remove(tmp_filename)
 
     _add_spatial_summary_to_zipfile(zip_out, arc_filename, size, squares)
 
-def _add_spatial_summary_to_zipfile(zip_out, arc_filename, size, squares):
+def _row_lonlat(row):
+    ''' Return (lon, lat) tuple for a CSV row, or None if it's not on earth.
     '''
+    try:
+        lat, lon = float(row['LAT']), float(row['LON'])
+    except ValueError:
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+
+    return lon, lat
+
+def _add_spatial_summary_to_zipfile(zip_out, arc_filename, size, squares):
+    ''' Write summary CSV and VRT for counts of grid squares keyed on (lat, lon) indexes.
     '''
     assert size in (.1, .2, .5, 1.)
     F = '{:.1f}'
 
-    handle, tmp_filename = mkstemp(suffix='.csv'); close(handle)
+    prefix, _ = splitext(arc_filename)
+    support_csvname = join('summary', prefix+'-summary.csv')
+    support_vrtname = join('summary', prefix+'-summary.vrt')
 
-    with open(tmp_filename, 'w') as output:
+    # Write the contents of the summary file.
+    with StringIO(newline='') as output:
         columns = 'count', 'lon', 'lat', 'area'
         out_csv = DictWriter(output, columns, dialect='excel')
-        out_csv.writerow({col: col for col in columns})
+        out_csv.writeheader()
 
-        for ((lat, lon), count) in sorted(squares.items()):
+        for ((y, x), count) in sorted(squares.items()):
+            lon, lat = x * size, y * size
             args = [F.format(n) for n in (lon, lat, lon + size, lat + size)]
             area = 'POLYGON(({0} {1},{0} {3},{2} {3},{2} {1},{0} {1}))'.format(*args)
             out_csv.writerow(dict(count=count, lon=F.format(lon), lat=F.format(lat), area=area))
 
-    prefix, _ = splitext(arc_filename)
-    support_csvname = join('summary', prefix+'-summary.csv')
-    support_vrtname = join('summary', prefix+'-summary.vrt')
-
-    # Write the contents of the summary file.
-    zip_out.write(tmp_filename, support_csvname)
+        zip_out.writestr(support_csvname, output.getvalue().encode('utf8'), ZIP_DEFLATED)
 
     with open(join(dirname(__file__), 'templates', 'source-summary.vrt'), 'rb') as file:
         args = dict(filename=basename(support_csvname))
@@ -285,19 +529,90 @@ def _add_spatial_summary_to_zipfile(zip_out, arc_filename, size, squares):
     # Write the contents of the summary file VRT.
     zip_out.writestr(support_vrtname, vrt_content)
 
-    remove(tmp_filename)
+def index_zipfile_members(zip_in):
+    ''' Return lists of zipfile members keyed on (source base, process hash).
 
-def add_source_to_zipfile(zip_out, result):
-    ''' Add a LocalProcessedResult to zipfile via add_csv_to_zipfile().
+        Keys come from member comments written by collect_prepared().
+    '''
+    members = defaultdict(list)
+
+    for zipinfo in zip_in.infolist():
+        try:
+            tag = json.loads(zipinfo.comment.decode('utf8'))
+            members[(tag['source'], tag['process hash'])].append(zipinfo)
+        except (ValueError, TypeError, KeyError):
+            # Untagged member, e.g. README.txt or LICENSE.txt.
+            continue
+
+    return dict(members)
+
+def _result_member_key(result):
+    return result.source_base, result.run_state.process_hash
+
+def _result_member_comment(result):
+    ''' Return a zipfile member comment tagging it with a result's source and process hash.
+    '''
+    if not result.run_state.process_hash:
+        # Without a hash there is no way to know if the source changed later.
+        return b''
+
+    tag = {'source': result.source_base, 'process hash': result.run_state.process_hash}
+    return json.dumps(tag, sort_keys=True).encode('utf8')
+
+def _copy_zipfile_member(zip_in, zipinfo, zip_out, comment=None):
+    ''' Copy compressed bytes of one zipfile member to another zipfile.
+
+        Writes a new local header and member data the way ZipFile.write() does.
+        Keeps the member comment unless a new one is given.
+
+        ZipFile has no public API for this, so the private _lock, _writecheck(),
+        start_dir and _didModify are used as in CPython 3.5 through 3.11;
+        TestCollect.test_copy_zipfile_member checks the result with testzip().
+    '''
+    zip_in.fp.seek(zipinfo.header_offset)
+    header = zip_in.fp.read(sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    zip_in.fp.seek(name_length + extra_length, SEEK_CUR)
+
+    info = ZipInfo(zipinfo.filename, zipinfo.date_time)
+    info.compress_type = zipinfo.compress_type
+    info.create_system = zipinfo.create_system
+    info.external_attr = zipinfo.external_attr
+    info.CRC = zipinfo.CRC
+    info.compress_size = zipinfo.compress_size
+    info.file_size = zipinfo.file_size
+    info.comment = zipinfo.comment if comment is None else comment
+
+    with zip_out._lock:
+        zip_out._writecheck(info)
+        zip_out.fp.seek(zip_out.start_dir)
+        info.header_offset = zip_out.fp.tell()
+        zip_out.fp.write(info.FileHeader())
+
+        remaining = info.compress_size
+        while remaining:
+            chunk = zip_in.fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise BadZipFile('Truncated member {}'.format(zipinfo.filename))
+            zip_out.fp.write(chunk)
+            remaining -= len(chunk)
+
+        zip_out.filelist.append(info)
+        zip_out.NameToInfo[info.filename] = info
+        zip_out.start_dir = zip_out.fp.tell()
+        zip_out._didModify = True
+
+def _add_file_to_zipfile(zip_out, source_base, filename):
+    ''' Add a processed source file to zipfile via add_csv_to_zipfile().
     '''
-    _, ext = splitext(result.filename)
+    _, ext = splitext(filename)
 
     if ext == '.csv':
-        with open(result.filename) as file:
-            add_csv_to_zipfile(zip_out, result.source_base + ext, file)
+        with open(filename) as file:
+            add_csv_to_zipfile(zip_out, source_base + ext, file)
 
     elif ext == '.zip':
-        with open(result.filename, 'rb') as file:
+        with open(filename, 'rb') as file:
             zip_in = ZipFile(file, 'r')
             for zipinfo in zip_in.infolist():
                 if zipinfo.filename == 'README.txt':
@@ -28,6 +28,9 @@ parser.add_argument('-r', '--repository', default='openaddresses',
 parser.add_argument('-t', '--github-token', default=environ.get('GITHUB_TOKEN', None),
                     help='Optional token value for reading from Github. Defaults to value of GITHUB_TOKEN environment variable.')
 
+parser.add_argument('--github-cache-dir', default=environ.get('GITHUB_CACHE_DIR', None),
+                    help='Optional directory for caching source lists and contents from Github. Defaults to value of GITHUB_CACHE_DIR environment variable.')
+
 parser.add_argument('-d', '--database-url', default=environ.get('DATABASE_URL', None),
                     help='Optional connection string for database. Defaults to value of DATABASE_URL environment variable.')
 
@@ -71,7 +74,8 @@ def main():
             with task_Q as db:
                 run_times = get_batch_run_times(db, args.owner, args.repository)
 
-            sources = find_batch_sources(args.owner, args.repository, github_auth, run_times)
+            sources = find_batch_sources(args.owner, args.repository, github_auth,
+                                         run_times, args.github_cache_dir)
 
             with task_Q as db:
                 new_set = add_set(db, args.owner, args.repository)
@@ -0,0 +1,232 @@
+import logging; _L = logging.getLogger('openaddr.ci.mirror')
+
+from argparse import ArgumentParser
+from urllib.parse import urlparse
+from os.path import splitext, join, exists, dirname, getsize
+from os import environ, close, remove, rename, link, makedirs, stat, utime, scandir
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkstemp
+from threading import Lock
+from shutil import copyfile
+from time import time
+import errno
+
+from .objects import read_latest_set, read_completed_runs_to_date
+from . import db_connect, db_cursor, setup_logger, log_function_errors
+from .. import download_processed_file, util
+
+# Largest total size of processed files to keep in a mirror.
+MIRROR_MAX_BYTES = 100 * 1024 * 1024 * 1024
+
+# Number of processed files to download at once while syncing.
+SYNC_CONCURRENCY = 8
+
+# Number of times to fetch a processed file evicted before it could be linked.
+LINK_ATTEMPTS = 3
+
+parser = ArgumentParser(description='Download processed results of the latest set to a local mirror.')
+
+parser.add_argument('-o', '--owner', default='openaddresses',
+                    help='Github repository owner. Defaults to "openaddresses".')
+
+parser.add_argument('-r', '--repository', default='openaddresses',
+                    help='Github repository name. Defaults to "openaddresses".')
+
+parser.add_argument('-d', '--database-url', default=environ.get('DATABASE_URL', None),
+                    help='Optional connection string for database. Defaults to value of DATABASE_URL environment variable.')
+
+parser.add_argument('--mirror-dir', default=environ.get('PROCESSED_MIRROR_DIR', None),
+                    help='Local mirror directory. Defaults to value of PROCESSED_MIRROR_DIR environment variable.')
+
+parser.add_argument('--sns-arn', default=environ.get('AWS_SNS_ARN', None),
+                    help='Optional AWS Simple Notification Service (SNS) resource. Defaults to value of AWS_SNS_ARN environment variable.')
+
+parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.DEBUG, default=logging.INFO)
+
+parser.add_argument('-q', '--quiet', help='Turn off most logging',
+                    action='store_const', dest='loglevel',
+                    const=logging.WARNING, default=logging.INFO)
+
+class ProcessedMirror:
+    ''' On-disk mirror of processed result files, shared by batch jobs on a host.
+
+        Files are keyed by process hash, or by run ID for older runs
+        without one. Least-recently used files are removed to stay under
+        max_bytes, so callers get hard links they can safely remove.
+    '''
+    def __init__(self, dirname, max_bytes=MIRROR_MAX_BYTES):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._total_bytes = sum(size for (_, _, size) in self._list_files())
+
+    def get_path(self, run):
+        ''' Return mirror path for a run's processed file.
+        '''
+        _, ext = splitext(urlparse(run.state.processed).path)
+        process_hash = run.state.process_hash
+
+        if process_hash:
+            return join(self.dirname, process_hash[:2], process_hash + ext)
+
+        return join(self.dirname, 'runs', '{}{}'.format(run.id, ext))
+
+    def fetch(self, run):
+        ''' Return path to mirrored processed file for a run, downloading if needed.
+        '''
+        path = self.get_path(run)
+
+        try:
+            # Mark recently-used, preserving modification time.
+            utime(path, (time(), stat(path).st_mtime))
+            return path
+        except OSError as e:
+            # Missing, or evicted by another process since last fetched.
+            if e.errno != errno.ENOENT:
+                raise
+
+        filename = download_processed_file(run.state.processed)
+        makedirs(dirname(path), exist_ok=True)
+        size = getsize(filename)
+
+        try:
+            rename(filename, path)
+        except OSError:
+            # Download may have landed on a different filesystem.
+            _copy_file(filename, path)
+            remove(filename)
+
+        with self._lock:
+            self._total_bytes += size
+
+        self.evict()
+        return path
+
+    def link_processed_file(self, run):
+        ''' Return path to a new link to the mirrored processed file for a run.
+
+            Caller may remove the returned file when done with it.
+        '''
+        for attempt in range(LINK_ATTEMPTS):
+            path = self.fetch(run)
+            _, ext = splitext(path)
+            handle, filename = mkstemp(prefix='processed-', suffix=ext)
+            close(handle)
+            remove(filename)
+
+            try:
+                _link_file(path, filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT or attempt == LINK_ATTEMPTS - 1:
+                    raise
+                # Evicted by another process since fetch(), so fetch again.
+                _L.debug('Fetching evicted {} again'.format(path))
+                continue
+
+            return filename
+
+    def evict(self):
+        ''' Remove least-recently used files until mirror fits in max_bytes.
+        '''
+        with self._lock:
+            if self._total_bytes <= self.max_bytes:
+                return
+
+            files = sorted(self._list_files())
+            self._total_bytes = sum(size for (_, _, size) in files)
+
+            for (_, path, size) in files:
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+                _L.debug('Evicting {} from mirror'.format(path))
+                try:
+                    remove(path)
+                except OSError:
+                    # Another process may have evicted it first.
+                    pass
+
+                self._total_bytes -= size
+
+    def _list_files(self):
+        ''' Return list of (access time, path, size) for files in the mirror.
+        '''
+        files, dirnames = list(), [self.dirname]
+
+        while dirnames:
+            if not exists(dirnames[0]):
+                dirnames.pop(0)
+                continue
+
+            for entry in scandir(dirnames.pop(0)):
+                if entry.is_dir():
+                    dirnames.append(entry.path)
+                else:
+                    info = entry.stat()
+                    files.append((info.st_atime, entry.path, info.st_size))
+
+        return files
+
+def _link_file(source, destination):
+    ''' Hard link source to destination, or copy it across filesystems.
+    '''
+    try:
+        link(source, destination)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            raise
+        # Mirror may be on a different filesystem.
+        _copy_file(source, destination)
+
+def _copy_file(source, destination):
+    ''' Copy a file beside destination, then rename it into place.
+
+        Readers of destination never see a partially-written file.
+    '''
+    handle, tmpname = mkstemp(prefix='copying-', dir=dirname(destination))
+    close(handle)
+
+    try:
+        copyfile(source, tmpname)
+        rename(tmpname, destination)
+    except:
+        remove(tmpname)
+        raise
+
+def sync_mirror(mirror, runs):
+    ''' Download processed files for a list of runs to mirror.
+    '''
+    def fetch(run):
+        try:
+            return mirror.fetch(run)
+        except Exception as e:
+            _L.error('Failed to mirror {}: {}'.format(run.state.processed, e))
+
+    runs = [run for run in runs if run.state and run.state.processed]
+
+    with ThreadPoolExecutor(SYNC_CONCURRENCY) as executor:
+        paths = list(executor.map(fetch, runs))
+
+    return [path for path in paths if path]
+
+@log_function_errors
+def main():
+    ''' Download processed files for the latest set to local mirror.
+    '''
+    args = parser.parse_args()
+    setup_logger(args.sns_arn, None, log_level=args.loglevel)
+    db_args = util.prepare_db_kwargs(args.database_url)
+
+    with db_connect(**db_args) as conn:
+        with db_cursor(conn) as db:
+            set = read_latest_set(db, args.owner, args.repository)
+            runs = read_completed_runs_to_date(db, set.id)
+
+    mirror = ProcessedMirror(args.mirror_dir)
+    paths = sync_mirror(mirror, runs)
+    _L.info('Mirrored {} processed files in {}'.format(len(paths), args.mirror_dir))
+
+if __name__ == '__main__':
+    exit(main())
@@ -88,7 +88,7 @@ class RunState:
 
     def __init__(self, json_blob):
         blob_dict = dict(json_blob or {})
-        self.keys = blob_dict.keys()
+        self.keys = list(blob_dict.keys())
 
         self.run_id = blob_dict.get('run id')
         self.source = blob_dict.get('source')
@@ -62,8 +62,13 @@ class Done:
 
 class Heartbeat:
 
-    def __init__(self, worker_id):
+    def __init__(self, worker_id, source_name=None, rows_processed=None, bytes_downloaded=None):
         self.worker_id = worker_id
+        self.source_name = source_name
+        self.rows_processed = rows_processed
+        self.bytes_downloaded = bytes_downloaded
 
     def asdata(self):
-        return dict(worker_id=self.worker_id)
+        return dict(worker_id=self.worker_id, source_name=self.source_name,
+                    rows_processed=self.rows_processed,
+                    bytes_downloaded=self.bytes_downloaded)
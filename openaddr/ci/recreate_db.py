@@ -25,11 +25,29 @@ def recreate(DATABASE_URL):
         pq = PQ(conn, table='queue')
         pq.create()
 
+def upgrade(DATABASE_URL):
+    ''' Apply upgrade.pgsql to an existing database, keeping its data.
+    '''
+    ci_upgrade_filename = join(dirname(__file__), 'upgrade.pgsql')
+
+    with connect(DATABASE_URL) as conn:
+        with conn.cursor() as db:
+            db.execute('SET client_min_messages TO WARNING')
+
+            with open(ci_upgrade_filename) as file:
+                db.execute(file.read())
+
 def main():
     '''
     '''
     DATABASE_URL = os.environ['DATABASE_URL']
     return recreate(DATABASE_URL)
 
+def upgrade_main():
+    '''
+    '''
+    DATABASE_URL = os.environ['DATABASE_URL']
+    return upgrade(DATABASE_URL)
+
 if __name__ == '__main__':
     exit(main())
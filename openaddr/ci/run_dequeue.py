@@ -2,12 +2,15 @@ import logging; _L = logging.getLogger('openaddr.ci.run_dequeue')
 
 from os import environ
 from time import sleep, time
+from datetime import timedelta
 from boto import connect_cloudwatch
 
 from . import (
     db_connect, db_queue, TASK_QUEUE, DONE_QUEUE, DUE_QUEUE, load_config,
     pop_task_from_donequeue, pop_task_from_duequeue, setup_logger,
-    HEARTBEAT_QUEUE, flush_heartbeat_queue, get_recent_workers
+    HEARTBEAT_QUEUE, flush_heartbeat_queue, get_recent_heartbeats,
+    db_listen, db_wait_for_notifies, drain_queue, QUEUE_POLL_INTERVAL,
+    DEQUEUE_BATCH_SIZE, GithubCache, DequeueBatch
     )
 
 def main():
@@ -16,6 +19,10 @@ def main():
     setup_logger(environ.get('AWS_SNS_ARN'), None)
     config = load_config()
     checkin_time = time()
+    conn = None
+
+    # Github responses are reused from one batch to the next.
+    batch = DequeueBatch(GithubCache())
     try:
         # Rely on boto environment.
         cw = connect_cloudwatch()
@@ -24,22 +31,29 @@ def main():
 
     while True:
         try:
-            with db_connect(config['DATABASE_URL']) as conn:
-                task_Q = db_queue(conn, TASK_QUEUE)
-                done_Q = db_queue(conn, DONE_QUEUE)
-                due_Q = db_queue(conn, DUE_QUEUE)
-                beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+            if conn is None:
+                conn = db_connect(config['DATABASE_URL'])
+                db_listen(conn, (DONE_QUEUE, DUE_QUEUE, HEARTBEAT_QUEUE))
+
+            task_Q = db_queue(conn, TASK_QUEUE)
+            done_Q = db_queue(conn, DONE_QUEUE)
+            due_Q = db_queue(conn, DUE_QUEUE)
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
 
-                pop_task_from_donequeue(done_Q, config['GITHUB_AUTH'])
-                pop_task_from_duequeue(due_Q, config['GITHUB_AUTH'])
-                flush_heartbeat_queue(beat_Q)
+            done_count = drain_queue(pop_task_from_donequeue, done_Q, config['GITHUB_AUTH'], batch=batch)
+            due_count = drain_queue(pop_task_from_duequeue, due_Q, config['GITHUB_AUTH'], batch=batch)
+            flush_heartbeat_queue(beat_Q)
 
-                if time() < checkin_time:
-                    continue
+            batch.post_updates(done_Q, config['GITHUB_AUTH'])
 
+            if time() >= checkin_time:
                 # Report basic information about current status.
                 with beat_Q as db:
-                    workers_n = len(get_recent_workers(db))
+                    heartbeats = get_recent_heartbeats(db)
+                    workers_n = len(heartbeats)
+
+                for beat in heartbeats:
+                    _L.debug('Worker {0.worker_id} on {0.source_name}: {0.rows_processed} rows processed, {0.bytes_downloaded} bytes downloaded'.format(beat))
 
                 task_n, done_n, due_n = map(len, (task_Q, done_Q, due_Q))
                 _L.info('{workers_n} active workers; queue lengths: {task_n} tasks, {done_n} done, {due_n} due'.format(**locals()))
@@ -54,10 +68,20 @@ def main():
 
                 checkin_time = time() + 30
 
+            # Go around again right away if there's more, otherwise wait.
+            if DEQUEUE_BATCH_SIZE in (done_count, due_count):
+                continue
+
+            wait = timedelta(seconds=max(0, checkin_time - time()))
+            db_wait_for_notifies(conn, min(wait, QUEUE_POLL_INTERVAL))
+
         except KeyboardInterrupt:
             raise
         except:
             _L.error('Error in dequeue main()', exc_info=True)
+            if conn is not None:
+                conn.close()
+            conn = None
             sleep(2)
 
 if __name__ == '__main__':
@@ -1,58 +1,129 @@
 import logging; _L = logging.getLogger('openaddr.ci.tileindex')
 
-from io import TextIOWrapper
-from operator import attrgetter
+from io import TextIOWrapper, StringIO
 from tempfile import mkstemp, mkdtemp
 from zipfile import ZipFile, ZIP_DEFLATED
-from itertools import groupby, zip_longest
+from collections import OrderedDict, defaultdict
+from itertools import islice
 from os.path import splitext, join, exists
-from os import close, environ, mkdir
+from os import close, environ, mkdir, remove
 from argparse import ArgumentParser
-from csv import DictReader, DictWriter
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj
+from csv import reader, writer
 from random import randint
-import gzip
+import gzip, json
 
 from . import db_connect, db_cursor, setup_logger, log_function_errors, collect
+from .mirror import ProcessedMirror
 from .objects import read_latest_set, read_completed_runs_to_date
 from .. import S3, iterate_local_processed_files, util
 from ..conform import OPENADDR_CSV_SCHEMA
 
 BLOCK_SIZE = 100000
+MAX_OPEN_TILES = 256
 SOURCE_COLNAME = 'OA:Source'
 TILE_SIZE = 1.
 
+# Most address rows in a tile before it is split into four quadrant subtiles.
+TILE_ROW_BUDGET = 500000
+
+# Deepest level of quadrant subtiles below a TILE_SIZE tile.
+MAX_TILE_DEPTH = 6
+
+# Number of tiles compressed and uploaded at once.
+PUBLISH_CONCURRENCY = 8
+
+# S3 key for index of published tiles and their subtiles.
+MANIFEST_KEYNAME = 'tiles/manifest.json'
+
 class Point:
+    ''' Address point with its CSV line in Tile column order, minus the source.
+    '''
+    __slots__ = ('key', 'result', 'line')
 
-    def __init__(self, lon, lat, result, row):
-        self.row = row
-        self.result = result
+    def __init__(self, lon, lat, result, line):
         self.key = lonlat_key(lon, lat)
+        self.result = result
+        self.line = line
 
 class Tile:
+    ''' Tile of addresses, keyed on its southwest lon, lat.
 
+        Quadrant subtiles share the key of their TILE_SIZE tile and add
+        one quadkey digit per level: 0 southwest, 1 southeast, 2 northwest,
+        and 3 northeast.
+    '''
     columns = OPENADDR_CSV_SCHEMA + [SOURCE_COLNAME]
 
-    def __init__(self, key, dirname):
+    def __init__(self, key, dirname, quadkey=''):
         self.key = key
         self.dirname = dirname
+        self.quadkey = quadkey
         self.results = set()
+        self.count = 0
 
         handle, self.filename = mkstemp(prefix='tile-', suffix='.csv.gz', dir=dirname)
         close(handle)
 
-        with gzip.open(self.filename, 'wt', encoding='utf8') as file:
-            rows = DictWriter(file, Tile.columns)
-            rows.writerow({k: k for k in Tile.columns})
+        with gzip.open(self.filename, 'wb') as file:
+            file.write(_csv_line(Tile.columns))
+
+    def open(self):
+        ''' Open tile file for adding points with write_points().
+        '''
+        return gzip.open(self.filename, 'ab')
 
     def add_points(self, points):
-        with gzip.open(self.filename, 'at', encoding='utf8') as file:
-            rows = DictWriter(file, Tile.columns)
-            for point in points:
+        with self.open() as file:
+            self.write_points(file, points)
+
+    def write_points(self, file, points):
+        ''' Write CSV lines of points with source column appended.
+        '''
+        suffixes, lines = dict(), list()
+
+        for point in points:
+            if point.result not in suffixes:
                 self.results.add(point.result)
+                source_line = _csv_line([point.result.source_base])
+                suffixes[point.result] = b',' + source_line
 
-                row = {SOURCE_COLNAME: point.result.source_base}
-                row.update(point.row)
-                rows.writerow(row)
+            lines.append(point.line + suffixes[point.result])
+
+        file.write(b''.join(lines))
+        self.count += len(lines)
+
+    def split(self):
+        ''' Return four quadrant subtiles with this tile's points divided among them.
+        '''
+        tiles = [Tile(self.key, self.dirname, self.quadkey + str(q)) for q in range(4)]
+        results = {result.source_base: result for result in self.results}
+        lon_index, lat_index = Tile.columns.index('LON'), Tile.columns.index('LAT')
+        depth = len(self.quadkey) + 1
+        files = [tile.open() for tile in tiles]
+
+        try:
+            with gzip.open(self.filename, 'rb') as file:
+                lines = _LineRecorder(TextIOWrapper(file, 'utf8', newline=''))
+                rows = reader(lines)
+                next(rows, None)
+                lines.pop()
+
+                for row in rows:
+                    line = lines.pop()
+                    quadkey = point_quadkey(float(row[lon_index]), float(row[lat_index]), depth)
+                    quadrant = int(quadkey[-1])
+                    files[quadrant].write(line.encode('utf8'))
+
+                    tile = tiles[quadrant]
+                    tile.results.add(results[row[-1]])
+                    tile.count += 1
+        finally:
+            for file in files:
+                file.close()
+
+        return tiles
 
     def publish(self, s3_bucket):
         '''
@@ -62,14 +133,22 @@ class Tile:
 
         zipfile = ZipFile(zip_filename, 'w', ZIP_DEFLATED, allowZip64=True)
 
-        with gzip.open(self.filename, 'rb') as file:
-            zipfile.writestr('addresses.csv', file.read())
+        handle, csv_filename = mkstemp(prefix='tile-', suffix='.csv', dir=self.dirname)
+        close(handle)
+
+        try:
+            with gzip.open(self.filename, 'rb') as file, open(csv_filename, 'wb') as output:
+                copyfileobj(file, output)
+
+            zipfile.write(csv_filename, 'addresses.csv')
+        finally:
+            remove(csv_filename)
 
         license_text = util.summarize_result_licenses(self.results)
         zipfile.writestr('LICENSE.txt', license_text.encode('utf8'))
 
         zipfile.close()
-        keyname = 'tiles/{:.1f}/{:.1f}.zip'.format(*self.key)
+        keyname = tile_keyname(self.key, self.quadkey)
 
         collect.write_to_s3(s3_bucket, zipfile.filename, keyname)
 
@@ -87,6 +166,9 @@ parser.add_argument('-b', '--bucket', default=environ.get('AWS_S3_BUCKET', None)
 parser.add_argument('-d', '--database-url', default=environ.get('DATABASE_URL', None),
                     help='Optional connection string for database. Defaults to value of DATABASE_URL environment variable.')
 
+parser.add_argument('--mirror-dir', default=environ.get('PROCESSED_MIRROR_DIR', None),
+                    help='Optional local mirror directory for processed files. Defaults to value of PROCESSED_MIRROR_DIR environment variable.')
+
 parser.add_argument('--sns-arn', default=environ.get('AWS_SNS_ARN', None),
                     help='Optional AWS Simple Notification Service (SNS) resource. Defaults to value of AWS_SNS_ARN environment variable.')
 
@@ -114,23 +196,112 @@ def main():
 
     dir = mkdtemp(prefix='tileindex-')
 
-    addresses = iterate_runs_points(runs)
+    mirror = args.mirror_dir and ProcessedMirror(args.mirror_dir)
+    addresses = iterate_runs_points(runs, mirror)
     point_blocks = iterate_point_blocks(addresses)
-    tiles = populate_tiles(dir, point_blocks)
+    tiles = split_tiles(populate_tiles(dir, point_blocks).values())
 
-    for tile in tiles.values():
-        _L.debug('Publishing tile {} with {} sources'.format(tile.key, len(tile.results)))
-        tile.publish(s3.bucket)
+    publish_tiles(s3.bucket, tiles)
+    publish_manifest(s3.bucket, tiles)
 
 def lonlat_key(lon, lat):
     '''
     '''
     return int(lon // TILE_SIZE), int(lat // TILE_SIZE) # Southwest corner lon, lat
 
-def iterate_runs_points(runs):
+def point_quadkey(lon, lat, depth):
+    ''' Return quadkey of subtile at depth containing a point.
+    '''
+    (x, y), size, digits = lonlat_key(lon, lat), TILE_SIZE, list()
+    west, south = x * TILE_SIZE, y * TILE_SIZE
+
+    for _ in range(depth):
+        size /= 2
+        east, north = int(lon >= west + size), int(lat >= south + size)
+        west, south = west + east * size, south + north * size
+        digits.append(str(east + 2 * north))
+
+    return ''.join(digits)
+
+def tile_keyname(key, quadkey):
+    ''' Return S3 key name for a tile or one of its quadrant subtiles.
+    '''
+    if not quadkey:
+        return 'tiles/{:.1f}/{:.1f}.zip'.format(*key)
+
+    return 'tiles/{:.1f}/{:.1f}/{}.zip'.format(key[0], key[1], quadkey)
+
+def find_tile_keyname(lon, lat, manifest):
+    ''' Return S3 key name for the smallest published tile containing a point.
+
+        Manifest is a dictionary from make_tile_manifest(). Tiles missing
+        from it are assumed to have no subtiles.
+    '''
+    key = lonlat_key(lon, lat)
+    quadkeys = manifest.get('{},{}'.format(*key), [''])
+    point_key = point_quadkey(lon, lat, MAX_TILE_DEPTH)
+
+    quadkey = max([q for q in quadkeys if point_key.startswith(q)] or [''], key=len)
+    return tile_keyname(key, quadkey)
+
+def split_tiles(tiles):
+    ''' Return list of tiles and subtiles, splitting any over TILE_ROW_BUDGET.
+
+        Parent tiles are kept so that each level of the pyramid is complete,
+        while empty subtiles are dropped.
+    '''
+    tiles, all_tiles = list(tiles), list()
+
+    while tiles:
+        tile = tiles.pop(0)
+        all_tiles.append(tile)
+
+        if tile.count <= TILE_ROW_BUDGET or len(tile.quadkey) >= MAX_TILE_DEPTH:
+            continue
+
+        _L.debug('Splitting tile {} {} with {} rows'.format(tile.key, tile.quadkey, tile.count))
+
+        for subtile in tile.split():
+            if subtile.count:
+                tiles.append(subtile)
+            else:
+                remove(subtile.filename)
+
+    return all_tiles
+
+def publish_tiles(s3_bucket, tiles):
+    ''' Publish tiles to S3, PUBLISH_CONCURRENCY at a time.
+    '''
+    def publish(tile):
+        _L.debug('Publishing tile {} {} with {} sources'.format(tile.key, tile.quadkey, len(tile.results)))
+        tile.publish(s3_bucket)
+
+    with ThreadPoolExecutor(PUBLISH_CONCURRENCY) as executor:
+        for _ in executor.map(publish, tiles):
+            # Raise any publishing errors.
+            pass
+
+def make_tile_manifest(tiles):
+    ''' Return dictionary of sorted quadkey lists keyed on "lon,lat" strings.
+    '''
+    manifest = defaultdict(list)
+
+    for tile in tiles:
+        manifest['{},{}'.format(*tile.key)].append(tile.quadkey)
+
+    return {key: sorted(quadkeys) for (key, quadkeys) in manifest.items()}
+
+def publish_manifest(s3_bucket, tiles):
+    '''
+    '''
+    manifest_key = s3_bucket.new_key(MANIFEST_KEYNAME)
+    manifest_key.set_contents_from_string(json.dumps(make_tile_manifest(tiles)),
+        headers={'Content-Type': 'application/json'})
+
+def iterate_runs_points(runs, mirror=None):
     ''' Iterate over all the points, skipping share-alike sources.
     '''
-    for result in iterate_local_processed_files(runs, sort_on='source_path'):
+    for result in iterate_local_processed_files(runs, sort_on='source_path', mirror=mirror):
         if result.run_state.share_alike == 'true':
             continue
 
@@ -148,49 +319,115 @@ def iterate_runs_points(runs):
                 break
 
             zipped_file = result_zip.open(csv_infos[0].filename)
-            point_rows = DictReader(TextIOWrapper(zipped_file))
+            lines = _LineRecorder(TextIOWrapper(zipped_file, 'utf8'))
+            point_rows = reader(lines)
+            header = next(point_rows, [])
+            lines.pop()
+
+            if 'LON' not in header or 'LAT' not in header:
+                continue
+
+            # Lines in the schema column order can be used unchanged.
+            lon_index, lat_index = header.index('LON'), header.index('LAT')
+            reorder = (header != OPENADDR_CSV_SCHEMA)
 
             for row in point_rows:
+                line = lines.pop()
+
                 try:
-                    lat, lon = float(row['LAT']), float(row['LON'])
-                except ValueError:
+                    lat, lon = float(row[lat_index]), float(row[lon_index])
+                except (ValueError, IndexError):
                     # Skip this point if the lat/lon don't parse
                     continue
 
                 # Include this point if it's on Earth
                 if -180 <= lon <= 180 and -90 <= lat <= 90:
-                    yield Point(lon, lat, result, row)
+                    if reorder:
+                        values = dict(zip(header, row))
+                        line_bytes = _csv_line([values.get(col) for col in OPENADDR_CSV_SCHEMA])
+                    else:
+                        line_bytes = line.encode('utf8')
+
+                    yield Point(lon, lat, result, line_bytes.rstrip(b'\r\n'))
+
+class _LineRecorder:
+    ''' Iterator over lines of a file that remembers lines used for a CSV row.
+    '''
+    def __init__(self, file):
+        self.file = file
+        self.lines = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.file)
+        self.lines.append(line)
+        return line
+
+    def pop(self):
+        ''' Return and forget lines read since the last call.
+        '''
+        line, self.lines = ''.join(self.lines), []
+        return line
+
+def _csv_line(values):
+    ''' Return a single line of CSV as bytes.
+    '''
+    buffer = StringIO()
+    writer(buffer, dialect='excel').writerow(values)
+    return buffer.getvalue().encode('utf8')
 
 def iterate_point_blocks(points):
     ''' Group points into blocks by key, generate (key, points) pairs.
+
+        Points are partitioned by key within each block of BLOCK_SIZE.
     '''
-    args, filler = [points] * BLOCK_SIZE, Point(0, -99, None, None) # Illegal lon, lat
+    while True:
+        groups = defaultdict(list)
 
-    for block in zip_longest(*args, fillvalue=filler):
-        point_block = sorted(block, key=attrgetter('key'))
+        for point in islice(points, BLOCK_SIZE):
+            groups[point.key].append(point)
 
-        for key, key_points in groupby(point_block, attrgetter('key')):
-            if key is not filler.key:
-                key_points_list = list(key_points)
-                _L.debug('Found {} points in tile {}'.format(len(key_points_list), key))
-                yield (key, key_points_list)
+        if not groups:
+            break
 
-    _L.debug('{} remain'.format(len(list(points))))
+        for key in sorted(groups.keys()):
+            _L.debug('Found {} points in tile {}'.format(len(groups[key]), key))
+            yield (key, groups[key])
 
 def populate_tiles(dirname, point_blocks):
     ''' Return a dictionary of Tiles keyed on southwest lon, lat.
-    '''
-    tiles = dict()
 
-    for (key, points) in point_blocks:
-        if key not in tiles:
-            tile_dirname = join(dirname, str(randint(100, 999)))
-            if not exists(tile_dirname):
-                mkdir(tile_dirname)
-            _L.debug('Adding Tile: {}'.format(key))
-            tiles[key] = Tile(key, tile_dirname)
-
-        tiles[key].add_points(points)
+        Keeps up to MAX_OPEN_TILES tile files open between blocks of points,
+        closing the least-recently used, so each tile is mostly written in
+        a single compressed stream.
+    '''
+    tiles, open_files = dict(), OrderedDict()
+
+    try:
+        for (key, points) in point_blocks:
+            if key not in tiles:
+                tile_dirname = join(dirname, str(randint(100, 999)))
+                if not exists(tile_dirname):
+                    mkdir(tile_dirname)
+                _L.debug('Adding Tile: {}'.format(key))
+                tiles[key] = Tile(key, tile_dirname)
+
+            if key in open_files:
+                open_files.move_to_end(key)
+            else:
+                while len(open_files) >= MAX_OPEN_TILES:
+                    _, file = open_files.popitem(last=False)
+                    file.close()
+
+                open_files[key] = tiles[key].open()
+
+            tiles[key].write_points(open_files[key], points)
+
+    finally:
+        for file in open_files.values():
+            file.close()
 
     return tiles
 
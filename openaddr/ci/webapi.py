@@ -3,10 +3,12 @@ import logging; _L = logging.getLogger('openaddr.ci.webapi')
 from urllib.parse import urljoin
 from operator import attrgetter
 from collections import defaultdict
+from time import time
 import json, os, csv, io
 
 from flask import Response, Blueprint, request, current_app, jsonify, url_for, redirect
 from flask_cors import CORS
+import requests
 
 from .objects import (
     load_collection_zips_dict, read_latest_set, read_completed_runs_to_date_cheaply,
@@ -21,6 +23,15 @@ CSV_HEADER = 'source', 'cache', 'sample', 'geometry type', 'address count', \
              'process hash', 'output', 'attribution required', 'attribution name', \
              'share-alike', 'code version'
 
+# Seconds to reuse a downloaded tile index manifest.
+TILE_MANIFEST_TTL = 300
+
+# Seconds to wait for a tile index manifest download.
+TILE_MANIFEST_TIMEOUT = 5
+
+# Tile index manifests by bucket, with expiration times.
+_tile_manifests = dict()
+
 webapi = Blueprint('webapi', __name__)
 CORS(webapi)
 
@@ -186,9 +197,33 @@ def app_get_tileindex_zip(lon, lat):
         return Response('"{}" and "{}" must both be on earth.\n'.format(lon, lat), status=404)
 
     bucket = current_app.config['AWS_S3_BUCKET']
-    url = u'https://s3.amazonaws.com/{}/tiles/{:.1f}/{:.1f}.zip'.format(bucket, *key)
+    manifest = get_tile_manifest(bucket)
+    keyname = tileindex.find_tile_keyname(float(lon), float(lat), manifest)
+    url = u'https://s3.amazonaws.com/{}/{}'.format(bucket, keyname)
     return redirect(nice_domain(url), 302)
 
+def get_tile_manifest(bucket):
+    ''' Return recently-downloaded tile index manifest, or an empty one on failure.
+    '''
+    expires, manifest = _tile_manifests.get(bucket, (0, None))
+
+    if time() < expires:
+        return manifest
+
+    url = u'https://s3.amazonaws.com/{}/{}'.format(bucket, tileindex.MANIFEST_KEYNAME)
+
+    try:
+        resp = requests.get(nice_domain(url), timeout=TILE_MANIFEST_TIMEOUT)
+        resp.raise_for_status()
+        manifest = resp.json()
+    except (requests.RequestException, ValueError) as e:
+        # Fall back to whole tiles until the manifest can be read.
+        _L.warning('Failed to read tile manifest {}: {}'.format(url, e))
+        manifest = dict()
+
+    _tile_manifests[bucket] = time() + TILE_MANIFEST_TTL, manifest
+    return manifest
+
 def apply_webapi_blueprint(app):
     '''
     '''
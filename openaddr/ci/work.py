@@ -4,14 +4,25 @@ from .. import util
 from ..jobs import JOB_TIMEOUT
 from .objects import RunState
 
-import os, json, tempfile, shutil, base64, subprocess
+import os, io, json, tempfile, shutil, base64, subprocess, hashlib, mimetypes
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urljoin
 
 MAGIC_OK_MESSAGE = 'Everything is fine'
 
+# Files larger than this are uploaded to S3 in parts of MULTIPART_CHUNK_SIZE.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Number of run artifacts to upload to S3 at once.
+UPLOAD_CONCURRENCY = 4
+
 def upload_file(s3, keyname, filename):
     ''' Create a new S3 key with filename contents, return its URL and MD5 hash.
     '''
+    if os.path.exists(filename) and os.path.getsize(filename) > MULTIPART_THRESHOLD:
+        return _upload_file_multipart(s3, keyname, filename)
+
     key = s3.new_key(keyname)
 
     key.set_contents_from_filename(filename)
@@ -19,63 +30,153 @@ def upload_file(s3, keyname, filename):
 
     return url, key.md5.decode('ascii')
 
+def _upload_file_multipart(s3, keyname, filename):
+    ''' Upload a large file to S3 in parts, return its URL and MD5 hash.
+
+        Multipart ETags are not content hashes, so MD5 is computed locally.
+    '''
+    content_type, _ = mimetypes.guess_type(filename)
+    headers = {'Content-Type': content_type or 'application/octet-stream'}
+    upload = s3.bucket.initiate_multipart_upload(keyname, headers=headers)
+    md5 = hashlib.md5()
+
+    try:
+        with open(filename, 'rb') as file:
+            chunks = iter(lambda: file.read(MULTIPART_CHUNK_SIZE), b'')
+            for (part_num, chunk) in enumerate(chunks, 1):
+                md5.update(chunk)
+                upload.upload_part_from_file(io.BytesIO(chunk), part_num=part_num)
+
+        upload.complete_upload()
+    except:
+        upload.cancel_upload()
+        raise
+
+    url = util.s3_key_url(s3.new_key(keyname))
+
+    return url, md5.hexdigest()
+
 def make_source_filename(source_name):
     '''
     '''
     return source_name.replace(u'/', u'--') + '.txt'
 
+class WorkProgress:
+    ''' Measure progress of a running job from files in its output directory.
+
+        Downloads land in http or esri directories under a cache step directory,
+        and converted rows in CSV files under a conform step directory.
+    '''
+    def __init__(self, source_name, output_dir):
+        self.source_name = source_name
+        self.output_dir = output_dir
+        self.rows_processed = 0
+        self.bytes_downloaded = 0
+
+        # Byte offset and newline count for each CSV file seen so far.
+        self._csv_counts = dict()
+
+    def update(self):
+        ''' Walk output directory to count downloaded bytes and converted rows.
+        '''
+        bytes_downloaded, rows_processed = 0, 0
+
+        for (dirpath, _, filenames) in os.walk(self.output_dir):
+            dirnames = os.path.relpath(dirpath, self.output_dir).split(os.sep)
+
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+
+                try:
+                    if 'http' in dirnames or 'esri' in dirnames:
+                        bytes_downloaded += os.path.getsize(path)
+                    elif filename.endswith('.csv') and \
+                        any(d.startswith('conform-') for d in dirnames):
+                        rows_processed += max(0, self._count_lines(path) - 1)
+                except OSError:
+                    # Job may have cleaned up the file.
+                    continue
+
+        self.bytes_downloaded = max(self.bytes_downloaded, bytes_downloaded)
+        self.rows_processed = max(self.rows_processed, rows_processed)
+
+    def _count_lines(self, path):
+        ''' Count newlines in a growing file, reading only new bytes.
+        '''
+        offset, count = self._csv_counts.get(path, (0, 0))
+
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                offset, count = offset + len(chunk), count + chunk.count(b'\n')
+
+        self._csv_counts[path] = offset, count
+        return count
+
 def assemble_runstate(s3, input, source_name, run_id, index_dirname):
     ''' Convert worker index dictionary to RunState.
+
+        Artifacts are uploaded concurrently, while processed data is packaged.
     '''
     output = {k: v for (k, v) in input.items()}
     output['run id'] = run_id
+    uploads, archive_path = dict(), None
 
-    if input['cache']:
-        # e.g. /runs/0/cache.zip
-        cache_path = os.path.join(index_dirname, input['cache'])
-        key_name = '/runs/{run}/{cache}'.format(run=run_id, **input)
-        url, fingerprint = upload_file(s3, key_name, cache_path)
-        output['cache'], output['fingerprint'] = url, fingerprint
-
-    if input['sample']:
-        # e.g. /runs/0/sample.json
-        sample_path = os.path.join(index_dirname, input['sample'])
-        key_name = '/runs/{run}/{sample}'.format(run=run_id, **input)
-        url, _ = upload_file(s3, key_name, sample_path)
-        output['sample'] = url
-
-    if input['processed']:
-        # e.g. /runs/0/fr/paris.zip
-        processed_path = os.path.join(index_dirname, input['processed'])
-        package_args = input.get('website') or 'Unknown', input.get('license') or 'Unknown'
-        archive_path = util.package_output(source_name, processed_path, *package_args)
-        key_name = u'/runs/{run}/{name}.zip'.format(run=run_id, name=source_name)
-        url, hash = upload_file(s3, key_name, archive_path)
-        output['processed'], output['process hash'] = url, hash
-
-        if os.path.exists(archive_path):
-            os.remove(archive_path)
+    try:
+        with ThreadPoolExecutor(UPLOAD_CONCURRENCY) as executor:
+            def upload(name, key_name, path):
+                uploads[name] = executor.submit(upload_file, s3, key_name, path)
+
+            if input['cache']:
+                # e.g. /runs/0/cache.zip
+                cache_path = os.path.join(index_dirname, input['cache'])
+                key_name = '/runs/{run}/{cache}'.format(run=run_id, **input)
+                upload('cache', key_name, cache_path)
+
+            if input['sample']:
+                # e.g. /runs/0/sample.json
+                sample_path = os.path.join(index_dirname, input['sample'])
+                key_name = '/runs/{run}/{sample}'.format(run=run_id, **input)
+                upload('sample', key_name, sample_path)
+
+            if input['output']:
+                # e.g. /runs/0/output.txt
+                output_path = os.path.join(index_dirname, input['output'])
+                key_name = '/runs/{run}/{output}'.format(run=run_id, **input)
+                upload('output', key_name, output_path)
+
+            if input['preview']:
+                # e.g. /runs/0/preview.png
+                preview_path = os.path.join(index_dirname, input['preview'])
+                key_name = '/runs/{run}/{preview}'.format(run=run_id, **input)
+                upload('preview', key_name, preview_path)
+
+            if input['slippymap']:
+                # e.g. /runs/0/slippymap.mbtiles
+                slippymap_path = os.path.join(index_dirname, input['slippymap'])
+                key_name = '/runs/{run}/{slippymap}'.format(run=run_id, **input)
+                upload('slippymap', key_name, slippymap_path)
+
+            if input['processed']:
+                # e.g. /runs/0/fr/paris.zip
+                processed_path = os.path.join(index_dirname, input['processed'])
+                package_args = input.get('website') or 'Unknown', input.get('license') or 'Unknown'
+                archive_path = util.package_output(source_name, processed_path, *package_args)
+                key_name = u'/runs/{run}/{name}.zip'.format(run=run_id, name=source_name)
+                upload('processed', key_name, archive_path)
+
+        for (name, future) in uploads.items():
+            url, hash = future.result()
+            output[name] = url
+
+            if name == 'cache':
+                output['fingerprint'] = hash
+            elif name == 'processed':
+                output['process hash'] = hash
 
-    if input['output']:
-        # e.g. /runs/0/output.txt
-        output_path = os.path.join(index_dirname, input['output'])
-        key_name = '/runs/{run}/{output}'.format(run=run_id, **input)
-        url, _ = upload_file(s3, key_name, output_path)
-        output['output'] = url
-
-    if input['preview']:
-        # e.g. /runs/0/preview.png
-        preview_path = os.path.join(index_dirname, input['preview'])
-        key_name = '/runs/{run}/{preview}'.format(run=run_id, **input)
-        url, _ = upload_file(s3, key_name, preview_path)
-        output['preview'] = url
-
-    if input['slippymap']:
-        # e.g. /runs/0/slippymap.mbtiles
-        slippymap_path = os.path.join(index_dirname, input['slippymap'])
-        key_name = '/runs/{run}/{slippymap}'.format(run=run_id, **input)
-        url, _ = upload_file(s3, key_name, slippymap_path)
-        output['slippymap'] = url
+    finally:
+        if archive_path and os.path.exists(archive_path):
+            os.remove(archive_path)
 
     return RunState(output)
 
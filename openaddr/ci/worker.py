@@ -16,7 +16,7 @@ import time, os, tempfile, shutil
 from . import (
     db_connect, db_queue, db_queue, pop_task_from_taskqueue,
     DONE_QUEUE, TASK_QUEUE, DUE_QUEUE, setup_logger, HEARTBEAT_QUEUE,
-    log_function_errors
+    log_function_errors, db_listen, db_wait_for_notifies, QUEUE_POLL_INTERVAL
     )
 
 parser = ArgumentParser(description='Run some source files.')
@@ -48,23 +48,33 @@ def main():
     args = parser.parse_args()
     setup_logger(args.sns_arn, None, log_level=args.loglevel)
     s3 = S3(None, None, args.bucket)
+    connection = None
 
     # Fetch and run jobs in a loop
     while True:
         worker_dir = tempfile.mkdtemp(prefix='worker-')
 
         try:
-            connection = db_connect(args.database_url)
+            if connection is None:
+                connection = db_connect(args.database_url)
+                db_listen(connection, (TASK_QUEUE, ))
+
             with connection as conn:
                 task_Q = db_queue(conn, TASK_QUEUE)
                 done_Q = db_queue(conn, DONE_QUEUE)
                 due_Q = db_queue(conn, DUE_QUEUE)
                 beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
-                pop_task_from_taskqueue(s3, task_Q, done_Q, due_Q, beat_Q,
-                                        worker_dir, args.mapbox_key)
-            connection.close()
+                got_task = pop_task_from_taskqueue(s3, task_Q, done_Q, due_Q, beat_Q,
+                                                   worker_dir, args.mapbox_key, block=False)
+
+            if not got_task:
+                # Sleep until a new task is announced, or check again later.
+                db_wait_for_notifies(connection, QUEUE_POLL_INTERVAL)
         except:
             _L.error('Error in worker main()', exc_info=True)
+            if connection is not None:
+                connection.close()
+            connection = None
             time.sleep(2)
         finally:
             shutil.rmtree(worker_dir)
@@ -5,12 +5,16 @@ from sys import stderr
 from datetime import date
 from zipfile import ZipFile
 from itertools import product
-from os.path import splitext, basename
+from os.path import splitext, basename, relpath, join, exists
 from argparse import ArgumentParser
 from urllib.parse import urlparse, parse_qsl, urljoin
 from tempfile import mkstemp, gettempdir
-from os import environ, close, remove
-from shutil import copyfile
+from os import environ, close, remove, rename, makedirs
+from math import log, tan, cos, radians, pi
+from shutil import move
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from queue import Queue
 from time import sleep
 from io import TextIOWrapper
 import json, subprocess, csv, sqlite3
@@ -20,10 +24,103 @@ import requests, boto3
 
 from .ci import db_connect, db_cursor, setup_logger
 from .ci.objects import read_latest_set, read_completed_runs_to_date
+from .ci.mirror import ProcessedMirror
+from .slippymap import iterate_feature_points, WRITE_BATCH_SIZE
 from . import iterate_local_processed_files
 
 MAPBOX_API_BASE = 'https://api.mapbox.com/uploads/v1/'
 
+# Center and bounds of each world quadrant tileset.
+QUADRANTS = {
+    'northwest': ('-122.2707,37.8044,13', '-180,0,0,85.05'), # Oakland
+    'northeast': ('139.7731,35.6793,13', '0,0,180,85.05'),   # Tokyo
+    'southeast': ('151.2073,-33.8686,13', '0,-85.05,180,0'), # Sydney
+    'southwest': ('-56.1975,-34.9057,13', '-180,-85.05,0,0'), # Montevideo
+    }
+
+# Highest zoom level of dotmap tiles.
+BASE_ZOOM = 15
+
+# Zoom level of regions used to track sources for incremental updates.
+REGION_ZOOM = 8
+
+# Fraction of region width of neighboring points to include when rebuilding a
+# region, so edge tiles get the same buffer they would in a full build. This
+# is wider than Tippecanoe's default 5 pixel buffer at REGION_ZOOM.
+REGION_BUFFER = 1/16
+
+# Fraction of world width around the 0° meridian and equator where points also
+# go to neighboring quadrants, so tiles at quadrant edges get the same buffer
+# they would in a whole-world tileset. This is Tippecanoe's default 5 pixel
+# buffer at zoom 1, the lowest zoom with tile edges on quadrant edges.
+QUADRANT_BUFFER = 5/256 / 2
+
+# Northern and southern limit of web mercator tiles.
+MAX_LATITUDE = 85.0511
+
+# Batches of feature lines to hold for each Tippecanoe process before blocking.
+PIPE_QUEUE_SIZE = 8
+
+class PipeWriter:
+    ''' Feed batches to a subprocess stdin from a thread with a bounded queue.
+
+        A slow process only blocks callers once its queue is full. Errors
+        writing to the process, e.g. when it exits early, are raised from
+        the next call to write() or close().
+    '''
+    def __init__(self, process, name):
+        self.process = process
+        self.name = name
+        self._queue = Queue(PIPE_QUEUE_SIZE)
+        self._error = None
+        self._aborted = False
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+
+            if batch is None:
+                break
+            elif self._error is not None or self._aborted:
+                # Keep draining the queue so writers never block.
+                continue
+
+            try:
+                self.process.stdin.write(batch)
+            except Exception as e:
+                self._error = e
+
+        try:
+            self.process.stdin.close()
+        except Exception as e:
+            self._error = self._error or e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('Failed writing to {}: {}'.format(self.name, self._error)) from self._error
+
+    def write(self, batch):
+        self._raise_error()
+        self._queue.put(batch)
+
+    def close(self):
+        ''' Finish writing queued batches, close stdin, and raise any errors.
+        '''
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def abort(self):
+        ''' Drop queued batches, close stdin, and wait for the thread to exit.
+
+            Used after the process has been killed, so errors are ignored.
+        '''
+        self._aborted = True
+        self._queue.put(None)
+        self._thread.join()
+
 def connect_db(dsn):
     ''' Prepare old-style arguments to connect_db().
     '''
@@ -42,7 +139,7 @@ def connect_db(dsn):
 def call_tippecanoe(mbtiles_filename, include_properties=True):
     '''
     '''
-    base_zoom = 15
+    base_zoom = BASE_ZOOM
 
     cmd = (
         'tippecanoe',
@@ -67,7 +164,7 @@ def call_tippecanoe(mbtiles_filename, include_properties=True):
 
     _L.info('Running tippcanoe: {}'.format(' '.join(full_cmd)))
 
-    return subprocess.Popen(full_cmd, stdin=subprocess.PIPE, bufsize=1)
+    return subprocess.Popen(full_cmd, stdin=subprocess.PIPE, bufsize=0)
 
 def join_tilesets(out_filename, in1_filename, in2_filename):
     '''
@@ -82,55 +179,76 @@ def join_tilesets(out_filename, in1_filename, in2_filename):
     if proc.returncode != 0:
         raise RuntimeError('Tile-join command returned {}'.format(proc.returncode))
 
-def split_tilesets(name_prefix, all_hi, all_lo, nw_hi, nw_lo, nw_out, ne_hi, ne_lo, ne_out, se_hi, se_lo, se_out, sw_hi, sw_lo, sw_out):
+def point_quadrant(lon, lat):
+    ''' Return name of the world quadrant tileset for a point.
+    '''
+    return ('north' if lat >= 0 else 'south') + ('east' if lon >= 0 else 'west')
+
+def point_quadrants(lon, lat, buffer=QUADRANT_BUFFER):
+    ''' Return set of world quadrant tilesets within buffer world widths of a point.
     '''
+    x, y = _lonlat_region_position(lon, lat)
+    x, y = x / 2**REGION_ZOOM - .5, y / 2**REGION_ZOOM - .5
+
+    norths = {'north', 'south'} if abs(y) < buffer else {'north' if lat >= 0 else 'south'}
+    easts = {'east', 'west'} if abs(x) < buffer else {'east' if lon >= 0 else 'west'}
+
+    return {north + east for (north, east) in product(norths, easts)}
+
+def iterate_quadrant_batches(points, size=WRITE_BATCH_SIZE):
+    ''' Generate (quadrant, batch) pairs of UTF-8 encoded feature lines.
+
+        Points are (lon, lat, line) tuples from stream_all_feature_points().
+        Points near quadrant edges are in batches for each nearby quadrant.
+    '''
+    batches = {quadrant: list() for quadrant in QUADRANTS}
+    lengths = {quadrant: 0 for quadrant in QUADRANTS}
+
+    for (lon, lat, line) in points:
+        for quadrant in sorted(point_quadrants(lon, lat)):
+            batches[quadrant].append(line)
+            lengths[quadrant] += len(line)
+
+            if lengths[quadrant] >= size:
+                yield quadrant, ''.join(batches[quadrant]).encode('utf8')
+                batches[quadrant], lengths[quadrant] = list(), 0
+
+    for (quadrant, batch) in batches.items():
+        if batch:
+            yield quadrant, ''.join(batch).encode('utf8')
+
+def finish_quadrant_tileset(name_prefix, quadrant, quad_hi, quad_lo, quad_out):
+    ''' Join high- and low-zoom tilesets for a quadrant and update its metadata.
+    '''
+    _L.info('Preparing {} quadrant...'.format(quadrant))
+    join_tilesets(quad_out, quad_hi, quad_lo)
+    remove(quad_hi)
+    remove(quad_lo)
+
+    _crop_quadrant_tiles(quad_out, quadrant)
+    _update_quadrant_metadata(quad_out, name_prefix, quadrant)
+    return quad_out
+
+def _crop_quadrant_tiles(mbtiles_filename, quadrant):
+    ''' Delete tiles outside a quadrant, drawn from neighboring quadrants' buffer points.
     '''
-    quadrants = [
-        ('northwest', nw_hi, nw_lo, nw_out, '-122.2707,37.8044,13'), # Oakland
-        ('northeast', ne_hi, ne_lo, ne_out, '139.7731,35.6793,13'),  # Tokyo
-        ('southeast', se_hi, se_lo, se_out, '151.2073,-33.8686,13'), # Sydney
-        ('southwest', sw_hi, sw_lo, sw_out, '-56.1975,-34.9057,13'), # Montevideo
-        ]
-
-    zooms_cutoffs = [(zoom + 1, 2**zoom) for zoom in range(15)]
-
-    for (quadrant, quad_hi, quad_lo, quad_out, center) in quadrants:
-        _L.info('Preparing {} quadrant...'.format(quadrant))
-        copyfile(all_hi, quad_hi)
-        copyfile(all_lo, quad_lo)
-
-        for filename in (quad_hi, quad_lo):
-            with sqlite3.connect(filename) as db:
-                for (zoom, cutoff) in zooms_cutoffs:
-                    if 'north' in quadrant:
-                        db.execute('delete from tiles where zoom_level = ? and tile_row < ?', (zoom, cutoff))
-                    if 'south' in quadrant:
-                        db.execute('delete from tiles where zoom_level = ? and tile_row >= ?', (zoom, cutoff))
-                    if 'east' in quadrant:
-                        db.execute('delete from tiles where zoom_level = ? and tile_column < ?', (zoom, cutoff))
-                    if 'west' in quadrant:
-                        db.execute('delete from tiles where zoom_level = ? and tile_column >= ?', (zoom, cutoff))
-
-        join_tilesets(quad_out, quad_hi, quad_lo)
-        remove(quad_hi)
-        remove(quad_lo)
-
-        with sqlite3.connect(quad_out) as db:
-            tileset_name = '{} {}'.format(name_prefix.capitalize(), quadrant.capitalize()).lstrip()
-            db.execute("update metadata set value = ? where name = 'center'", (center, ))
-            db.execute("update metadata set value = ? where name in ('name', 'description')",
-                       ('OpenAddresses {} {}'.format(str(date.today()), tileset_name), ))
-
-            if quadrant == 'northwest':
-                db.execute("update metadata set value = ? where name = 'bounds'", ('-180,0,0,85.05', ))
-            if quadrant == 'northeast':
-                db.execute("update metadata set value = ? where name = 'bounds'", ('0,0,180,85.05', ))
-            if quadrant == 'southeast':
-                db.execute("update metadata set value = ? where name = 'bounds'", ('0,-85.05,180,0', ))
-            if quadrant == 'southwest':
-                db.execute("update metadata set value = ? where name = 'bounds'", ('-180,-85.05,0,0', ))
-
-        yield quadrant, quad_out
+    # Tiles above zoom 0 are split at 2**(zoom - 1); MBTiles rows count up from the south.
+    half = '(1 << (zoom_level - 1))'
+    column = 'tile_column {} {}'.format('>=' if quadrant.endswith('east') else '<', half)
+    row = 'tile_row {} {}'.format('>=' if quadrant.startswith('north') else '<', half)
+
+    with sqlite3.connect(mbtiles_filename) as db:
+        db.execute('delete from tiles where zoom_level > 0 and not ({} and {})'.format(column, row))
+
+def _update_quadrant_metadata(mbtiles_filename, name_prefix, quadrant):
+    center, bounds = QUADRANTS[quadrant]
+
+    with sqlite3.connect(mbtiles_filename) as db:
+        tileset_name = '{} {}'.format(name_prefix.capitalize(), quadrant.capitalize()).lstrip()
+        db.execute("update metadata set value = ? where name = 'center'", (center, ))
+        db.execute("update metadata set value = ? where name in ('name', 'description')",
+                   ('OpenAddresses {} {}'.format(str(date.today()), tileset_name), ))
+        db.execute("update metadata set value = ? where name = 'bounds'", (bounds, ))
 
 def mapbox_upload(mbtiles_path, tileset, username, api_key):
     ''' Upload MBTiles file to a tileset on Mapbox API.
@@ -237,6 +355,16 @@ parser.add_argument('-m', '--mapbox-key', default=environ.get('MAPBOX_KEY', None
 parser.add_argument('-n', '--name-prefix', default='',
                     help='Optional Mapbox tileset name prefix.')
 
+parser.add_argument('--mirror-dir', default=environ.get('PROCESSED_MIRROR_DIR', None),
+                    help='Optional local mirror directory for processed files. Defaults to value of PROCESSED_MIRROR_DIR environment variable.')
+
+parser.add_argument('--state-dir', default=environ.get('DOTMAP_STATE_DIR', None),
+                    help='Optional directory to keep tilesets and sources for incremental updates. Defaults to value of DOTMAP_STATE_DIR environment variable.')
+
+parser.add_argument('--incremental', action='store_true',
+                    help='Only rebuild tiles touched by sources changed since the tilesets in --state-dir. '
+                         'Tiles at zooms 0-{} are kept from the previous tilesets and go stale until a full rebuild without --incremental.'.format(REGION_ZOOM - 1))
+
 parser.add_argument('--sns-arn', default=environ.get('AWS_SNS_ARN', None),
                     help='Optional AWS Simple Notification Service (SNS) resource. Defaults to value of AWS_SNS_ARN environment variable.')
 
@@ -252,80 +380,273 @@ def main():
             runs = read_completed_runs_to_date(db, set.id)
             _L.info("Using set %s with %d runs.", set.id, len(runs))
 
-    mbtiles_filenames = list()
+    mirror = args.mirror_dir and ProcessedMirror(args.mirror_dir)
+    state = args.state_dir and read_state(args.state_dir)
 
-    # Prepare 14 temporary files for use in preparing and cutting MBTiles output.
-    for i in range(14):
-        handle, mbtiles_filename = mkstemp(prefix='oa-{:02d}-'.format(i), suffix='.mbtiles')
-        _L.info("Added %s as temp mbtiles filename", mbtiles_filename)
-        mbtiles_filenames.append(mbtiles_filename)
-        close(handle)
-
-    # Stream all features to two tilesets: high-zoom and low-zoom.
-    _L.info("Instantiating tippecanoes")
-    tippecanoe_hi = call_tippecanoe(mbtiles_filenames[0], True)
-    tippecanoe_lo = call_tippecanoe(mbtiles_filenames[1], False)
-    results = iterate_local_processed_files(runs)
+    if args.incremental and state:
+        mbtiles_filenames, sources = update_tilesets(args.name_prefix, runs, state, args.state_dir, mirror)
+    else:
+        if args.incremental:
+            _L.warning("No previous dotmap state found, building all tilesets")
 
-    _L.info("Streaming all features")
-    for feature in stream_all_features(results):
-        line = json.dumps(feature).encode('utf8') + b'\n'
-        tippecanoe_hi.stdin.write(line)
-        tippecanoe_lo.stdin.write(line)
+        sources = dict()
+        results = iterate_local_processed_files(runs, mirror=mirror)
+        mbtiles_filenames = build_tilesets(args.name_prefix, stream_tracked_feature_points(results, sources))
 
-    _L.info("Finished streaming features")
-    tippecanoe_hi.stdin.close()
-    tippecanoe_lo.stdin.close()
-    tippecanoe_hi.wait()
-    tippecanoe_lo.wait()
-
-    status_hi, status_lo = tippecanoe_hi.returncode, tippecanoe_lo.returncode
-    _L.info("Tippecanoes are finished. Highzoom status: %s, Lowzoom status: %s", status_hi, status_lo)
-
-    if status_hi != 0 and status_lo != 0:
-        raise RuntimeError('High- and low-zoom Tippecanoe commands returned {} and {}'.format(status_hi, status_lo))
-    elif status_hi != 0:
-        raise RuntimeError('High-zoom Tippecanoe command returned {}'.format(status_hi))
-    elif status_lo != 0:
-        raise RuntimeError('Low-zoom Tippecanoe command returned {}'.format(status_lo))
-
-    # Split world tilesets into quadrants and upload them to Mapbox.
-    for (quadrant, mbtiles_filename) in split_tilesets(args.name_prefix, *mbtiles_filenames):
+    # Upload quadrant tilesets to Mapbox.
+    for (quadrant, mbtiles_filename) in sorted(mbtiles_filenames.items()):
         tileset_name = '{}-{}'.format(args.name_prefix, quadrant).lstrip('-')
         tileset_id = '{}.{}'.format(args.mapbox_user, tileset_name)
         mapbox_upload(mbtiles_filename, tileset_id, args.mapbox_user, args.mapbox_key)
         _L.info("Uploaded %s to mapbox", mbtiles_filename)
 
+    if args.state_dir:
+        write_state(args.state_dir, mbtiles_filenames, sources)
+
     _L.info("Done updating dotmap.")
 
-def stream_all_features(results):
-    ''' Generate a stream of all locations as GeoJSON features.
+def build_tilesets(name_prefix, points):
+    ''' Build a joined MBTiles file for each quadrant with any points.
+
+        Points are (lon, lat, line) tuples from stream_all_feature_points().
+        Returns a dictionary of MBTiles filenames keyed on quadrant name.
+    '''
+    mbtiles_filenames, tippecanoes, writers = dict(), dict(), dict()
+
+    def start_quadrant(quadrant):
+        # Prepare temporary files for high-zoom, low-zoom, and joined output.
+        for kind in ('hi', 'lo', 'out'):
+            handle, mbtiles_filename = mkstemp(prefix='oa-{}-{}-'.format(quadrant, kind), suffix='.mbtiles')
+            _L.info("Added %s as temp mbtiles filename", mbtiles_filename)
+            mbtiles_filenames[(quadrant, kind)] = mbtiles_filename
+            close(handle)
+
+        # Stream features to two tilesets: high-zoom and low-zoom.
+        for kind in ('hi', 'lo'):
+            key = quadrant, kind
+            tippecanoes[key] = call_tippecanoe(mbtiles_filenames[key], kind == 'hi')
+            writers[key] = PipeWriter(tippecanoes[key], 'tippecanoe {} {}'.format(*key))
+
+    _L.info("Streaming all features")
+    try:
+        for (quadrant, batch) in iterate_quadrant_batches(points):
+            if (quadrant, 'hi') not in writers:
+                start_quadrant(quadrant)
+
+            writers[(quadrant, 'hi')].write(batch)
+            writers[(quadrant, 'lo')].write(batch)
+
+        for writer in writers.values():
+            writer.close()
+    except:
+        # Don't leave the other Tippecanoes or their writers waiting for input.
+        for tippecanoe in tippecanoes.values():
+            tippecanoe.kill()
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+    _L.info("Finished streaming features")
+
+    for ((quadrant, kind), tippecanoe) in sorted(tippecanoes.items()):
+        tippecanoe.wait()
+        _L.info("Tippecanoe for %s %s is finished with status %s", quadrant, kind, tippecanoe.returncode)
+
+    failures = ['{} {}'.format(*key) for (key, tippecanoe) in sorted(tippecanoes.items()) if tippecanoe.returncode != 0]
+
+    if failures:
+        raise RuntimeError('Tippecanoe commands failed for {}'.format(', '.join(failures)))
+
+    # Join high- and low-zoom tilesets for each quadrant.
+    quadrants = sorted({quadrant for (quadrant, _) in tippecanoes})
+
+    with ThreadPoolExecutor(max(1, len(quadrants))) as executor:
+        futures = {quadrant: executor.submit(finish_quadrant_tileset, name_prefix, quadrant,
+                                             *[mbtiles_filenames[(quadrant, kind)] for kind in ('hi', 'lo', 'out')])
+                   for quadrant in quadrants}
+
+    return {quadrant: future.result() for (quadrant, future) in futures.items()}
+
+def update_tilesets(name_prefix, runs, state, state_dir, mirror):
+    ''' Rebuild tiles in regions touched by changed sources, merge into previous tilesets.
+
+        Tiles below REGION_ZOOM are kept from the previous tilesets, and go
+        stale until the next full build. Points within REGION_BUFFER of a
+        dirty region are included so tiles at its edges are not clipped,
+        but only tiles inside dirty regions are replaced.
+
+        Returns a dictionary of MBTiles filenames keyed on quadrant name
+        and a dictionary of sources for write_state().
+    '''
+    previous = state['sources']
+    runs = {run_source_base(run): run for run in runs if run.state and run.state.processed}
+
+    changed_bases = {source_base for (source_base, run) in runs.items()
+                     if not run.state.process_hash
+                     or previous.get(source_base, {}).get('process hash') != run.state.process_hash}
+    removed_bases = set(previous.keys()) - set(runs.keys())
+    _L.info("Found %d changed and %d removed sources", len(changed_bases), len(removed_bases))
+
+    sources = {source_base: previous[source_base] for source_base in runs
+               if source_base not in changed_bases}
+
+    dirty_regions = set()
+
+    for source_base in (changed_bases | removed_bases):
+        dirty_regions |= set(previous.get(source_base, {}).get('regions', []))
+
+    # Read changed sources once to learn their new regions.
+    changed_runs = [runs[source_base] for source_base in sorted(changed_bases)]
+    for _ in stream_tracked_feature_points(iterate_local_processed_files(changed_runs, mirror=mirror), sources):
+        pass
+
+    for source_base in changed_bases:
+        dirty_regions |= set(sources.get(source_base, {}).get('regions', []))
+
+    _L.info("Rebuilding tiles in %d regions", len(dirty_regions))
+
+    # Rebuild dirty regions from every source with points in or next to them.
+    nearby_regions = {(x + dx, y + dy) for ((x, y), dx, dy)
+                      in product(dirty_regions, (-1, 0, 1), (-1, 0, 1))}
+    dirty_runs = [run for (source_base, run) in sorted(runs.items())
+                  if nearby_regions & set(sources.get(source_base, {}).get('regions', []))]
+    results = iterate_local_processed_files(dirty_runs, mirror=mirror)
+    points = ((lon, lat, line) for (lon, lat, line) in stream_all_feature_points(results)
+              if lonlat_buffer_regions(lon, lat) & dirty_regions)
+
+    patch_filenames = build_tilesets(name_prefix, points)
+    mbtiles_filenames = dict()
+
+    for quadrant in QUADRANTS:
+        mbtiles_filenames[quadrant] = join(state_dir, '{}.mbtiles'.format(quadrant))
+        patch_filename = patch_filenames.get(quadrant)
+        merge_tileset_regions(mbtiles_filenames[quadrant], patch_filename, dirty_regions)
+        _update_quadrant_metadata(mbtiles_filenames[quadrant], name_prefix, quadrant)
+
+        if patch_filename:
+            remove(patch_filename)
+
+    return mbtiles_filenames, sources
+
+def merge_tileset_regions(mbtiles_filename, patch_filename, regions):
+    ''' Replace tiles at REGION_ZOOM and above in regions with tiles from patch.
+
+        Tiles are only deleted if there is no patch tileset.
+    '''
+    with sqlite3.connect(mbtiles_filename) as db:
+        if patch_filename:
+            db.execute('attach database ? as patch', (patch_filename, ))
+
+        for (region, zoom) in product(sorted(regions), range(REGION_ZOOM, BASE_ZOOM + 1)):
+            bounds = (zoom, ) + region_tile_bounds(region, zoom)
+            where = 'zoom_level = ? and tile_column between ? and ? and tile_row between ? and ?'
+            db.execute('delete from tiles where ' + where, bounds)
+
+            if patch_filename:
+                db.execute('insert into tiles select zoom_level, tile_column, tile_row, tile_data from patch.tiles where ' + where, bounds)
+
+def lonlat_region(lon, lat):
+    ''' Return (x, y) index of the REGION_ZOOM web mercator tile containing a point.
+    '''
+    x, y = _lonlat_region_position(lon, lat)
+    return _clamp_region(int(x), int(y))
+
+def lonlat_buffer_regions(lon, lat, buffer=REGION_BUFFER):
+    ''' Return set of (x, y) regions within buffer region widths of a point.
+    '''
+    x, y = _lonlat_region_position(lon, lat)
+    return {_clamp_region(int(x + dx), int(y + dy))
+            for (dx, dy) in product((-buffer, buffer), (-buffer, buffer))}
+
+def _lonlat_region_position(lon, lat):
+    ''' Return fractional (x, y) position of a point in REGION_ZOOM tile units.
+    '''
+    count = 2**REGION_ZOOM
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = (lon + 180.) / 360. * count
+    y = (1. - log(tan(radians(lat)) + 1. / cos(radians(lat))) / pi) / 2. * count
+    return x, y
+
+def _clamp_region(x, y):
+    count = 2**REGION_ZOOM
+    return min(max(x, 0), count - 1), min(max(y, 0), count - 1)
+
+def region_tile_bounds(region, zoom):
+    ''' Return min. and max. MBTiles column and row of tiles at zoom inside a region.
+    '''
+    (x, y), shift = region, zoom - REGION_ZOOM
+    row_max = 2**zoom - 1 - (y << shift) # MBTiles rows count up from the south.
+    row_min = 2**zoom - 1 - (((y + 1) << shift) - 1)
+    return x << shift, ((x + 1) << shift) - 1, row_min, row_max
+
+def run_source_base(run):
+    source_base, _ = splitext(relpath(run.source_path, 'sources'))
+    return source_base
+
+def read_state(state_dir):
+    ''' Return dotmap state from a previous run, or None if it's incomplete.
+    '''
+    filenames = [join(state_dir, name) for name in ['sources.json']
+                 + ['{}.mbtiles'.format(quadrant) for quadrant in QUADRANTS]]
+
+    if not all(exists(filename) for filename in filenames):
+        return None
+
+    with open(filenames[0]) as file:
+        state = json.load(file)
+
+    for source in state['sources'].values():
+        source['regions'] = [tuple(region) for region in source['regions']]
+
+    return state
+
+def write_state(state_dir, mbtiles_filenames, sources):
+    ''' Save quadrant tilesets and sources for a later incremental update.
+    '''
+    makedirs(state_dir, exist_ok=True)
+
+    for (quadrant, mbtiles_filename) in mbtiles_filenames.items():
+        state_filename = join(state_dir, '{}.mbtiles'.format(quadrant))
+        if mbtiles_filename != state_filename:
+            move(mbtiles_filename, state_filename)
+
+    handle, sources_filename = mkstemp(prefix='sources-', suffix='.json', dir=state_dir)
+    close(handle)
+
+    with open(sources_filename, 'w') as file:
+        json.dump(dict(sources=sources), file, sort_keys=True)
+
+    rename(sources_filename, join(state_dir, 'sources.json'))
+
+def stream_tracked_feature_points(results, sources):
+    ''' Generate stream_all_feature_points() output, noting regions of each source.
+
+        Sources are added to a dictionary keyed on source base, with process
+        hash and list of (x, y) regions at REGION_ZOOM with any points.
+    '''
+    for result in results:
+        regions = set()
+
+        for (lon, lat, line) in stream_all_feature_points([result]):
+            regions.add(lonlat_region(lon, lat))
+            yield lon, lat, line
+
+        sources[result.source_base] = {'process hash': result.run_state.process_hash,
+                                       'regions': sorted(regions)}
+
+def stream_all_feature_points(results):
+    ''' Generate a stream of all locations as (lon, lat, GeoJSON line) tuples.
     '''
     for result in results:
         _L.debug(u'Opening {} ({})'.format(result.filename, result.source_base))
 
-        zipfile = ZipFile(result.filename, mode='r')
-        for filename in zipfile.namelist():
+        with ZipFile(result.filename, mode='r') as zipfile:
             # Look for the one expected .csv file in the zip archive.
-            _, ext = splitext(filename)
-            if ext == '.csv':
-                # Yield GeoJSON point objects with no properties.
-                fileobj = zipfile.open(filename)
-                buffer = TextIOWrapper(fileobj, encoding='utf8')
-                for row in csv.DictReader(buffer):
-                    try:
-                        lon_lat = float(row['LON']), float(row['LAT'])
-                        properties = {k: v for (k, v) in row.items() if k not in ('LON', 'LAT')}
-                        feature = {"type": "Feature", "properties": properties,
-                            "geometry": {"type": "Point", "coordinates": lon_lat}}
-                    except ValueError:
-                        pass
-                    else:
-                        yield feature
-
-                # Move on to the next zip archive.
-                zipfile.close()
-                break
+            csv_names = [name for name in zipfile.namelist() if splitext(name)[1] == '.csv']
+
+            if csv_names:
+                buffer = TextIOWrapper(zipfile.open(csv_names[0]), encoding='utf8', newline='')
+                yield from iterate_feature_points(csv.reader(buffer))
 
 if __name__ == '__main__':
     exit(main())
@@ -3,16 +3,18 @@ import logging; _L = logging.getLogger('openaddr.preview')
 
 from zipfile import ZipFile
 from io import TextIOWrapper
-from csv import DictReader
+from csv import reader
 from tempfile import mkstemp
-from math import pow, sqrt, pi, log
+from math import pow, pi, log
 from argparse import ArgumentParser
 from urllib.parse import urlparse
-import json, itertools, os, struct
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import json, itertools, os, gzip, sqlite3
 
-import requests, uritemplate, mapbox_vector_tile
+import numpy, requests, uritemplate, mapbox_vector_tile
 
-from osgeo import osr, ogr
+from osgeo import ogr
 
 try:
     import cairo
@@ -21,17 +23,36 @@ except ImportError:
     import cairocffi as cairo
 
 TILE_URL = 'http://a.tiles.mapbox.com/v4/mapbox.mapbox-streets-v7/{z}/{x}/{y}.mvt{?access_token}'
-EARTH_DIAMETER = 6378137 * 2 * pi
-FORMAT = 'ff'
 
-# WGS 84, http://spatialreference.org/ref/epsg/4326/
-EPSG4326 = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
+# Web Mercator sphere, https://trac.osgeo.org/openlayers/wiki/SphericalMercator
+EARTH_RADIUS = 6378137
+EARTH_DIAMETER = EARTH_RADIUS * 2 * pi
 
-# Web Mercator, https://trac.osgeo.org/openlayers/wiki/SphericalMercator
-EPSG900913 = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +no_defs'
+# Packed (x, y) values in points files.
+POINT_DTYPE = numpy.float32
 
-def render(filename_or_url, png_filename, width, resolution, mapbox_key):
-    '''
+# Number of points to project and write at once.
+POINTS_BATCH_SIZE = 100000
+
+# Number of basemap tiles to fetch at once.
+TILE_CONCURRENCY = 8
+
+# Seconds to keep basemap tiles in a cache directory.
+TILE_CACHE_TTL = 7 * 86400
+
+# Sources with more points than this are drawn as a density raster by default.
+DENSITY_POINT_THRESHOLD = 100000
+
+# Opacity of a pixel with a single point in a density raster.
+DENSITY_MIN_ALPHA = .4
+
+def render(filename_or_url, png_filename, width, resolution, mapbox_key, density=None,
+           tile_source=None, cache_dir=None):
+    ''' Draw a preview map to png_filename.
+
+        Points are drawn individually, or as a single density raster when
+        density is true. If density is None, it's chosen by point count.
+        See get_tile_data() for tile_source and cache_dir.
     '''
     src_filename = get_local_filename(filename_or_url)
     _, points_filename = mkstemp(prefix='points-', suffix='.bin')
@@ -39,7 +60,7 @@ def render(filename_or_url, png_filename, width, resolution, mapbox_key):
     try:
         _L.info('Writing from {} to {}...'.format(src_filename, points_filename))
         points = project_lonlats(iterate_file_lonlats(src_filename))
-        write_points(points, points_filename)
+        write_point_arrays(points, points_filename)
 
         xmin, ymin, xmax, ymax = calculate_bounds(points_filename)
     except:
@@ -68,7 +89,7 @@ def render(filename_or_url, png_filename, width, resolution, mapbox_key):
     context.fill()
 
     landuse_geoms, water_geoms, roads_geoms = \
-        get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key)
+        get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key, tile_source, cache_dir)
 
     fill_geometries(context, landuse_geoms, muppx, park_fill)
     fill_geometries(context, water_geoms, muppx, water_fill)
@@ -79,14 +100,24 @@ def render(filename_or_url, png_filename, width, resolution, mapbox_key):
 
     context.set_line_width(.25 * muppx)
 
-    for (x, y) in read_points(points_filename):
-        context.arc(x, y, 15, 0, 2 * pi)
-        context.set_source_rgb(*point_fill)
-        context.fill()
-        context.arc(x, y, 15, 0, 2 * pi)
-        context.set_source_rgb(*black)
-        context.stroke()
+    points = read_points(points_filename)
+
+    if density is None:
+        density = len(points) > DENSITY_POINT_THRESHOLD
+
+    if density:
+        _L.info('Drawing {} points as density raster'.format(len(points)))
+        draw_density(context, points, point_fill)
+    else:
+        for (x, y) in points.tolist():
+            context.arc(x, y, 15, 0, 2 * pi)
+            context.set_source_rgb(*point_fill)
+            context.fill()
+            context.arc(x, y, 15, 0, 2 * pi)
+            context.set_source_rgb(*black)
+            context.stroke()
 
+    del points
     os.remove(points_filename)
     surface.write_to_png(png_filename)
 
@@ -131,17 +162,93 @@ def iterate_file_lonlats(filename):
             csv_names = [name for name in zip.namelist() if name.endswith('.csv')]
             csv_file = TextIOWrapper(zip.open(csv_names[0]))
 
-        for row in DictReader(csv_file):
+        rows = reader(csv_file)
+        header = next(rows, [])
+
+        if 'LON' not in header or 'LAT' not in header:
+            return
+
+        lon_index, lat_index = header.index('LON'), header.index('LAT')
+
+        for row in rows:
             try:
-                lon, lat = float(row['LON']), float(row['LAT'])
+                lon, lat = float(row[lon_index]), float(row[lat_index])
             except:
                 continue
 
             if -180 <= lon <= 180 and -90 <= lat <= 90:
                 yield (lon, lat)
 
-def get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key):
+def get_tile_data(zoom, col, row, mapbox_key, tile_source=None, cache_dir=None):
+    ''' Get vector tile data from a local tile source, a cache, or Mapbox.
+
+        Local tile_source may be an MBTiles file or a directory of z/x/y.mvt
+        files, and tiles missing from it are returned as None. Tiles fetched
+        from Mapbox are kept in optional cache_dir with the same layout.
+    '''
+    if tile_source and tile_source.lower().endswith('.mbtiles'):
+        return read_mbtiles_tile(tile_source, zoom, col, row)
+
+    if tile_source:
+        return read_directory_tile(tile_source, zoom, col, row)
+
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, str(zoom), str(col), '{}.mvt'.format(row))
+        if os.path.exists(cache_path) and time() - os.path.getmtime(cache_path) < TILE_CACHE_TTL:
+            _L.debug('Reading tile {}'.format(cache_path))
+            with open(cache_path, 'rb') as file:
+                return file.read()
+
+    url = uritemplate.expand(TILE_URL, dict(z=zoom, x=col, y=row, access_token=mapbox_key))
+    _L.debug('Getting tile {}'.format(url))
+    got = requests.get(url)
+
+    if cache_dir and got.status_code == 200:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        handle, temp_path = mkstemp(dir=os.path.dirname(cache_path), suffix='.mvt')
+
+        # Rename into place so concurrent previews never see partial tiles.
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                file.write(got.content)
+            os.rename(temp_path, cache_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    return got.content
+
+def read_directory_tile(dirname, zoom, col, row):
+    ''' Read vector tile data from a directory of z/x/y.mvt files, or None.
     '''
+    path = os.path.join(dirname, str(zoom), str(col), '{}.mvt'.format(row))
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as file:
+        return file.read()
+
+def read_mbtiles_tile(filename, zoom, col, row):
+    ''' Read vector tile data from an MBTiles file, or None.
+    '''
+    with sqlite3.connect(filename) as db:
+        # MBTiles rows count up from the south.
+        found = db.execute('''SELECT tile_data FROM tiles
+                              WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?''',
+                           (zoom, col, 2**zoom - 1 - row)).fetchone()
+
+    if found is None:
+        return None
+
+    data = bytes(found[0])
+    return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+def get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key,
+                     tile_source=None, cache_dir=None):
+    ''' Get landuse, water, and road geometries for a map area.
+
+        Tiles are fetched concurrently; see get_tile_data() for tile_source and cache_dir.
     '''
     zoom = round(calculate_zoom(scale, resolution))
     mincol = 2**zoom * (xmin + EARTH_DIAMETER/2) / EARTH_DIAMETER
@@ -187,10 +294,18 @@ def get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key):
         geom = ogr.CreateGeometryFromJson(json.dumps(dict(type=geometry['type'], coordinates=coordinates)))
         return geom
 
-    for (row, col) in row_cols:
-        url = uritemplate.expand(TILE_URL, dict(z=zoom, x=col, y=row, access_token=mapbox_key))
-        got = requests.get(url)
-        tile = mapbox_vector_tile.decode(got.content)
+    def get_tile(row_col):
+        row, col = row_col
+        return row, col, get_tile_data(zoom, col, row, mapbox_key, tile_source, cache_dir)
+
+    with ThreadPoolExecutor(TILE_CONCURRENCY) as executor:
+        tiles_data = executor.map(get_tile, row_cols)
+
+    for (row, col, data) in tiles_data:
+        if data is None:
+            continue
+
+        tile = mapbox_vector_tile.decode(data)
         bounds = tile_bounds(row, col, zoom)
 
         if 'landuse' in tile:
@@ -213,83 +328,80 @@ def get_map_features(xmin, ymin, xmax, ymax, resolution, scale, mapbox_key):
                     if feature['properties'].get('class') in ('motorway', 'motorway_link', 'trunk', 'primary', 'secondary', 'tertiary', 'link', 'street', 'street_limited', 'pedestrian', 'construction', 'track', 'service', 'major_rail', 'minor_rail'):
                         roads_geoms.append(projected_geom(feature['geometry'], *road_xform))
 
-        _L.debug('Getting tile {}'.format(url))
-
     return landuse_geoms, water_geoms, roads_geoms
 
-def get_projection():
-    '''
+def iterate_point_arrays(points, size=POINTS_BATCH_SIZE):
+    ''' Stream (n, 2) arrays of up to size values from a stream of 2-tuples.
     '''
-    osr.UseExceptions()
-    sref_geo = osr.SpatialReference(); sref_geo.ImportFromProj4(EPSG4326)
-    sref_map = osr.SpatialReference(); sref_map.ImportFromProj4(EPSG900913)
-    return osr.CoordinateTransformation(sref_geo, sref_map)
+    points = iter(points)
 
-def project_lonlats(lonlats):
-    ''' Stream Mercator (x, y) points from a stream of (lon, lat) coordinates.
+    while True:
+        values = itertools.chain.from_iterable(itertools.islice(points, size))
+        array = numpy.fromiter(values, dtype=numpy.float64).reshape(-1, 2)
+
+        if not len(array):
+            return
+
+        yield array
+
+def project_lonlat_array(lonlats):
+    ''' Project an (n, 2) array of (lon, lat) coordinates to Mercator (x, y).
+
+        Coordinates at the poles have no Mercator position and are dropped.
     '''
-    project, geom = get_projection(), ogr.Geometry(ogr.wkbPoint)
+    lonlats = lonlats[numpy.abs(lonlats[:,1]) < 90]
+    lons, lats = numpy.radians(lonlats[:,0]), numpy.radians(lonlats[:,1])
 
-    for (lon, lat) in lonlats:
-        geom.SetPoint(0, lon, lat)
-        try:
-            geom.Transform(project)
-        except:
-            pass
-        else:
-            yield (geom.GetX(), geom.GetY())
+    xs = EARTH_RADIUS * lons
+    ys = EARTH_RADIUS * numpy.log(numpy.tan(pi/4 + lats/2))
 
-    del project, geom
+    return numpy.column_stack((xs, ys))
 
-def write_points(points, points_filename):
-    ''' Write a stream of (x, y) points into a file of packed values.
+def project_lonlats(lonlats):
+    ''' Stream arrays of Mercator (x, y) points from a stream of (lon, lat) coordinates.
+    '''
+    for array in iterate_point_arrays(lonlats):
+        yield project_lonlat_array(array)
+
+def write_point_arrays(arrays, points_filename):
+    ''' Write a stream of (n, 2) point arrays into a file of packed values.
     '''
     count = 0
 
     with open(points_filename, mode='wb') as file:
-        for (x, y) in points:
-            file.write(struct.pack(FORMAT, x, y))
-            count += 1
+        for array in arrays:
+            array.astype(POINT_DTYPE).tofile(file)
+            count += len(array)
 
     _L.info('Wrote {} points to {}'.format(count, points_filename))
 
+def write_points(points, points_filename):
+    ''' Write a stream of (x, y) points into a file of packed values.
+    '''
+    write_point_arrays(iterate_point_arrays(points), points_filename)
+
 def read_points(points_filename):
-    ''' Read a file of packed values into a stream of (x, y) points.
+    ''' Read a file of packed values into an (n, 2) array of (x, y) points.
+
+        Array is memory-mapped from the file, so large sources need not fit in memory.
     '''
     _L.debug('Reading from {}'.format(points_filename))
-    chunk_size = struct.calcsize(FORMAT)
 
-    with open(points_filename, mode='rb') as file:
-        while True:
-            chunk = file.read(chunk_size)
-            if chunk:
-                yield struct.unpack(FORMAT, chunk)
-            else:
-                return
+    if os.path.getsize(points_filename) == 0:
+        return numpy.empty((0, 2), dtype=POINT_DTYPE)
+
+    return numpy.memmap(points_filename, dtype=POINT_DTYPE, mode='r').reshape(-1, 2)
 
 def stats(points_filename):
     ''' Return means and standard deviations for points in file.
-
-        Uses Welford's numerically stable algorithm from
-        https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Online_algorithm
     '''
-    n, xmean, xM2, ymean, yM2 = 0, 0, 0, 0, 0
-
-    for (x, y) in read_points(points_filename):
-        n += 1
-
-        xdelta = x - xmean
-        xmean += xdelta / n
-        xM2 += xdelta * (x - xmean)
-
-        ydelta = y - ymean
-        ymean += ydelta / n
-        yM2 += ydelta * (y - ymean)
+    points = read_points(points_filename)
 
-    if n < 2:
+    if len(points) < 2:
         raise ValueError()
 
-    xstddev, ystddev = sqrt(xM2 / (n - 1)), sqrt(yM2 / (n - 1))
+    xmean, ymean = points.mean(axis=0, dtype=numpy.float64).tolist()
+    xstddev, ystddev = points.std(axis=0, dtype=numpy.float64, ddof=1).tolist()
 
     return xmean, xstddev, ymean, ystddev
 
@@ -312,14 +424,12 @@ def calculate_bounds(points_filename):
     ymin, ymax = ymean - 3 * ysdev, ymean + 3 * ysdev
 
     # look at the actual points
-    left, right = xmax, xmin
-    bottom, top = ymax, ymin
+    points = read_points(points_filename)
+    xs, ys = points[:,0], points[:,1]
+    xs, ys = xs[(xmin <= xs) & (xs <= xmax)], ys[(ymin <= ys) & (ys <= ymax)]
 
-    for (x, y) in read_points(points_filename):
-        if xmin <= x <= xmax:
-            left, right = min(left, x), max(right, x)
-        if ymin <= y <= ymax:
-            bottom, top = min(bottom, y), max(top, y)
+    left, right = (float(xs.min()), float(xs.max())) if len(xs) else (xmax, xmin)
+    bottom, top = (float(ys.min()), float(ys.max())) if len(ys) else (ymax, ymin)
 
     # pad by 2% on all sides
     width, height = right - left, top - bottom
@@ -401,6 +511,54 @@ def fill_geometries(ctx, geometries, muppx, rgb):
                 draw_line(ctx, points[-1], points)
             ctx.fill()
 
+def density_pixels(points, matrix, width, height, rgb):
+    ''' Get a (height, width) array of premultiplied ARGB32 pixels for points.
+
+        Points are binned by pixel using the (xx, yx, xy, yy, x0, y0) matrix
+        from map units, and pixel opacity grows with log of point count.
+    '''
+    xx, yx, xy, yy, x0, y0 = matrix
+    counts = numpy.zeros(width * height, dtype=numpy.int64)
+
+    for offset in range(0, len(points), POINTS_BATCH_SIZE):
+        xs, ys = numpy.transpose(points[offset:offset + POINTS_BATCH_SIZE]).astype(numpy.float64)
+        cols = numpy.floor(xx * xs + xy * ys + x0).astype(numpy.int64)
+        rows = numpy.floor(yx * xs + yy * ys + y0).astype(numpy.int64)
+        inside = (0 <= cols) & (cols < width) & (0 <= rows) & (rows < height)
+        counts += numpy.bincount(rows[inside] * width + cols[inside], minlength=width * height)
+
+    levels = numpy.log(numpy.maximum(counts, 1)) / log(max(counts.max(), 2))
+    alphas = numpy.where(counts > 0, DENSITY_MIN_ALPHA + (1 - DENSITY_MIN_ALPHA) * levels, 0)
+    alphas = numpy.round(alphas * 0xFF).astype(numpy.uint32)
+
+    red, green, blue = [(alphas * round(c * 0xFF) + 0x7F) // 0xFF for c in rgb]
+    pixels = (alphas << 24) | (red << 16) | (green << 8) | blue
+
+    return pixels.reshape(height, width)
+
+def draw_density(ctx, points, rgb):
+    ''' Draw points onto context target surface as a single density raster.
+    '''
+    target = ctx.get_target()
+    width, height = target.get_width(), target.get_height()
+    pixels = density_pixels(points, tuple(ctx.get_matrix()), width, height, rgb)
+
+    # Copy pixels into a new surface, because ImageSurface.create_for_data()
+    # is not implemented by py3cairo 1.10. Image rows may be padded past width.
+    image = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    data = numpy.zeros((height, image.get_stride() // 4), dtype=numpy.uint32)
+    data[:,:width] = pixels
+
+    image.flush()
+    image.get_data()[:] = data.tobytes()
+    image.mark_dirty()
+
+    ctx.save()
+    ctx.identity_matrix()
+    ctx.set_source_surface(image, 0, 0)
+    ctx.paint()
+    ctx.restore()
+
 def draw_line(ctx, start, points):
     '''
     '''
@@ -414,7 +572,7 @@ parser = ArgumentParser(description='Draw a map of a single source preview.')
 parser.add_argument('src_filename', help='Input Zip or CSV filename or URL.')
 parser.add_argument('png_filename', help='Output PNG filename.')
 
-parser.set_defaults(resolution=1, width=668)
+parser.set_defaults(resolution=1, width=668, density=None)
 
 parser.add_argument('--2x', dest='resolution', action='store_const', const=2,
                     help='Draw at double resolution.')
@@ -422,12 +580,24 @@ parser.add_argument('--2x', dest='resolution', action='store_const', const=2,
 parser.add_argument('--1x', dest='resolution', action='store_const', const=1,
                     help='Draw at normal resolution.')
 
+parser.add_argument('--density', dest='density', action='store_const', const=True,
+                    help='Draw points as a density raster. Defaults to automatic choice by point count.')
+
+parser.add_argument('--no-density', dest='density', action='store_const', const=False,
+                    help='Draw points individually.')
+
 parser.add_argument('--width', dest='width', type=int,
                     help='Width in pixels.')
 
 parser.add_argument('--mapbox-key', dest='mapbox_key',
                     help='Mapbox API Key. See: https://mapbox.com/')
 
+parser.add_argument('--tile-source', default=os.environ.get('PREVIEW_TILE_SOURCE', None),
+                    help='Optional local MBTiles file or z/x/y.mvt directory of basemap tiles. Defaults to value of PREVIEW_TILE_SOURCE environment variable.')
+
+parser.add_argument('--tile-cache-dir', default=os.environ.get('PREVIEW_TILE_CACHE_DIR', None),
+                    help='Optional directory for caching basemap tiles. Defaults to value of PREVIEW_TILE_CACHE_DIR environment variable.')
+
 parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
                     action='store_const', dest='loglevel',
                     const=logging.DEBUG, default=logging.INFO)
@@ -440,7 +610,8 @@ def main():
     args = parser.parse_args()
     from .ci import setup_logger
     setup_logger(None, None, log_level=args.loglevel)
-    render(args.src_filename, args.png_filename, args.width, args.resolution, args.mapbox_key)
+    render(args.src_filename, args.png_filename, args.width, args.resolution,
+           args.mapbox_key, args.density, args.tile_source, args.tile_cache_dir)
 
 if __name__ == '__main__':
     exit(main())
@@ -5,7 +5,7 @@ from urllib.parse import urlparse
 from os.path import join, basename, dirname, exists, splitext, relpath
 from shutil import copy, move, rmtree
 from argparse import ArgumentParser
-from os import mkdir, rmdir, close, chmod
+from os import mkdir, rmdir, close, chmod, environ
 from _thread import get_ident
 import tempfile, json, csv, sys, enum
 import threading
@@ -51,7 +51,7 @@ def boolstr(value):
 
     raise ValueError(repr(value))
 
-def process(source, destination, layer, layersource, do_preview, mapbox_key=None, extras=dict()):
+def process(source, destination, layer, layersource, do_preview, mapbox_key=None, extras=dict(), tile_cache_dir=None):
     ''' Process a single source and destination, return path to JSON state file.
 
         Creates a new directory and files under destination.
@@ -153,7 +153,7 @@ def process(source, destination, layer, layersource, do_preview, mapbox_key=None
                         _L.info('Processed data in {}'.format(conform_result.path))
 
                         if do_preview and mapbox_key:
-                            preview_path = render_preview(conform_result.path, temp_dir, mapbox_key)
+                            preview_path = render_preview(conform_result.path, temp_dir, mapbox_key, tile_cache_dir)
 
                         if do_preview:
                             slippymap_path = render_slippymap(conform_result.path, temp_dir)
@@ -202,11 +202,11 @@ def upgrade_source_schema(schema):
 
     return v2
 
-def render_preview(csv_filename, temp_dir, mapbox_key):
+def render_preview(csv_filename, temp_dir, mapbox_key, tile_cache_dir=None):
     '''
     '''
     png_filename = join(temp_dir, 'preview.png')
-    preview.render(csv_filename, png_filename, 668, 2, mapbox_key)
+    preview.render(csv_filename, png_filename, 668, 2, mapbox_key, cache_dir=tile_cache_dir)
 
     return png_filename
 
@@ -412,6 +412,9 @@ parser.add_argument('--skip-preview', help="Don't render a map preview",
 parser.add_argument('--mapbox-key', dest='mapbox_key',
                     help='Mapbox API Key. See: https://mapbox.com/')
 
+parser.add_argument('--tile-cache-dir', default=environ.get('PREVIEW_TILE_CACHE_DIR', None),
+                    help='Optional directory for caching preview basemap tiles. Defaults to value of PREVIEW_TILE_CACHE_DIR environment variable.')
+
 parser.add_argument('-l', '--logfile', help='Optional log file name.')
 
 parser.add_argument('-v', '--verbose', help='Turn on verbose logging',
@@ -434,7 +437,7 @@ def main():
     csv.field_size_limit(sys.maxsize)
 
     try:
-        processed_path = process(args.source, args.destination, args.layer, args.layersource, args.render_preview, mapbox_key=args.mapbox_key)
+        processed_path = process(args.source, args.destination, args.layer, args.layersource, args.render_preview, mapbox_key=args.mapbox_key, tile_cache_dir=args.tile_cache_dir)
     except Exception as e:
         _L.error(e, exc_info=True)
         return 1
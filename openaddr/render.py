@@ -6,8 +6,9 @@ from unicodedata import normalize
 from collections import defaultdict
 from argparse import ArgumentParser
 from itertools import combinations, chain
-from os.path import join, dirname, splitext, relpath
+from os.path import join, dirname, splitext, relpath, basename, exists
 from urllib.parse import urljoin
+from tempfile import gettempdir, mkstemp
 import json, csv, io, os
 
 from osgeo import ogr, osr
@@ -24,6 +25,12 @@ except ImportError:
 # Areas
 WORLD, USA, EUROPE = 54029, 2163, 'Europe'
 
+# Natural Earth and U.S. Census shapefiles.
+GEODATA_DIR = join(dirname(__file__), 'geodata')
+
+# Directory for state borders computed from geodata, kept between runs.
+BORDERS_CACHE_DIR = join(gettempdir(), 'openaddr-render')
+
 # WGS 84, http://spatialreference.org/ref/epsg/4326/
 EPSG4326 = '+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs'
 
@@ -33,6 +40,9 @@ EPSG2163 = '+proj=laea +lat_0=45 +lon_0=-100 +x_0=0 +y_0=0 +a=6370997 +b=6370997
 # World Van der Grinten I, http://spatialreference.org/ref/esri/54029/
 ESRI54029 = '+proj=vandg +lon_0=0 +x_0=0 +y_0=0 +R_A +ellps=WGS84 +datum=WGS84 +units=m +no_defs'
 
+# Opened geodata features and state borders, shared by renders in a process.
+_geodata, _state_borders = dict(), dict()
+
 class RunPartial:
     ''' Partial mock of objects.Run, just to make load_live_state() valid.
     '''
@@ -109,68 +119,83 @@ def load_fake_state(sources_dir):
     '''
     return {path: None for path in iterate_sources_dir(sources_dir)}
 
-def load_geoids(directory, good_sources):
-    ''' Load two dictionaries of U.S. Census GEOIDs that should be rendered.
+def load_coverages(directory):
+    ''' Load a dictionary of source coverage objects in one pass over sources.
 
-        Dictionary keys are FIPS GEOIDs, values are sets of source paths.
+        Dictionary keys are source paths, values are coverage objects.
     '''
-    good_geoids, bad_geoids = defaultdict(set), defaultdict(set)
+    coverages = dict()
 
     for path in iterate_sources_dir(directory):
         with open(join(directory, path)) as file:
             data = json.load(file)
 
-        if 'geoid' in data.get('coverage', {}).get('US Census', {}):
+        coverages[path] = data.get('coverage', {})
+
+    return coverages
+
+def load_geoids(directory, good_sources, coverages=None):
+    ''' Load two dictionaries of U.S. Census GEOIDs that should be rendered.
+
+        Dictionary keys are FIPS GEOIDs, values are sets of source paths.
+    '''
+    good_geoids, bad_geoids = defaultdict(set), defaultdict(set)
+
+    if coverages is None:
+        coverages = load_coverages(directory)
+
+    for (path, coverage) in coverages.items():
+        if 'geoid' in coverage.get('US Census', {}):
             if path in good_sources:
-                good_geoids[data['coverage']['US Census']['geoid']].add(path)
+                good_geoids[coverage['US Census']['geoid']].add(path)
             else:
-                bad_geoids[data['coverage']['US Census']['geoid']].add(path)
+                bad_geoids[coverage['US Census']['geoid']].add(path)
 
     return good_geoids, bad_geoids
 
-def load_iso3166s(directory, good_sources):
+def load_iso3166s(directory, good_sources, coverages=None):
     ''' Load two dictionaries of ISO 3166 codes that should be rendered.
 
         Dictionary keys are ISO 3166 codes, values are sets of source paths.
     '''
     good_iso3166s, bad_iso3166s = defaultdict(set), defaultdict(set)
 
-    for path in iterate_sources_dir(directory):
-        with open(join(directory, path)) as file:
-            data = json.load(file)
+    if coverages is None:
+        coverages = load_coverages(directory)
 
-        if 'code' in data.get('coverage', {}).get('ISO 3166', {}):
+    for (path, coverage) in coverages.items():
+        if 'code' in coverage.get('ISO 3166', {}):
             if path in good_sources:
-                good_iso3166s[data['coverage']['ISO 3166']['code']].add(path)
+                good_iso3166s[coverage['ISO 3166']['code']].add(path)
             else:
-                bad_iso3166s[data['coverage']['ISO 3166']['code']].add(path)
+                bad_iso3166s[coverage['ISO 3166']['code']].add(path)
 
-        elif 'alpha2' in data.get('coverage', {}).get('ISO 3166', {}):
+        elif 'alpha2' in coverage.get('ISO 3166', {}):
             if path in good_sources:
-                good_iso3166s[data['coverage']['ISO 3166']['alpha2']].add(path)
+                good_iso3166s[coverage['ISO 3166']['alpha2']].add(path)
             else:
-                bad_iso3166s[data['coverage']['ISO 3166']['alpha2']].add(path)
+                bad_iso3166s[coverage['ISO 3166']['alpha2']].add(path)
 
     return good_iso3166s, bad_iso3166s
 
-def load_geometries(directory, good_sources, area):
+def load_geometries(directory, good_sources, area, coverages=None):
     ''' Load two dictionaries of GeoJSON geometries should be rendered.
 
         Dictionary keys are source paths, values are geometries
     '''
     good_geometries, bad_geometries = dict(), dict()
 
+    if coverages is None:
+        coverages = load_coverages(directory)
+
     osr.UseExceptions()
     sref_geo = osr.SpatialReference(); sref_geo.ImportFromProj4(EPSG4326)
     sref_map = osr.SpatialReference(); sref_map.ImportFromProj4(EPSG2163 if area == USA else ESRI54029)
     project = osr.CoordinateTransformation(sref_geo, sref_map)
 
-    for path in iterate_sources_dir(directory):
-        with open(join(directory, path)) as file:
-            data = json.load(file)
-
-        if 'geometry' in data.get('coverage', {}):
-            geojson = json.dumps(data['coverage']['geometry'])
+    for (path, coverage) in coverages.items():
+        if 'geometry' in coverage:
+            geojson = json.dumps(coverage['geometry'])
             geometry = ogr.CreateGeometryFromJson(geojson)
 
             if not geometry:
@@ -185,6 +210,51 @@ def load_geometries(directory, good_sources, area):
 
     return good_geometries, bad_geometries
 
+def load_state_borders(area, us_state_features, cache_dir=BORDERS_CACHE_DIR):
+    ''' Get a list of border geometries between neighboring U.S. states.
+
+        Borders are computed once per state shapefile and cached in
+        cache_dir as a single WKB geometry collection.
+    '''
+    shp_filename = join(GEODATA_DIR, 'cb_2013_us_state_20m-{}.shp'.format(USA if area == USA else WORLD))
+    shp_stat = os.stat(shp_filename)
+    cache_key = '{}-{}-{}'.format(splitext(basename(shp_filename))[0], shp_stat.st_size, int(shp_stat.st_mtime))
+    cache_filename = join(cache_dir, 'state-borders-{}.wkb'.format(cache_key))
+
+    if cache_key in _state_borders:
+        return _state_borders[cache_key]
+
+    if exists(cache_filename):
+        with open(cache_filename, 'rb') as file:
+            collection = ogr.CreateGeometryFromWkb(file.read())
+
+        borders = [collection.GetGeometryRef(i).Clone() for i in range(collection.GetGeometryCount())]
+        _state_borders[cache_key] = borders
+        return borders
+
+    # Compare cheap envelopes before intersecting state geometries.
+    states = [(f.GetGeometryRef(), f.GetGeometryRef().GetEnvelope()) for f in us_state_features]
+    collection = ogr.Geometry(ogr.wkbGeometryCollection)
+
+    for ((geom1, (xmin1, xmax1, ymin1, ymax1)), (geom2, (xmin2, xmax2, ymin2, ymax2))) in combinations(states, 2):
+        if xmin1 > xmax2 or xmin2 > xmax1 or ymin1 > ymax2 or ymin2 > ymax1:
+            continue
+
+        if geom1.Intersects(geom2):
+            collection.AddGeometry(geom1.Intersection(geom2))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temp_filename = mkstemp(dir=cache_dir, suffix='.wkb')
+
+    # Rename into place so concurrent renders never see a partial file.
+    with os.fdopen(handle, 'wb') as file:
+        file.write(collection.ExportToWkb())
+    os.rename(temp_filename, cache_filename)
+
+    borders = [collection.GetGeometryRef(i).Clone() for i in range(collection.GetGeometryCount())]
+    _state_borders[cache_key] = borders
+    return borders
+
 def stroke_features(ctx, features):
     '''
     '''
@@ -299,9 +369,15 @@ def first_layer_list(datasource):
     return list(datasource.GetLayer(0) if hasattr(datasource, 'GetLayer') else [])
 
 def open_datasources(area):
+    ''' Open geodata for an area, reusing features already opened in this process.
     '''
-    '''
-    geodata = join(dirname(__file__), 'geodata')
+    # World and Europe are drawn from the same datasources.
+    geodata_key = USA if area == USA else WORLD
+
+    if geodata_key in _geodata:
+        return _geodata[geodata_key]
+
+    geodata = GEODATA_DIR
 
     if area in (WORLD, EUROPE):
         landarea_ds = ogr.Open(join(geodata, 'ne_50m_admin_0_countries-54029.shp'))
@@ -337,19 +413,51 @@ def open_datasources(area):
     _datasources = landarea_ds, coastline_ds, lakes_ds, countries_ds, \
         countries_borders_ds, admin1s_ds, us_state_ds, us_county_ds
 
-    return (
+    _geodata[geodata_key] = (
         _datasources, landarea_features, coastline_features,
         lakes_features, countries_features, countries_borders_features,
         admin1s_features, us_state_features, us_county_features
         )
 
-def render_png(sources_dir, good_sources, width, resolution, filename, area):
+    return _geodata[geodata_key]
+
+def preload_geodata(areas):
+    ''' Open geodata and state borders for areas, e.g. before forking renders.
+
+        Forked processes inherit the features in _geodata and _state_borders
+        instead of each opening their own.
+    '''
+    for area in areas:
+        _, _, _, _, _, _, _, us_state_features, _ = open_datasources(area)
+        load_state_borders(area, us_state_features)
+
+def index_features(features, field_name):
+    ''' Get a dictionary of feature lists keyed by a string field value.
+    '''
+    index = defaultdict(list)
+
+    for feature in features:
+        index[feature.GetFieldAsString(field_name)].append(feature)
+
+    return index
+
+def select_features(index, keys):
+    ''' Get a list of indexed features with any of the given keys.
+    '''
+    return [feature for key in keys for feature in index.get(key, [])]
+
+def render_png(sources_dir, good_sources, width, resolution, filename, area, coverages=None):
     ''' Resolution: 1 for 100%, 2 for 200%, etc.
+
+        Optional coverages from load_coverages() can be shared between renders.
     '''
     # Load data
-    good_geoids, bad_geoids = load_geoids(sources_dir, good_sources)
-    good_iso3166s, bad_iso3166s = load_iso3166s(sources_dir, good_sources)
-    good_geometries, bad_geometries = load_geometries(sources_dir, good_sources, area)
+    if coverages is None:
+        coverages = load_coverages(sources_dir)
+
+    good_geoids, bad_geoids = load_geoids(sources_dir, good_sources, coverages)
+    good_iso3166s, bad_iso3166s = load_iso3166s(sources_dir, good_sources, coverages)
+    good_geometries, bad_geometries = load_geometries(sources_dir, good_sources, area, coverages)
 
     # Open datasources
     _datasources, landarea_features, coastline_features, lakes_features, \
@@ -357,22 +465,25 @@ def render_png(sources_dir, good_sources, width, resolution, filename, area):
         us_state_features, us_county_features = open_datasources(area)
 
     # Assign features to good or bad lists
-    good_data_states = [f for f in us_state_features if f.GetFieldAsString('GEOID') in good_geoids]
-    good_data_counties = [f for f in us_county_features if f.GetFieldAsString('GEOID') in good_geoids]
-    bad_data_states = [f for f in us_state_features if f.GetFieldAsString('GEOID') in bad_geoids]
-    bad_data_counties = [f for f in us_county_features if f.GetFieldAsString('GEOID') in bad_geoids]
-    good_data_countries = [f for f in countries_features if f.GetFieldAsString('iso_a2') in good_iso3166s]
-    good_data_admin1s = [f for f in admin1s_features if f.GetFieldAsString('iso_3166_2') in good_iso3166s]
-    bad_data_countries = [f for f in countries_features if f.GetFieldAsString('iso_a2') in bad_iso3166s]
-    bad_data_admin1s = [f for f in admin1s_features if f.GetFieldAsString('iso_3166_2') in bad_iso3166s]
+    states_index = index_features(us_state_features, 'GEOID')
+    counties_index = index_features(us_county_features, 'GEOID')
+    countries_index = index_features(countries_features, 'iso_a2')
+    admin1s_index = index_features(admin1s_features, 'iso_3166_2')
+
+    good_data_states = select_features(states_index, good_geoids)
+    good_data_counties = select_features(counties_index, good_geoids)
+    bad_data_states = select_features(states_index, bad_geoids)
+    bad_data_counties = select_features(counties_index, bad_geoids)
+    good_data_countries = select_features(countries_index, good_iso3166s)
+    good_data_admin1s = select_features(admin1s_index, good_iso3166s)
+    bad_data_countries = select_features(countries_index, bad_iso3166s)
+    bad_data_admin1s = select_features(admin1s_index, bad_iso3166s)
 
     # Prepare output surface
     surface, context, scale = make_context(width, resolution, area)
 
     # Draw each border between neighboring states exactly once.
-    state_borders = [s1.GetGeometryRef().Intersection(s2.GetGeometryRef())
-                     for (s1, s2) in combinations(us_state_features, 2)
-                     if s1.GetGeometryRef().Intersects(s2.GetGeometryRef())]
+    state_borders = load_state_borders(area, us_state_features)
 
     # Set up some colors
     silver = 0xdd/0xff, 0xdd/0xff, 0xdd/0xff
@@ -430,13 +541,16 @@ def _source_address_count(sources, paths):
     addr_counts = [int(sources[path].state.address_count or 0) for path in paths]
     return sum(addr_counts)
 
-def render_geojson(sources_dir, good_sources, filename, area):
-    '''
+def render_geojson(sources_dir, good_sources, filename, area, coverages=None):
+    ''' Optional coverages from load_coverages() can be shared between renders.
     '''
     # Load data
-    good_geoids, bad_geoids = load_geoids(sources_dir, good_sources)
-    good_iso3166s, bad_iso3166s = load_iso3166s(sources_dir, good_sources)
-    good_geometries, bad_geometries = load_geometries(sources_dir, good_sources, area)
+    if coverages is None:
+        coverages = load_coverages(sources_dir)
+
+    good_geoids, bad_geoids = load_geoids(sources_dir, good_sources, coverages)
+    good_iso3166s, bad_iso3166s = load_iso3166s(sources_dir, good_sources, coverages)
+    good_geometries, bad_geometries = load_geometries(sources_dir, good_sources, area, coverages)
 
     # Open datasources
     _datasources, landarea_features, coastline_features, lakes_features, \
@@ -446,11 +560,15 @@ def render_geojson(sources_dir, good_sources, filename, area):
     wgs84 = osr.SpatialReference(osr.SRS_WKT_WGS84)
     feature_strings = []
 
+    # Position of each good source, to list dates in good_sources order.
+    source_order = {path: index for (index, path) in enumerate(good_sources)}
+
     def append_feature_string(geom, name, status, paths, count, etc):
-        source_dates = [str(run.datetime_tz)
-                        for (path, run) in good_sources.items()
-                        if path in paths]
+        source_dates = [str(good_sources[path].datetime_tz)
+                        for path in sorted(set(paths) & source_order.keys(), key=source_order.get)]
 
+        # Transform a copy, leaving shared geodata features in map projection.
+        geom = geom.Clone()
         geom.TransformTo(wgs84)
         geom_str = geom.ExportToJson(options=['COORDINATE_PRECISION=4'])
 
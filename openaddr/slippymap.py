@@ -3,13 +3,18 @@ import logging; _L = logging.getLogger('openaddr.slippymap')
 
 from zipfile import ZipFile
 from io import TextIOWrapper
-from csv import DictReader
+from csv import reader
 from tempfile import gettempdir, mkstemp
 from argparse import ArgumentParser
 from urllib.parse import urlparse
-import os, subprocess, json
+from json.encoder import encode_basestring_ascii
+from math import isfinite
+import os, subprocess
 import requests
 
+# Characters of GeoJSON feature lines to collect before each write to Tippecanoe.
+WRITE_BATCH_SIZE = 4 * 1024 * 1024
+
 def generate(mbtiles_filename, *filenames_or_urls):
     '''
     '''
@@ -19,12 +24,13 @@ def generate(mbtiles_filename, *filenames_or_urls):
 
     tippecanoe = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=1)
 
-    for filename_or_url in filenames_or_urls:
-        src_filename = get_local_filename(filename_or_url)
+    def iterate_lines():
+        for filename_or_url in filenames_or_urls:
+            src_filename = get_local_filename(filename_or_url)
+            yield from iterate_file_feature_lines(src_filename)
 
-        for feature in iterate_file_features(src_filename):
-            tippecanoe.stdin.write(json.dumps(feature).encode('utf8'))
-            tippecanoe.stdin.write(b'\n')
+    for batch in iterate_line_batches(iterate_lines()):
+        tippecanoe.stdin.write(batch)
 
     tippecanoe.stdin.close()
     tippecanoe.wait()
@@ -52,13 +58,13 @@ def get_local_filename(filename_or_url):
 
     return filename
 
-def iterate_file_features(filename):
-    ''' Stream GeoJSON features from an input .csv or .zip file.
+def iterate_file_feature_lines(filename):
+    ''' Stream GeoJSON feature lines from an input .csv or .zip file.
     '''
     suffix = os.path.splitext(filename)[1].lower()
 
     if suffix == '.csv':
-        open_file = open(filename, 'r')
+        open_file = open(filename, 'r', newline='')
     elif suffix == '.zip':
         open_file = open(filename, 'rb')
 
@@ -68,19 +74,65 @@ def iterate_file_features(filename):
         elif suffix == '.zip':
             zip = ZipFile(file)
             csv_names = [name for name in zip.namelist() if name.endswith('.csv')]
-            csv_file = TextIOWrapper(zip.open(csv_names[0]))
-
-        for row in DictReader(csv_file):
-            try:
-                lon, lat = float(row['LON']), float(row['LAT'])
-            except:
-                continue
-
-            if -180 <= lon <= 180 and -90 <= lat <= 90:
-                geometry = dict(type='Point', coordinates=[lon, lat])
-                properties = {k: v for (k, v) in row.items() if k not in ('LON', 'LAT')}
-                feature = dict(type='Feature', geometry=geometry, properties=properties)
-                yield(feature)
+            csv_file = TextIOWrapper(zip.open(csv_names[0]), newline='')
+
+        yield from iterate_feature_lines(reader(csv_file), on_earth=True)
+
+def iterate_feature_lines(rows, on_earth=False):
+    ''' Generate GeoJSON point feature lines from CSV rows, header first.
+    '''
+    for (_, _, line) in iterate_feature_points(rows, on_earth):
+        yield line
+
+def iterate_feature_points(rows, on_earth=False):
+    ''' Generate (lon, lat, GeoJSON line) tuples for points in CSV rows, header first.
+
+        Lines have the same content as json.dumps() of equivalent features,
+        but are formatted from a template of property names made once
+        for the header. Points off the earth are skipped if on_earth is true.
+    '''
+    header = next(rows, None)
+
+    if not header or 'LON' not in header or 'LAT' not in header:
+        return
+
+    lon_index, lat_index = header.index('LON'), header.index('LAT')
+    names = [(index, encode_basestring_ascii(name) + ': ')
+             for (index, name) in enumerate(header) if name not in ('LON', 'LAT')]
+
+    for row in rows:
+        try:
+            lon, lat = float(row[lon_index]), float(row[lat_index])
+        except (ValueError, IndexError):
+            continue
+
+        if not (isfinite(lon) and isfinite(lat)):
+            continue
+
+        if on_earth and not (-180 <= lon <= 180 and -90 <= lat <= 90):
+            continue
+
+        properties = ', '.join([name + (encode_basestring_ascii(row[index]) if index < len(row) else 'null')
+                                for (index, name) in names])
+
+        yield lon, lat, ''.join(('{"type": "Feature", "geometry": {"type": "Point", "coordinates": [',
+                                 repr(lon), ', ', repr(lat), ']}, "properties": {', properties, '}}\n'))
+
+def iterate_line_batches(lines, size=WRITE_BATCH_SIZE):
+    ''' Generate UTF-8 encoded batches of about size characters from lines.
+    '''
+    batch, length = list(), 0
+
+    for line in lines:
+        batch.append(line)
+        length += len(line)
+
+        if length >= size:
+            yield ''.join(batch).encode('utf8')
+            batch, length = list(), 0
+
+    if batch:
+        yield ''.join(batch).encode('utf8')
 
 parser = ArgumentParser(description='Generate a single source slippy map MBTiles file with Tippecanoe.')
 
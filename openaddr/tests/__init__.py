@@ -1947,6 +1947,44 @@ class TestPackage (unittest.TestCase):
             self.assertEqual(local_processed_result2.run_state.processed, state3['processed'])
             self.assertEqual(local_processed_result2.run_state.license, state3['license'])
 
+    def test_iterate_local_processed_files_prefetch(self):
+        states = [{'processed': 'http://s3.amazonaws.com/openaddresses/{}.csv'.format(i)} for i in range(5)]
+        runs = [Run(i, 'sources/{}.json'.format(i), '___', b'', None, RunState(state),
+                    None, None, None, None, None, None, None, None)
+                for (i, state) in enumerate(states)]
+
+        downloaded = list()
+
+        def _download_processed_file(url):
+            handle, filename = tempfile.mkstemp(prefix='processed-', suffix='.csv')
+            os.write(handle, b'.' * 10)
+            close(handle)
+            downloaded.append(filename)
+            return filename
+
+        with mock.patch('openaddr.download_processed_file') as download_processed_file, \
+             mock.patch('openaddr.PREFETCH_DOWNLOADS', new=3), \
+             mock.patch('openaddr.PREFETCH_BYTES', new=15):
+            download_processed_file.side_effect = _download_processed_file
+            local_processed_files = iterate_local_processed_files(runs, sort_on='source_path')
+
+            result1 = next(local_processed_files)
+            self.assertEqual(result1.source_base, '0')
+            self.assertTrue(os.path.exists(result1.filename))
+            self.assertGreaterEqual(len(downloaded), 2, 'Should have downloaded ahead')
+            self.assertLessEqual(len(downloaded), 3, 'Should have stayed within lookahead')
+
+            result2 = next(local_processed_files)
+            self.assertEqual(result2.source_base, '1')
+            self.assertFalse(os.path.exists(result1.filename), 'Should have removed used file')
+
+            # Stop early, with some downloads still waiting.
+            local_processed_files.close()
+
+        self.assertLess(len(downloaded), 5)
+        for filename in downloaded:
+            self.assertFalse(os.path.exists(filename), 'Should have removed all files')
+
     def test_download_processed_file_csv(self):
         with mock.patch('openaddr.S3') as s3:
             fake_s3 = mock.MagicMock()
@@ -2017,7 +2055,7 @@ class FakeS3 (S3):
         S3.__init__(self, 'Fake Key', 'Fake Secret', 'data-test.openaddresses.io')
 
     def _write_fake_key(self, name, string):
-        with locked_open(self._fake_keys) as file, self._threadlock:
+        with self._threadlock, locked_open(self._fake_keys) as file:
             data = pickle.load(file)
             data[name] = string
 
@@ -2026,7 +2064,7 @@ class FakeS3 (S3):
             pickle.dump(data, file)
 
     def _read_fake_key(self, name):
-        with locked_open(self._fake_keys) as file, self._threadlock:
+        with self._threadlock, locked_open(self._fake_keys) as file:
             data = pickle.load(file)
 
         return data[name]
@@ -1,20 +1,22 @@
 # coding=utf8
 from __future__ import print_function
 
-from os import environ, remove, stat, close, utime
-from os.path import join, splitext
-from shutil import rmtree
+from os import environ, remove, stat, close, utime, mkdir
+from os.path import join, splitext, basename
+from shutil import rmtree, copyfile
 from tempfile import mkdtemp, mkstemp
 from urllib.parse import parse_qsl, urlparse, urljoin
 from base64 import b64decode, b64encode
 from datetime import timedelta, datetime
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_DEFLATED
 from io import BytesIO, StringIO
 from mock import patch
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 from uuid import uuid4
+from csv import DictReader
 
-import hmac, hashlib, mock, subprocess, gzip
+import hmac, hashlib, mock, subprocess, gzip, pickle, errno
 import unittest, json, os, sys, itertools, logging
 
 from flask import Flask
@@ -32,7 +34,9 @@ from ..ci import (
     is_merged_to_master, get_commit_info, HEARTBEAT_QUEUE, flush_heartbeat_queue,
     get_recent_workers, load_config, get_batch_run_times, webauth, webcoverage,
     process_github_payload, skip_payload, is_rerun_payload, update_job_comments,
-    reset_logger, CloudwatchHandler
+    reset_logger, CloudwatchHandler, db_listen, db_wait_for_notifies, drain_queue,
+    DequeueBatch, GithubCache, send_heartbeat, get_recent_heartbeats,
+    _render_and_upload_maps, _prepare_render_sources
     )
 
 from ..ci.objects import (
@@ -47,20 +51,26 @@ from ..ci.objects import (
 
 from ..ci.collect import (
     is_us_northeast, is_us_midwest, is_us_south, is_us_west, is_europe, is_asia,
-    is_south_america, is_north_america, add_source_to_zipfile, CollectorPublisher,
-    prepare_collections, add_csv_to_zipfile, write_to_s3, MULTIPART_CHUNK_SIZE
+    is_south_america, is_north_america, prepare_source, CollectorPublisher,
+    prepare_collections, add_csv_to_zipfile, write_to_s3, MULTIPART_CHUNK_SIZE,
+    collect_results, collect_previous_runs, load_previous_collections,
+    _copy_zipfile_member
     )
 
+from ..ci.mirror import ProcessedMirror, sync_mirror
+
 from ..ci.tileindex import (
-    iterate_runs_points, iterate_point_blocks, populate_tiles, lonlat_key, Tile, Point
+    iterate_runs_points, iterate_point_blocks, populate_tiles, lonlat_key, Tile, Point,
+    split_tiles, make_tile_manifest, point_quadkey, publish_tiles
     )
 
 from ..jobs import JOB_TIMEOUT
 from ..ci.work import make_source_filename, assemble_runstate, MAGIC_OK_MESSAGE
+from ..ci.queuedata import Heartbeat
 from ..ci.webhooks import apply_webhooks_blueprint
 from ..ci.webdotmap import apply_dotmap_blueprint
 from ..ci.webapi import apply_webapi_blueprint
-from .. import LocalProcessedResult
+from .. import LocalProcessedResult, iterate_local_processed_files, render
 from . import FakeS3
 
 def en64(bytes):
@@ -129,6 +139,10 @@ class TestObjects (unittest.TestCase):
         self.assertEqual(state.get('tests passed'), value)
         self.assertEqual(state.tests_passed, value)
 
+        # states are sent to map render processes
+        state = pickle.loads(pickle.dumps(RunState({'source': 'x.json', 'address count': 9})))
+        self.assertEqual(state.to_dict(), {'source': 'x.json', 'address count': 9})
+
     def test_add_job(self):
         ''' Check behavior of objects.add_job()
         '''
@@ -1012,9 +1026,12 @@ class TestAPI (unittest.TestCase):
         self.assertEqual(data['render_usa_url'], 'https://data.openaddresses.io/--/usa.png')
         self.assertEqual(data['render_geojson_url'], 'https://data.openaddresses.io/--/world.geojson')
 
-    def test_tile_redirects(self):
+    @patch('openaddr.ci.webapi.get_tile_manifest')
+    def test_tile_redirects(self, get_tile_manifest):
         '''
         '''
+        get_tile_manifest.return_value = dict()
+
         got1 = self.client.get('tiles/-123/37.zip')
         self.assertEqual(got1.status_code, 302)
         self.assertIn('tiles/-123.0/37.0.zip', got1.headers['location'])
@@ -1039,6 +1056,42 @@ class TestAPI (unittest.TestCase):
         got7 = self.client.get('tiles/-123/999.zip')
         self.assertEqual(got7.status_code, 404)
 
+    def test_tile_redirects_subtiles(self):
+        ''' Show that tile redirects go to the smallest subtile in the manifest.
+        '''
+        manifest = {'-123,37': ['', '2', '3', '30', '32']}
+
+        with patch.dict('openaddr.ci.webapi._tile_manifests', clear=True), \
+             patch('requests.get') as get:
+            get.return_value.json.return_value = manifest
+            got1 = self.client.get('tiles/-122.9/37.9.zip')
+            got2 = self.client.get('tiles/-122.1/37.9.zip')
+            got3 = self.client.get('tiles/-122.4/37.6.zip')
+            got4 = self.client.get('tiles/-122.1/37.1.zip')
+            got5 = self.client.get('tiles/-121.1/37.1.zip')
+
+        self.assertEqual(len(get.mock_calls) - len(get.return_value.mock_calls), 1,
+                         'Manifest should be requested just once')
+        self.assertEqual(get.mock_calls[0][1][0], 'https://data.openaddresses.io/tiles/manifest.json')
+
+        self.assertEqual(got1.status_code, 302)
+        self.assertIn('tiles/-123.0/37.0/2.zip', got1.headers['location'])
+        self.assertIn('tiles/-123.0/37.0/3.zip', got2.headers['location'])
+        self.assertIn('tiles/-123.0/37.0/30.zip', got3.headers['location'])
+        self.assertIn('tiles/-123.0/37.0.zip', got4.headers['location'])
+        self.assertIn('tiles/-122.0/37.0.zip', got5.headers['location'])
+
+    def test_tile_redirects_no_manifest(self):
+        ''' Show that tile redirects fall back to whole tiles without a manifest.
+        '''
+        with patch.dict('openaddr.ci.webapi._tile_manifests', clear=True), \
+             patch('requests.get') as get:
+            get.side_effect = ConnectionError('Nope')
+            got1 = self.client.get('tiles/-122.9/37.9.zip')
+
+        self.assertEqual(got1.status_code, 302)
+        self.assertIn('tiles/-123.0/37.0.zip', got1.headers['location'])
+
 class TestAuth (unittest.TestCase):
 
     def test_serializer(self):
@@ -3192,6 +3245,74 @@ class TestWorker (unittest.TestCase):
         self.assertIsNone(result['state'].processed)
         self.assertEqual(result['state'].run_id, -1)
 
+    @patch('openaddr.ci.work.MULTIPART_THRESHOLD', new=10)
+    @patch('openaddr.ci.work.MULTIPART_CHUNK_SIZE', new=4)
+    def test_upload_file_multipart(self):
+        ''' Show that large files are uploaded in parts with a local MD5 hash.
+        '''
+        s3 = mock.Mock()
+        s3.new_key.return_value.name = 'a-key'
+        s3.new_key.return_value.bucket.name = 'a-bucket'
+        upload = s3.bucket.initiate_multipart_upload.return_value
+
+        filename = join(self.output_dir, 'data.zip')
+        with open(filename, 'wb') as file:
+            file.write(b'0123456789ab')
+
+        url, hash = work.upload_file(s3, '/runs/1/data.zip', filename)
+
+        self.assertEqual(url, 'https://s3.amazonaws.com/a-bucket/a-key')
+        self.assertEqual(hash, hashlib.md5(b'0123456789ab').hexdigest())
+        self.assertEqual(s3.bucket.initiate_multipart_upload.mock_calls[0][1], ('/runs/1/data.zip', ))
+        self.assertEqual(s3.bucket.initiate_multipart_upload.mock_calls[0][2]['headers'],
+                         {'Content-Type': 'application/zip'})
+
+        parts = upload.upload_part_from_file.mock_calls
+        self.assertEqual([call[2]['part_num'] for call in parts], [1, 2, 3])
+        self.assertEqual([call[1][0].getvalue() for call in parts], [b'0123', b'4567', b'89ab'])
+        self.assertEqual(len(upload.complete_upload.mock_calls), 1)
+        self.assertEqual(len(upload.cancel_upload.mock_calls), 0)
+
+        # A failed part cancels the whole upload.
+        upload.upload_part_from_file.side_effect = IOError('Bad part')
+
+        with self.assertRaises(IOError):
+            work.upload_file(s3, '/runs/1/data.zip', filename)
+
+        self.assertEqual(len(upload.cancel_upload.mock_calls), 1)
+
+    def test_work_progress(self):
+        ''' Show that WorkProgress counts downloaded bytes and converted rows.
+        '''
+        download_dir = join(self.output_dir, 'work-x/out/process_one-x/cache-x/http')
+        conform_dir = join(self.output_dir, 'work-x/out/process_one-x/conform-x')
+        os.makedirs(download_dir)
+        os.makedirs(conform_dir)
+
+        with open(join(download_dir, 'data.zip'), 'wb') as file:
+            file.write(b'.' * 1000)
+
+        with open(join(conform_dir, 'out.csv'), 'w') as file:
+            file.write('X,Y\n1,2\n3,4\n')
+
+        progress = work.WorkProgress('xx/f', self.output_dir)
+        progress.update()
+
+        self.assertEqual(progress.bytes_downloaded, 1000)
+        self.assertEqual(progress.rows_processed, 2)
+
+        with open(join(conform_dir, 'out.csv'), 'a') as file:
+            file.write('5,6\n')
+
+        progress.update()
+        self.assertEqual(progress.rows_processed, 3)
+
+        # Progress does not go backwards when the job cleans up after itself.
+        rmtree(join(self.output_dir, 'work-x'))
+        progress.update()
+        self.assertEqual(progress.bytes_downloaded, 1000)
+        self.assertEqual(progress.rows_processed, 3)
+
 class TestBatch (unittest.TestCase):
 
     def setUp(self):
@@ -3213,6 +3334,7 @@ class TestBatch (unittest.TestCase):
         self.github_auth = config['GITHUB_AUTH']
 
         self.request_index = 0
+        self.failed_paths = set()
 
     def tearDown(self):
         '''
@@ -3257,48 +3379,52 @@ class TestBatch (unittest.TestCase):
             data = u'''{\r  "sha": "8dd262c2f30a70b27e371869c54315b1abc32247",\r  "commit": {\r    "author": {\r      "name": "migurski",\r      "email": "mike-github@teczno.com",\r      "date": "2015-06-27T22:55:38Z"\r    },\r    "committer": {\r      "name": "migurski",\r      "email": "mike-github@teczno.com",\r      "date": "2015-06-27T22:55:38Z"\r    },\r    "message": "Merge pull request #4 from migurski/master\\n\\nAdded La Réunion",\r    "tree": {\r      "sha": "55f5da58da7b14f02da8f1214fd72d1bc8f02ba3",\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/55f5da58da7b14f02da8f1214fd72d1bc8f02ba3"\r    },\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/commits/8dd262c2f30a70b27e371869c54315b1abc32247",\r    "comment_count": 0\r  },\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/commits/8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/commit/8dd262c2f30a70b27e371869c54315b1abc32247",\r  "comments_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/commits/8dd262c2f30a70b27e371869c54315b1abc32247/comments",\r  "author": {\r    "login": "migurski",\r    "id": 58730,\r    "avatar_url": "https://avatars.githubusercontent.com/u/58730?v=3",\r    "gravatar_id": "",\r    "url": "https://api.github.com/users/migurski",\r    "html_url": "https://github.com/migurski",\r    "followers_url": "https://api.github.com/users/migurski/followers",\r    "following_url": "https://api.github.com/users/migurski/following{/other_user}",\r    "gists_url": "https://api.github.com/users/migurski/gists{/gist_id}",\r    "starred_url": "https://api.github.com/users/migurski/starred{/owner}{/repo}",\r    "subscriptions_url": "https://api.github.com/users/migurski/subscriptions",\r    "organizations_url": "https://api.github.com/users/migurski/orgs",\r    "repos_url": "https://api.github.com/users/migurski/repos",\r    "events_url": "https://api.github.com/users/migurski/events{/privacy}",\r    "received_events_url": "https://api.github.com/users/migurski/received_events",\r    "type": "User",\r    "site_admin": false\r  },\r  "committer": {\r    "login": "migurski",\r    "id": 58730,\r    "avatar_url": "https://avatars.githubusercontent.com/u/58730?v=3",\r    "gravatar_id": "",\r    "url": "https://api.github.com/users/migurski",\r    "html_url": "https://github.com/migurski",\r    "followers_url": "https://api.github.com/users/migurski/followers",\r    "following_url": "https://api.github.com/users/migurski/following{/other_user}",\r    "gists_url": "https://api.github.com/users/migurski/gists{/gist_id}",\r    "starred_url": "https://api.github.com/users/migurski/starred{/owner}{/repo}",\r    "subscriptions_url": "https://api.github.com/users/migurski/subscriptions",\r    "organizations_url": "https://api.github.com/users/migurski/orgs",\r    "repos_url": "https://api.github.com/users/migurski/repos",\r    "events_url": "https://api.github.com/users/migurski/events{/privacy}",\r    "received_events_url": "https://api.github.com/users/migurski/received_events",\r    "type": "User",\r    "site_admin": false\r  },\r  "parents": [\r    {\r      "sha": "c3c7de37f96d38534dc6297a2483c218994241b6",\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/commits/c3c7de37f96d38534dc6297a2483c218994241b6",\r      "html_url": "https://github.com/openaddresses/hooked-on-sources/commit/c3c7de37f96d38534dc6297a2483c218994241b6"\r    },\r    {\r      "sha": "6460668909a85d9db8df871d91e9b25bc5192add",\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/commits/6460668909a85d9db8df871d91e9b25bc5192add",\r      "html_url": "https://github.com/openaddresses/hooked-on-sources/commit/6460668909a85d9db8df871d91e9b25bc5192add"\r    }\r  ],\r  "stats": {\r    "total": 23,\r    "additions": 23,\r    "deletions": 0\r  },\r  "files": [\r    {\r      "sha": "a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r      "filename": "sources/fr/la-réunion.json",\r      "status": "added",\r      "additions": 23,\r      "deletions": 0,\r      "changes": 23,\r      "blob_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r      "raw_url": "https://github.com/openaddresses/hooked-on-sources/raw/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r      "contents_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "patch": "@@ -0,0 +1,23 @@\\n+{\\n+    \\"coverage\\": {\\n+        \\"ISO 3166\\": {\\n+            \\"alpha2\\": \\"FR-974\\"\\n+        }\\n+    },\\n+    \\"website\\": \\"http://adresse.data.gouv.fr/download/\\",\\n+    \\"note\\": \\"Downloaded and cached 2015-06-18\\",\\n+    \\"data\\": \\"https://data.openaddresses.io/cache/fr/BAN_licence_gratuite_repartage_974.zip\\",\\n+    \\"type\\": \\"http\\",\\n+    \\"compression\\": \\"zip\\",\\n+    \\"conform\\": {\\n+        \\"type\\": \\"csv\\",\\n+        \\"csvsplit\\": \\";\\",\\n+        \\"number\\": \\"numero\\",\\n+        \\"street\\": \\"nom_voie\\",\\n+        \\"lon\\": \\"lon\\",\\n+        \\"lat\\": \\"lat\\",\\n+        \\"city\\": \\"nom_commune\\",\\n+        \\"postcode\\": \\"code_post\\",\\n+        \\"encoding\\": \\"ISO-8859-1\\"\\n+    }\\n+}\\n\\\\ No newline at end of file"\r    }\r  ]\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources') and query.get('ref', '').startswith('8dd262'):
-            data = u'''[\r  {\r    "name": "fr",\r    "path": "sources/fr",\r    "sha": "6dbcdcdb66c96a597e6a9c0cd8becd50697a1455",\r    "size": 0,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/tree/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/6dbcdcdb66c96a597e6a9c0cd8becd50697a1455",\r    "download_url": null,\r    "type": "dir",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/6dbcdcdb66c96a597e6a9c0cd8becd50697a1455",\r      "html": "https://github.com/openaddresses/hooked-on-sources/tree/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr"\r    }\r  },\r  {\r    "name": "us-ca-alameda_county.json",\r    "path": "sources/us-ca-alameda_county.json",\r    "sha": "c9cd0ed30256ae64d5924b03b0423346501b92d8",\r    "size": 745,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-alameda_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-alameda_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json"\r    }\r  },\r  {\r    "name": "us-ca-berkeley.json",\r    "path": "sources/us-ca-berkeley.json",\r    "sha": "16464c39b59b5a09c6526da3afa9a5f57caabcad",\r    "size": 779,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-berkeley.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-berkeley.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json"\r    }\r  },\r  {\r    "name": "us-ca-contra_costa_county.json",\r    "path": "sources/us-ca-contra_costa_county.json",\r    "sha": "8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r    "size": 902,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-contra_costa_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-contra_costa_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json"\r    }\r  },\r  {\r    "name": "us-ca-nevada_county.json",\r    "path": "sources/us-ca-nevada_county.json",\r    "sha": "2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r    "size": 659,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-nevada_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-nevada_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json"\r    }\r  },\r  {\r    "name": "us-ca-san_francisco.json",\r    "path": "sources/us-ca-san_francisco.json",\r    "sha": "cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r    "size": 519,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-san_francisco.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-san_francisco.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json"\r    }\r  }\r]'''
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/trees/55f5da58da7b14f02da8f1214fd72d1bc8f02ba3') and query.get('recursive') == '1':
+            data = u'''{\r  "sha": "55f5da58da7b14f02da8f1214fd72d1bc8f02ba3",\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/55f5da58da7b14f02da8f1214fd72d1bc8f02ba3",\r  "tree": [\r    {\r      "path": "README.md",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "c7a2c2ac2ef8ee4a8d1ae46f3a3c9f4ea2b6c0a1",\r      "size": 17,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c7a2c2ac2ef8ee4a8d1ae46f3a3c9f4ea2b6c0a1"\r    },\r    {\r      "path": "sources",\r      "mode": "040000",\r      "type": "tree",\r      "sha": "bd2f7ea0e0dcb9bf2b4c7d5ed81ba2e4c2b6c3c5",\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/bd2f7ea0e0dcb9bf2b4c7d5ed81ba2e4c2b6c3c5"\r    },\r    {\r      "path": "sources/README.txt",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391",\r      "size": 0,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"\r    },\r    {\r      "path": "sources/fr",\r      "mode": "040000",\r      "type": "tree",\r      "sha": "6dbcdcdb66c96a597e6a9c0cd8becd50697a1455",\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/trees/6dbcdcdb66c96a597e6a9c0cd8becd50697a1455"\r    },\r    {\r      "path": "sources/fr/la-réunion.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r      "size": 603,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9"\r    },\r    {\r      "path": "sources/us-ca-alameda_county.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "c9cd0ed30256ae64d5924b03b0423346501b92d8",\r      "size": 745,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8"\r    },\r    {\r      "path": "sources/us-ca-berkeley.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "16464c39b59b5a09c6526da3afa9a5f57caabcad",\r      "size": 779,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad"\r    },\r    {\r      "path": "sources/us-ca-contra_costa_county.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r      "size": 902,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c"\r    },\r    {\r      "path": "sources/us-ca-nevada_county.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r      "size": 659,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9"\r    },\r    {\r      "path": "sources/us-ca-san_francisco.json",\r      "mode": "100644",\r      "type": "blob",\r      "sha": "cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r      "size": 519,\r      "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff"\r    }\r  ],\r  "truncated": false\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/fr') and query.get('ref', '').startswith('8dd262'):
-            data = u'''[\r  {\r    "name": "la-réunion.json",\r    "path": "sources/fr/la-réunion.json",\r    "sha": "a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r    "size": 603,\r    "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r    "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r    "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r    "type": "file",\r    "_links": {\r      "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r      "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r      "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json"\r    }\r  }\r]'''
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c'):
+            data = u'''{\r  "sha": "8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r  "size": 902,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjAxMyIsCiAgICAgICAgICAgICJuYW1l\\nIjogIkNvbnRyYSBDb3N0YSBDb3VudHkiLAogICAgICAgICAgICAic3RhdGUi\\nOiAiQ2FsaWZvcm5pYSIKICAgICAgICB9LAogICAgICAgICJjb3VudHJ5Ijog\\nInVzIiwKICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjb3VudHki\\nOiAiQ29udHJhIENvc3RhIgogICAgfSwKICAgICJkYXRhIjogImh0dHA6Ly93\\nd3cuY2NtYXAudXMvZG93bmxvYWQvbWFpbi5hc3A/aWRQcm9kdWN0PTEzNDQ5\\nMiIsCiAgICAid2Vic2l0ZSI6ICJodHRwOi8vd3d3LmNjbWFwLnVzL2NhdGFs\\nb2cuYXNwP1VzZXJDaG9pY2U9MSZMYXllcmNudHJsPTAwMDAwMDAwMDAwMDAw\\nMDAwMDAwMDAjMSIsCiAgICAibGljZW5zZSI6ICJodHRwOi8vd3d3LmNjbWFw\\nLnVzL2luZm9ybWF0aW9uLmFzcCIsCiAgICAiYXR0cmlidXRpb24iOiAiQ29u\\ndHJhIENvc3RhIENvdW50eSIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJj\\nb21wcmVzc2lvbiI6ICJ6aXAiLAogICAgInllYXIiOiAiMjAxNCIsCiAgICAi\\nbm90ZSI6ICJEZXRhaWxzIGZvciB0aGUgZGF0YXNldCAoZWcsIHByb2plY3Rp\\nb24pIGNhbiBiZSBmb3VuZCBoZXJlIGh0dHA6Ly93d3cuY2NtYXAudXMvRGV0\\nYWlscy5hc3A/UHJvZHVjdD0xMzQ0OTIiLAogICAgImNvbmZvcm0iOiB7CiAg\\nICAgICAgImxvbiI6ICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAg\\nICJudW1iZXIiOiAiU19TVFJfTkJSIiwKICAgICAgICAibWVyZ2UiOiBbIlNf\\nU1RSX05NIiwgIlNfU1RSX1NVRiJdLAogICAgICAgICJzdHJlZXQiOiAiYXV0\\nb19zdHJlZXQiLAogICAgICAgICJ0eXBlIjogInNoYXBlZmlsZSIKICAgIH0K\\nfQo=\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-contra_costa_county.json') and query.get('ref', '').startswith('8dd262'):
-            data = u'''{\r  "name": "us-ca-contra_costa_county.json",\r  "path": "sources/us-ca-contra_costa_county.json",\r  "sha": "8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r  "size": 902,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-contra_costa_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjAxMyIsCiAgICAgICAgICAgICJuYW1l\\nIjogIkNvbnRyYSBDb3N0YSBDb3VudHkiLAogICAgICAgICAgICAic3RhdGUi\\nOiAiQ2FsaWZvcm5pYSIKICAgICAgICB9LAogICAgICAgICJjb3VudHJ5Ijog\\nInVzIiwKICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjb3VudHki\\nOiAiQ29udHJhIENvc3RhIgogICAgfSwKICAgICJkYXRhIjogImh0dHA6Ly93\\nd3cuY2NtYXAudXMvZG93bmxvYWQvbWFpbi5hc3A/aWRQcm9kdWN0PTEzNDQ5\\nMiIsCiAgICAid2Vic2l0ZSI6ICJodHRwOi8vd3d3LmNjbWFwLnVzL2NhdGFs\\nb2cuYXNwP1VzZXJDaG9pY2U9MSZMYXllcmNudHJsPTAwMDAwMDAwMDAwMDAw\\nMDAwMDAwMDAjMSIsCiAgICAibGljZW5zZSI6ICJodHRwOi8vd3d3LmNjbWFw\\nLnVzL2luZm9ybWF0aW9uLmFzcCIsCiAgICAiYXR0cmlidXRpb24iOiAiQ29u\\ndHJhIENvc3RhIENvdW50eSIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJj\\nb21wcmVzc2lvbiI6ICJ6aXAiLAogICAgInllYXIiOiAiMjAxNCIsCiAgICAi\\nbm90ZSI6ICJEZXRhaWxzIGZvciB0aGUgZGF0YXNldCAoZWcsIHByb2plY3Rp\\nb24pIGNhbiBiZSBmb3VuZCBoZXJlIGh0dHA6Ly93d3cuY2NtYXAudXMvRGV0\\nYWlscy5hc3A/UHJvZHVjdD0xMzQ0OTIiLAogICAgImNvbmZvcm0iOiB7CiAg\\nICAgICAgImxvbiI6ICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAg\\nICJudW1iZXIiOiAiU19TVFJfTkJSIiwKICAgICAgICAibWVyZ2UiOiBbIlNf\\nU1RSX05NIiwgIlNfU1RSX1NVRiJdLAogICAgICAgICJzdHJlZXQiOiAiYXV0\\nb19zdHJlZXQiLAogICAgICAgICJ0eXBlIjogInNoYXBlZmlsZSIKICAgIH0K\\nfQo=\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-contra_costa_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/8010fecfae4eac9187e9e6a5c8f7dfcb2534e17c",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-contra_costa_county.json"\r  }\r}'''
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad'):
+            data = u'''{\r  "sha": "16464c39b59b5a09c6526da3afa9a5f57caabcad",\r  "size": 779,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjA2MDAwIiwKICAgICAgICAgICAgInBs\\nYWNlIjogIkJlcmtlbGV5IiwKICAgICAgICAgICAgInN0YXRlIjogIkNhbGlm\\nb3JuaWEiCiAgICAgICAgfSwKICAgICAgICAiY291bnRyeSI6ICJ1cyIsCiAg\\nICAgICAgInN0YXRlIjogImNhIiwKICAgICAgICAicGxhY2UiOiAiQmVya2Vs\\nZXkiCiAgICB9LAogICAgImF0dHJpYnV0aW9uIjogIkNpdHkgb2YgQmVya2Vs\\nZXkiLAogICAgImRhdGEiOiAiaHR0cDovL3d3dy5jaS5iZXJrZWxleS5jYS51\\ncy91cGxvYWRlZEZpbGVzL0lUL0dJUy9QYXJjZWxzLnppcCIsCiAgICAid2Vi\\nc2l0ZSI6ICJodHRwOi8vd3d3LmNpLmJlcmtlbGV5LmNhLnVzL2RhdGFjYXRh\\nbG9nLyIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJjb21wcmVzc2lvbiI6\\nICJ6aXAiLAogICAgIm5vdGUiOiAiTWV0YWRhdGEgYXQgaHR0cDovL3d3dy5j\\naS5iZXJrZWxleS5jYS51cy91cGxvYWRlZEZpbGVzL0lUL0dJUy9QYXJjZWxz\\nLnNocCgxKS54bWwiLAogICAgImNvbmZvcm0iOiB7CiAgICAgICAgImxvbiI6\\nICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1iZXIiOiAi\\nU3RyZWV0TnVtIiwKICAgICAgICAibWVyZ2UiOiBbIlN0cmVldE5hbWUiLCAi\\nU3RyZWV0U3VmeCIsICJEaXJlY3Rpb24iXSwKICAgICAgICAic3RyZWV0Ijog\\nImF1dG9fc3RyZWV0IiwKICAgICAgICAidHlwZSI6ICJzaGFwZWZpbGUtcG9s\\neWdvbiIKICAgIH0KfQo=\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-berkeley.json') and query.get('ref', '').startswith('8dd262'):
-            data = u'''{\r  "name": "us-ca-berkeley.json",\r  "path": "sources/us-ca-berkeley.json",\r  "sha": "16464c39b59b5a09c6526da3afa9a5f57caabcad",\r  "size": 779,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-berkeley.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjA2MDAwIiwKICAgICAgICAgICAgInBs\\nYWNlIjogIkJlcmtlbGV5IiwKICAgICAgICAgICAgInN0YXRlIjogIkNhbGlm\\nb3JuaWEiCiAgICAgICAgfSwKICAgICAgICAiY291bnRyeSI6ICJ1cyIsCiAg\\nICAgICAgInN0YXRlIjogImNhIiwKICAgICAgICAicGxhY2UiOiAiQmVya2Vs\\nZXkiCiAgICB9LAogICAgImF0dHJpYnV0aW9uIjogIkNpdHkgb2YgQmVya2Vs\\nZXkiLAogICAgImRhdGEiOiAiaHR0cDovL3d3dy5jaS5iZXJrZWxleS5jYS51\\ncy91cGxvYWRlZEZpbGVzL0lUL0dJUy9QYXJjZWxzLnppcCIsCiAgICAid2Vi\\nc2l0ZSI6ICJodHRwOi8vd3d3LmNpLmJlcmtlbGV5LmNhLnVzL2RhdGFjYXRh\\nbG9nLyIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJjb21wcmVzc2lvbiI6\\nICJ6aXAiLAogICAgIm5vdGUiOiAiTWV0YWRhdGEgYXQgaHR0cDovL3d3dy5j\\naS5iZXJrZWxleS5jYS51cy91cGxvYWRlZEZpbGVzL0lUL0dJUy9QYXJjZWxz\\nLnNocCgxKS54bWwiLAogICAgImNvbmZvcm0iOiB7CiAgICAgICAgImxvbiI6\\nICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1iZXIiOiAi\\nU3RyZWV0TnVtIiwKICAgICAgICAibWVyZ2UiOiBbIlN0cmVldE5hbWUiLCAi\\nU3RyZWV0U3VmeCIsICJEaXJlY3Rpb24iXSwKICAgICAgICAic3RyZWV0Ijog\\nImF1dG9fc3RyZWV0IiwKICAgICAgICAidHlwZSI6ICJzaGFwZWZpbGUtcG9s\\neWdvbiIKICAgIH0KfQo=\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-berkeley.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/16464c39b59b5a09c6526da3afa9a5f57caabcad",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-berkeley.json"\r  }\r}'''
-            return response(200, data.encode('utf8'), headers=response_headers)
-
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-alameda_county.json') and query.get('ref', '').startswith('8dd262'):
-            if self.request_index % 2:
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8'):
+            if url.path not in self.failed_paths:
+                # Fail once per blob to exercise retries from parallel requests.
+                self.failed_paths.add(url.path)
                 raise ConnectionError('Something-or-other went wrong')
 
-            data = u'''{\r  "name": "us-ca-alameda_county.json",\r  "path": "sources/us-ca-alameda_county.json",\r  "sha": "c9cd0ed30256ae64d5924b03b0423346501b92d8",\r  "size": 745,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-alameda_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjAwMSIsCiAgICAgICAgICAgICJuYW1l\\nIjogIkFsYW1lZGEgQ291bnR5IiwKICAgICAgICAgICAgInN0YXRlIjogIkNh\\nbGlmb3JuaWEiCiAgICAgICAgfSwKICAgICAgICAiY291bnRyeSI6ICJ1cyIs\\nCiAgICAgICAgInN0YXRlIjogImNhIiwKICAgICAgICAiY291bnR5IjogIkFs\\nYW1lZGEiCiAgICB9LAogICAgImRhdGEiOiAiaHR0cHM6Ly9kYXRhLmFjZ292\\nLm9yZy9hcGkvZ2Vvc3BhdGlhbC84ZTRzLTdmNHY/bWV0aG9kPWV4cG9ydCZm\\nb3JtYXQ9T3JpZ2luYWwiLAogICAgImxpY2Vuc2UiOiAiaHR0cDovL3d3dy5h\\nY2dvdi5vcmcvYWNkYXRhL3Rlcm1zLmh0bSIsCiAgICAiYXR0cmlidXRpb24i\\nOiAiQWxhbWVkYSBDb3VudHkiLAogICAgInllYXIiOiAiIiwKICAgICJ0eXBl\\nIjogImh0dHAiLAogICAgImNvbXByZXNzaW9uIjogInppcCIsCiAgICAiY29u\\nZm9ybSI6IHsKICAgICAgICAibWVyZ2UiOiBbCiAgICAgICAgICAgICJmZWFu\\nbWUiLAogICAgICAgICAgICAiZmVhdHlwIgogICAgICAgIF0sCiAgICAgICAg\\nImxvbiI6ICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1i\\nZXIiOiAic3RfbnVtIiwKICAgICAgICAic3RyZWV0IjogImF1dG9fc3RyZWV0\\nIiwKICAgICAgICAidHlwZSI6ICJzaGFwZWZpbGUiLAogICAgICAgICJwb3N0\\nY29kZSI6ICJ6aXBjb2RlIgogICAgfQp9Cg==\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-alameda_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-alameda_county.json"\r  }\r}'''
+            data = u'''{\r  "sha": "c9cd0ed30256ae64d5924b03b0423346501b92d8",\r  "size": 745,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/c9cd0ed30256ae64d5924b03b0423346501b92d8",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjAwMSIsCiAgICAgICAgICAgICJuYW1l\\nIjogIkFsYW1lZGEgQ291bnR5IiwKICAgICAgICAgICAgInN0YXRlIjogIkNh\\nbGlmb3JuaWEiCiAgICAgICAgfSwKICAgICAgICAiY291bnRyeSI6ICJ1cyIs\\nCiAgICAgICAgInN0YXRlIjogImNhIiwKICAgICAgICAiY291bnR5IjogIkFs\\nYW1lZGEiCiAgICB9LAogICAgImRhdGEiOiAiaHR0cHM6Ly9kYXRhLmFjZ292\\nLm9yZy9hcGkvZ2Vvc3BhdGlhbC84ZTRzLTdmNHY/bWV0aG9kPWV4cG9ydCZm\\nb3JtYXQ9T3JpZ2luYWwiLAogICAgImxpY2Vuc2UiOiAiaHR0cDovL3d3dy5h\\nY2dvdi5vcmcvYWNkYXRhL3Rlcm1zLmh0bSIsCiAgICAiYXR0cmlidXRpb24i\\nOiAiQWxhbWVkYSBDb3VudHkiLAogICAgInllYXIiOiAiIiwKICAgICJ0eXBl\\nIjogImh0dHAiLAogICAgImNvbXByZXNzaW9uIjogInppcCIsCiAgICAiY29u\\nZm9ybSI6IHsKICAgICAgICAibWVyZ2UiOiBbCiAgICAgICAgICAgICJmZWFu\\nbWUiLAogICAgICAgICAgICAiZmVhdHlwIgogICAgICAgIF0sCiAgICAgICAg\\nImxvbiI6ICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1i\\nZXIiOiAic3RfbnVtIiwKICAgICAgICAic3RyZWV0IjogImF1dG9fc3RyZWV0\\nIiwKICAgICAgICAidHlwZSI6ICJzaGFwZWZpbGUiLAogICAgICAgICJwb3N0\\nY29kZSI6ICJ6aXBjb2RlIgogICAgfQp9Cg==\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json') and query.get('ref', '').startswith('8dd262'):
-            if self.request_index % 2:
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9'):
+            if url.path not in self.failed_paths:
+                # Fail once per blob to exercise retries from parallel requests.
+                self.failed_paths.add(url.path)
                 raise ConnectionError('Something-or-other went wrong')
 
-            data = u'''{\r  "name": "la-réunion.json",\r  "path": "sources/fr/la-réunion.json",\r  "sha": "a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r  "size": 603,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJJU08gMzE2NiI6IHsKICAg\\nICAgICAgICAgImFscGhhMiI6ICJGUi05NzQiCiAgICAgICAgfQogICAgfSwK\\nICAgICJ3ZWJzaXRlIjogImh0dHA6Ly9hZHJlc3NlLmRhdGEuZ291di5mci9k\\nb3dubG9hZC8iLAogICAgIm5vdGUiOiAiRG93bmxvYWRlZCBhbmQgY2FjaGVk\\nIDIwMTUtMDYtMTgiLAogICAgImRhdGEiOiAiaHR0cDovL2RhdGEub3BlbmFk\\nZHJlc3Nlcy5pby9jYWNoZS9mci9CQU5fbGljZW5jZV9ncmF0dWl0ZV9yZXBh\\ncnRhZ2VfOTc0LnppcCIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJjb21w\\ncmVzc2lvbiI6ICJ6aXAiLAogICAgImNvbmZvcm0iOiB7CiAgICAgICAgInR5\\ncGUiOiAiY3N2IiwKICAgICAgICAiY3N2c3BsaXQiOiAiOyIsCiAgICAgICAg\\nIm51bWJlciI6ICJudW1lcm8iLAogICAgICAgICJzdHJlZXQiOiAibm9tX3Zv\\naWUiLAogICAgICAgICJsb24iOiAibG9uIiwKICAgICAgICAibGF0IjogImxh\\ndCIsCiAgICAgICAgImNpdHkiOiAibm9tX2NvbW11bmUiLAogICAgICAgICJw\\nb3N0Y29kZSI6ICJjb2RlX3Bvc3QiLAogICAgICAgICJlbmNvZGluZyI6ICJJ\\nU08tODg1OS0xIgogICAgfQp9\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/fr/la-r%C3%A9union.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/fr/la-r%C3%A9union.json"\r  }\r}'''
+            data = u'''{\r  "sha": "a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r  "size": 603,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJJU08gMzE2NiI6IHsKICAg\\nICAgICAgICAgImFscGhhMiI6ICJGUi05NzQiCiAgICAgICAgfQogICAgfSwK\\nICAgICJ3ZWJzaXRlIjogImh0dHA6Ly9hZHJlc3NlLmRhdGEuZ291di5mci9k\\nb3dubG9hZC8iLAogICAgIm5vdGUiOiAiRG93bmxvYWRlZCBhbmQgY2FjaGVk\\nIDIwMTUtMDYtMTgiLAogICAgImRhdGEiOiAiaHR0cDovL2RhdGEub3BlbmFk\\nZHJlc3Nlcy5pby9jYWNoZS9mci9CQU5fbGljZW5jZV9ncmF0dWl0ZV9yZXBh\\ncnRhZ2VfOTc0LnppcCIsCiAgICAidHlwZSI6ICJodHRwIiwKICAgICJjb21w\\ncmVzc2lvbiI6ICJ6aXAiLAogICAgImNvbmZvcm0iOiB7CiAgICAgICAgInR5\\ncGUiOiAiY3N2IiwKICAgICAgICAiY3N2c3BsaXQiOiAiOyIsCiAgICAgICAg\\nIm51bWJlciI6ICJudW1lcm8iLAogICAgICAgICJzdHJlZXQiOiAibm9tX3Zv\\naWUiLAogICAgICAgICJsb24iOiAibG9uIiwKICAgICAgICAibGF0IjogImxh\\ndCIsCiAgICAgICAgImNpdHkiOiAibm9tX2NvbW11bmUiLAogICAgICAgICJw\\nb3N0Y29kZSI6ICJjb2RlX3Bvc3QiLAogICAgICAgICJlbmNvZGluZyI6ICJJ\\nU08tODg1OS0xIgogICAgfQp9\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-san_francisco.json') and query.get('ref', '').startswith('8dd262'):
-            if self.request_index % 2:
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff'):
+            if url.path not in self.failed_paths:
+                # Fail once per blob to exercise retries from parallel requests.
+                self.failed_paths.add(url.path)
                 raise ConnectionError('Something-or-other went wrong')
 
-            data = u'''{\r  "name": "us-ca-san_francisco.json",\r  "path": "sources/us-ca-san_francisco.json",\r  "sha": "cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r  "size": 519,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-san_francisco.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJjb3VudHJ5IjogInVzIiwK\\nICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjaXR5IjogIlNhbiBG\\ncmFuY2lzY28iCiAgICB9LAogICAgImF0dHJpYnV0aW9uIjogIkNpdHkgb2Yg\\nU2FuIEZyYW5jaXNjbyIsCiAgICAiZGF0YSI6ICJodHRwczovL2RhdGEuc2Zn\\nb3Yub3JnL2Rvd25sb2FkL2t2ZWotdzVrYi9aSVBQRUQlMjBTSEFQRUZJTEUi\\nLAogICAgImxpY2Vuc2UiOiAiIiwKICAgICJ5ZWFyIjogIiIsCiAgICAidHlw\\nZSI6ICJodHRwIiwKICAgICJjb21wcmVzc2lvbiI6ICJ6aXAiLAogICAgImNv\\nbmZvcm0iOiB7Cgkic3BsaXQiOiAiQUREUkVTUyIsCiAgICAgICAgImxvbiI6\\nICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1iZXIiOiAi\\nYXV0b19udW1iZXIiLAogICAgICAgICJzdHJlZXQiOiAiYXV0b19zdHJlZXQi\\nLAogICAgICAgICJ0eXBlIjogInNoYXBlZmlsZSIsCiAgICAgICAgInBvc3Rj\\nb2RlIjogInppcGNvZGUiCiAgICB9Cn0K\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-san_francisco.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-san_francisco.json"\r  }\r}'''
+            data = u'''{\r  "sha": "cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r  "size": 519,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/cbf1f900ac072b6a2e728819a97e74bc772e79ff",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJjb3VudHJ5IjogInVzIiwK\\nICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjaXR5IjogIlNhbiBG\\ncmFuY2lzY28iCiAgICB9LAogICAgImF0dHJpYnV0aW9uIjogIkNpdHkgb2Yg\\nU2FuIEZyYW5jaXNjbyIsCiAgICAiZGF0YSI6ICJodHRwczovL2RhdGEuc2Zn\\nb3Yub3JnL2Rvd25sb2FkL2t2ZWotdzVrYi9aSVBQRUQlMjBTSEFQRUZJTEUi\\nLAogICAgImxpY2Vuc2UiOiAiIiwKICAgICJ5ZWFyIjogIiIsCiAgICAidHlw\\nZSI6ICJodHRwIiwKICAgICJjb21wcmVzc2lvbiI6ICJ6aXAiLAogICAgImNv\\nbmZvcm0iOiB7Cgkic3BsaXQiOiAiQUREUkVTUyIsCiAgICAgICAgImxvbiI6\\nICJ4IiwKICAgICAgICAibGF0IjogInkiLAogICAgICAgICJudW1iZXIiOiAi\\nYXV0b19udW1iZXIiLAogICAgICAgICJzdHJlZXQiOiAiYXV0b19zdHJlZXQi\\nLAogICAgICAgICJ0eXBlIjogInNoYXBlZmlsZSIsCiAgICAgICAgInBvc3Rj\\nb2RlIjogInppcGNvZGUiCiAgICB9Cn0K\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
-        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-nevada_county.json') and query.get('ref', '').startswith('8dd262'):
-            if self.request_index % 2:
+        if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9'):
+            if url.path not in self.failed_paths:
+                # Fail once per blob to exercise retries from parallel requests.
+                self.failed_paths.add(url.path)
                 raise ConnectionError('Something-or-other went wrong')
 
-            data = u'''{\r  "name": "us-ca-nevada_county.json",\r  "path": "sources/us-ca-nevada_county.json",\r  "sha": "2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r  "size": 659,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-nevada_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r  "html_url": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json",\r  "git_url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r  "download_url": "https://raw.githubusercontent.com/openaddresses/hooked-on-sources/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json",\r  "type": "file",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjA1NyIsCiAgICAgICAgICAgICJuYW1l\\nIjogIk5ldmFkYSBDb3VudHkiLAogICAgICAgICAgICAic3RhdGUiOiAiQ2Fs\\naWZvcm5pYSIKICAgICAgICB9LAogICAgICAgICJjb3VudHJ5IjogInVzIiwK\\nICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjb3VudHkiOiAiTmV2\\nYWRhIgogICAgfSwKICAgICJhdHRyaWJ1dGlvbiI6ICJOZXZhZGEgQ291bnR5\\nIiwKICAgICJkYXRhIjogImh0dHA6Ly93d3cubXluZXZhZGFjb3VudHkuY29t\\nL25jL2lncy9naXMvZG9jcy9EaWdpdGFsJTIwRGF0YSUyMExpYnJhcnkvQWRk\\ncmVzc1BvaW50LnppcCIsCiAgICAid2Vic2l0ZSI6ICJodHRwOi8vd3d3Lm15\\nbmV2YWRhY291bnR5LmNvbS9uYy9pZ3MvZ2lzL1BhZ2VzL01ldGFEYXRhLmFz\\ncHgiLAogICAgInR5cGUiOiAiaHR0cCIsCiAgICAiY29tcHJlc3Npb24iOiAi\\nemlwIiwKICAgICJjb25mb3JtIjogewogICAgICAgICJsb24iOiAieCIsCiAg\\nICAgICAgImxhdCI6ICJ5IiwKICAgICAgICAibnVtYmVyIjogInN0cmVldE51\\nbSIsCiAgICAgICAgInN0cmVldCI6ICJzdHJlZXROYW1lIiwKICAgICAgICAi\\ndHlwZSI6ICJzaGFwZWZpbGUiCiAgICB9Cn0KCgo=\\n",\r  "encoding": "base64",\r  "_links": {\r    "self": "https://api.github.com/repos/openaddresses/hooked-on-sources/contents/sources/us-ca-nevada_county.json?ref=8dd262c2f30a70b27e371869c54315b1abc32247",\r    "git": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r    "html": "https://github.com/openaddresses/hooked-on-sources/blob/8dd262c2f30a70b27e371869c54315b1abc32247/sources/us-ca-nevada_county.json"\r  }\r}'''
+            data = u'''{\r  "sha": "2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r  "size": 659,\r  "url": "https://api.github.com/repos/openaddresses/hooked-on-sources/git/blobs/2dc45c5b21b9149d16b47142ee06d5238be8bfd9",\r  "content": "ewogICAgImNvdmVyYWdlIjogewogICAgICAgICJVUyBDZW5zdXMiOiB7CiAg\\nICAgICAgICAgICJnZW9pZCI6ICIwNjA1NyIsCiAgICAgICAgICAgICJuYW1l\\nIjogIk5ldmFkYSBDb3VudHkiLAogICAgICAgICAgICAic3RhdGUiOiAiQ2Fs\\naWZvcm5pYSIKICAgICAgICB9LAogICAgICAgICJjb3VudHJ5IjogInVzIiwK\\nICAgICAgICAic3RhdGUiOiAiY2EiLAogICAgICAgICJjb3VudHkiOiAiTmV2\\nYWRhIgogICAgfSwKICAgICJhdHRyaWJ1dGlvbiI6ICJOZXZhZGEgQ291bnR5\\nIiwKICAgICJkYXRhIjogImh0dHA6Ly93d3cubXluZXZhZGFjb3VudHkuY29t\\nL25jL2lncy9naXMvZG9jcy9EaWdpdGFsJTIwRGF0YSUyMExpYnJhcnkvQWRk\\ncmVzc1BvaW50LnppcCIsCiAgICAid2Vic2l0ZSI6ICJodHRwOi8vd3d3Lm15\\nbmV2YWRhY291bnR5LmNvbS9uYy9pZ3MvZ2lzL1BhZ2VzL01ldGFEYXRhLmFz\\ncHgiLAogICAgInR5cGUiOiAiaHR0cCIsCiAgICAiY29tcHJlc3Npb24iOiAi\\nemlwIiwKICAgICJjb25mb3JtIjogewogICAgICAgICJsb24iOiAieCIsCiAg\\nICAgICAgImxhdCI6ICJ5IiwKICAgICAgICAibnVtYmVyIjogInN0cmVldE51\\nbSIsCiAgICAgICAgInN0cmVldCI6ICJzdHJlZXROYW1lIiwKICAgICAgICAi\\ndHlwZSI6ICJzaGFwZWZpbGUiCiAgICB9Cn0KCgo=\\n",\r  "encoding": "base64"\r}'''
             return response(200, data.encode('utf8'), headers=response_headers)
 
         if MHP == ('GET', GH, '/repos/openaddresses/hooked-on-sources/compare/8dd262c2f30a70b27e371869c54315b1abc32247...master'):
@@ -3412,6 +3538,35 @@ class TestBatch (unittest.TestCase):
 
         self.assertEqual(file_names, expected_names)
 
+    @patch('openaddr.ci.GITHUB_RETRY_DELAY', new=timedelta(seconds=0))
+    def test_batch_sources_cache(self):
+        ''' Show that cached batch sources are not requested from Github again.
+        '''
+        owner, repository = 'openaddresses', 'hooked-on-sources'
+        cache_dir = join(self.output_dir, 'github-cache')
+        requested_paths = list()
+
+        def response_content(url, request):
+            requested_paths.append(url.path)
+            return self.response_content(url, request)
+
+        with HTTMock(response_content):
+            sources1 = list(find_batch_sources(owner, repository, self.github_auth, {}, cache_dir))
+
+        self.assertEqual(len(sources1), 6)
+        self.assertIn('/repos/openaddresses/hooked-on-sources/git/trees/55f5da58da7b14f02da8f1214fd72d1bc8f02ba3', requested_paths)
+        self.assertIn('/repos/openaddresses/hooked-on-sources/git/blobs/a8ccd9b403c39e9e9150470cb6b0d4c6515f82a9', requested_paths)
+        self.assertNotIn('sources/README.txt', [source['path'] for source in sources1])
+
+        del requested_paths[:]
+
+        with HTTMock(response_content):
+            sources2 = list(find_batch_sources(owner, repository, self.github_auth, {}, cache_dir))
+
+        self.assertEqual(sources1, sources2)
+        self.assertEqual([path for path in requested_paths if '/git/' in path], [],
+                         'Trees and blobs should come from the cache')
+
     @patch('openaddr.jobs.JOB_TIMEOUT', new=timedelta(seconds=1))
     @patch('openaddr.ci.DUETASK_DELAY', new=timedelta(seconds=0))
     @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
@@ -3532,6 +3687,94 @@ class TestBatch (unittest.TestCase):
             self.assertEqual(properties[2]['address count'], 999)
             self.assertEqual(properties[2]['source count'], 1)
 
+    def test_render_and_upload_maps(self):
+        ''' Show that set maps are rendered in parallel and uploaded as each finishes.
+        '''
+        def render_png(sources_dir, good_sources, width, resolution, filename, area, coverages):
+            self.assertEqual(coverages, {'sources/a.json': {'ISO 3166': {'alpha2': 'AA'}}})
+            with open(filename, 'w') as file:
+                file.write('PNG {}'.format(area))
+
+        def render_geojson(sources_dir, good_sources, filename, area, coverages):
+            self.assertEqual(good_sources, {'sources/a.json': 'run'})
+            with open(filename, 'w') as file:
+                file.write('GeoJSON')
+
+        dirname = mkdtemp(prefix='test_render_and_upload_maps-')
+
+        try:
+            mkdir(join(dirname, 'sources'))
+            with open(join(dirname, 'sources', 'a.json'), 'w') as file:
+                json.dump({'coverage': {'ISO 3166': {'alpha2': 'AA'}}}, file)
+
+            with patch('openaddr.render.render_png') as render_png_, \
+                 patch('openaddr.render.render_geojson') as render_geojson_, \
+                 patch('openaddr.render.preload_geodata') as preload_geodata, \
+                 patch('openaddr.ci.ProcessPoolExecutor', new=ThreadPoolExecutor):
+                render_png_.side_effect = render_png
+                render_geojson_.side_effect = render_geojson
+                urls = _render_and_upload_maps(self.s3, {'sources/a.json': 'run'}, '/sets/1', dirname)
+        finally:
+            rmtree(dirname)
+
+        preload_geodata.assert_called_once_with({render.WORLD, render.USA, render.EUROPE})
+        self.assertEqual(len(render_png_.mock_calls), 3)
+        self.assertEqual(len(render_geojson_.mock_calls), 1)
+        self.assertEqual(urls, (
+            'https://s3.amazonaws.com/fake-bucket/sets/1/render-world.png',
+            'https://s3.amazonaws.com/fake-bucket/sets/1/render-usa.png',
+            'https://s3.amazonaws.com/fake-bucket/sets/1/render-europe.png',
+            'https://s3.amazonaws.com/fake-bucket/sets/1/render-world.geojson'))
+
+        with HTTMock(self.response_content):
+            self.assertEqual(get(urls[1]).content, b'PNG 2163')
+            self.assertEqual(get(urls[3]).content, b'GeoJSON')
+
+    def test_render_and_upload_maps_processes(self):
+        ''' Show that runs from read_completed_set_runs() reach forked render processes.
+        '''
+        with db_connect(self.database_url) as conn:
+            with db_cursor(conn) as db:
+                db.execute('''INSERT INTO sets (id, owner, repository, datetime_start, datetime_end)
+                              VALUES (1, 'openaddresses', 'openaddresses', NOW(), NOW())''')
+
+                for source_path in ('sources/a.json', 'sources/b.json'):
+                    state = RunState({'source': source_path[8:], 'address count': 9,
+                                      'processed': 'http://example.com/{}.zip'.format(source_path[8:-5])})
+                    set_run(db, add_run(db), source_path, 'abc', b64encode(b'{"coverage": {}}'),
+                            state, True, None, '', None, True, 1)
+
+                good_sources = {run.source_path: run for run in read_completed_set_runs(db, 1)}
+
+        def render_png(sources_dir, good_sources, width, resolution, filename, area, coverages):
+            # Runs here were pickled in the parent process and unpickled in this one.
+            with open(filename, 'w') as file:
+                json.dump({path: [run.id, run.datetime_tz.isoformat(), run.state.to_json()]
+                           for (path, run) in good_sources.items()}, file)
+
+        dirname = mkdtemp(prefix='test_render_and_upload_maps_processes-')
+
+        try:
+            _prepare_render_sources(good_sources.values(), dirname)
+
+            with patch('openaddr.render.render_png') as render_png_, \
+                 patch('openaddr.render.render_geojson') as render_geojson_, \
+                 patch('openaddr.render.preload_geodata'):
+                render_png_.side_effect = render_png
+                render_geojson_.side_effect = lambda *args: render_png(*args[:2], None, None, *args[2:])
+                urls = _render_and_upload_maps(self.s3, good_sources, '/sets/1', dirname)
+        finally:
+            rmtree(dirname)
+
+        expected = {path: [run.id, run.datetime_tz.isoformat(), run.state.to_json()]
+                    for (path, run) in good_sources.items()}
+
+        self.assertEqual(len(expected), 2)
+
+        with HTTMock(self.response_content):
+            for url in urls:
+                self.assertEqual(json.loads(get(url).content.decode('utf8')), expected)
+
     def test_render_index_maps(self):
         ''' Show that front page maps get rendered correctly.
         '''
@@ -3620,6 +3863,261 @@ class TestQueue (unittest.TestCase):
         self.assertEqual(job_data[5]['state'].source, 'sources/xx/f.json')
         self.assertEqual(job_data[5]['state'].process_hash, 'f00')
 
+    def test_queue_notifies(self):
+        ''' Show that a listening connection hears about new queue items.
+        '''
+        conn1, conn2 = db_connect(self.database_url), db_connect(self.database_url)
+        db_listen(conn1, (DONE_QUEUE, DUE_QUEUE))
+
+        try:
+            # Nothing to hear about yet.
+            self.assertEqual(db_wait_for_notifies(conn1, timedelta(seconds=.1)), set())
+
+            db_queue(conn2, DONE_QUEUE).put(dict(hello='world'))
+            db_queue(conn2, TASK_QUEUE).put(dict(hello='world'))
+
+            # Only hear about the listened-to queue.
+            self.assertEqual(db_wait_for_notifies(conn1, timedelta(seconds=5)), set([DONE_QUEUE]))
+            self.assertEqual(db_wait_for_notifies(conn1, timedelta(seconds=.1)), set())
+        finally:
+            conn1.close()
+            conn2.close()
+
+    @patch('openaddr.ci.update_job_status')
+    @patch('openaddr.ci.objects.set_run')
+    @patch('openaddr.ci.is_merged_to_master')
+    def test_drain_done_queue(self, is_merged_to_master, set_run, update_job_status):
+        ''' Show that a batch of done tasks is handled without blocking.
+        '''
+        with db_connect(self.database_url) as conn:
+            done_Q = db_queue(conn, DONE_QUEUE)
+
+            for run_id in range(3):
+                done_Q.put(dict(job_id='j', url='u', name='sources/xx/f.json',
+                                content_b64='Li4u', file_id='iii', commit_sha='sss',
+                                run_id=run_id, result=dict(message='Yo', output={})))
+
+            self.assertEqual(drain_queue(pop_task_from_donequeue, done_Q, mock.Mock(), 2), 2)
+            self.assertEqual(drain_queue(pop_task_from_donequeue, done_Q, mock.Mock(), 2), 1)
+            self.assertEqual(drain_queue(pop_task_from_donequeue, done_Q, mock.Mock(), 2), 0)
+
+        self.assertEqual([call[1][1] for call in set_run.mock_calls], [0, 1, 2])
+
+    @patch('openaddr.ci.update_job_comments')
+    @patch('openaddr.ci.update_pending_status')
+    @patch('openaddr.ci.update_success_status')
+    @patch('openaddr.ci.objects.set_run')
+    @patch('openaddr.ci.get')
+    def test_done_queue_batch(self, get, set_run, update_success_status, update_pending_status, update_job_comments):
+        ''' Show that a batch of done tasks makes few Github requests.
+        '''
+        get.return_value.json.return_value = {
+            'repository_url': 'https://api.github.com/repos/{owner}/{repo}',
+            'compare_url': 'https://api.github.com/repos/o/r/compare/{base}...{head}',
+            'base_commit': {'sha': 'sss'}, 'merge_base_commit': {'sha': 'sss'}
+            }
+
+        filenames = ['sources/xx/{}.json'.format(name) for name in 'abc']
+        file_states = {name: None for name in filenames}
+        task_files = {'file-{}'.format(i): name for (i, name) in enumerate(filenames)}
+
+        with db_connect(self.database_url) as conn:
+            done_Q = db_queue(conn, DONE_QUEUE)
+
+            with done_Q as db:
+                add_job(db, 'j', None, task_files, file_states, dict(file_states),
+                        'o', 'r', 'http://example.com/status', None)
+
+            for (run_id, filename) in enumerate(filenames):
+                done_Q.put(dict(job_id='j', url='u', name=filename, content_b64='Li4u',
+                                file_id='iii', commit_sha='sss', run_id=run_id,
+                                result=dict(message=MAGIC_OK_MESSAGE, output={})))
+
+            batch = DequeueBatch(GithubCache())
+            drain_queue(pop_task_from_donequeue, done_Q, mock.Mock(), batch=batch)
+
+            # Updates wait in the database until posted, even for a new batch.
+            with done_Q as db:
+                db.execute('SELECT COUNT(*) FROM job_updates')
+                self.assertEqual(db.fetchone(), (3, ))
+
+            DequeueBatch(batch.github_cache).post_updates(done_Q, mock.Mock())
+            batch.post_updates(done_Q, mock.Mock())
+
+            with done_Q as db:
+                self.assertIs(read_job(db, 'j').status, True)
+                db.execute('SELECT COUNT(*) FROM job_updates')
+                self.assertEqual(db.fetchone(), (0, ))
+
+        self.assertEqual(len(set_run.mock_calls), 3)
+        self.assertEqual(set_run.mock_calls[0][1][10], True, 'Commit should be merged')
+        self.assertEqual(len(get.mock_calls) // 2, 3, 'Should have asked Github about one commit')
+        self.assertEqual(len(update_pending_status.mock_calls), 0)
+        self.assertEqual(len(update_success_status.mock_calls), 1)
+        self.assertEqual([call[1][2] for call in update_job_comments.mock_calls], [0, 1, 2])
+
+    @patch('openaddr.ci.JOB_UPDATE_RETRY_DELAY', new=timedelta(seconds=0))
+    @patch('openaddr.ci.update_job_comments')
+    @patch('openaddr.ci.post_job_status')
+    def test_dequeue_batch_failed_post(self, post_job_status, update_job_comments):
+        ''' Show that a job whose Github post fails is retried without holding up other jobs.
+        '''
+        with db_connect(self.database_url) as conn:
+            done_Q = db_queue(conn, DONE_QUEUE)
+            batch = DequeueBatch(GithubCache())
+
+            with done_Q as db:
+                for job_id in ('j1', 'j2'):
+                    add_job(db, job_id, True, {}, {}, {}, 'o', 'r', 'http://example.com/status', None)
+
+                batch.add_job(db, 'j1', 'u1', 1)
+                batch.add_job(db, 'j2', 'u2', 2)
+
+            post_job_status.side_effect = [ValueError('Failed status post'), None, None]
+            batch.post_updates(done_Q, mock.Mock())
+
+            with done_Q as db:
+                db.execute('SELECT job_id, attempts FROM job_updates')
+                self.assertEqual(db.fetchall(), [('j1', 1)], 'Failed update should be kept')
+
+            batch.post_updates(done_Q, mock.Mock())
+            batch.post_updates(done_Q, mock.Mock())
+
+            with done_Q as db:
+                db.execute('SELECT COUNT(*) FROM job_updates')
+                self.assertEqual(db.fetchone(), (0, ), 'Posted updates should be removed')
+
+        self.assertEqual([call[1][1] for call in post_job_status.mock_calls], ['u1', 'u2', 'u1'])
+        self.assertEqual([call[1][1:3] for call in update_job_comments.mock_calls], [('j2', 2), ('j1', 1)])
+
+    @patch('openaddr.ci.JOB_UPDATE_RETRY_DELAY', new=timedelta(seconds=0))
+    @patch('openaddr.ci.JOB_UPDATE_ATTEMPTS', new=2)
+    @patch('openaddr.ci.post_job_status')
+    def test_dequeue_batch_failed_post_gives_up(self, post_job_status):
+        ''' Show that a job whose Github post keeps failing is eventually dropped.
+        '''
+        with db_connect(self.database_url) as conn:
+            done_Q = db_queue(conn, DONE_QUEUE)
+            batch = DequeueBatch(GithubCache())
+
+            with done_Q as db:
+                add_job(db, 'j', True, {}, {}, {}, 'o', 'r', 'http://example.com/status', None)
+                batch.add_job(db, 'j', 'u', 1)
+
+            post_job_status.side_effect = ValueError('Failed status post')
+
+            for count in (1, 0, 0):
+                batch.post_updates(done_Q, mock.Mock())
+
+                with done_Q as db:
+                    db.execute('SELECT COUNT(*) FROM job_updates')
+                    self.assertEqual(db.fetchone(), (count, ))
+
+        self.assertEqual(len(post_job_status.mock_calls), 2)
+
+    @patch('openaddr.ci.JOB_UPDATE_RETRY_DELAY', new=timedelta(hours=1))
+    @patch('openaddr.ci.post_job_status')
+    def test_dequeue_batch_failed_post_waits(self, post_job_status):
+        ''' Show that a failed Github post is not retried before its delay.
+        '''
+        with db_connect(self.database_url) as conn:
+            done_Q = db_queue(conn, DONE_QUEUE)
+            batch = DequeueBatch(GithubCache())
+
+            with done_Q as db:
+                add_job(db, 'j', True, {}, {}, {}, 'o', 'r', 'http://example.com/status', None)
+                batch.add_job(db, 'j', 'u', 1)
+
+            post_job_status.side_effect = ValueError('Failed status post')
+            batch.post_updates(done_Q, mock.Mock())
+            batch.post_updates(done_Q, mock.Mock())
+
+            with done_Q as db:
+                db.execute('SELECT attempts, next_try > NOW() FROM job_updates')
+                self.assertEqual(db.fetchall(), [(1, True)])
+
+        self.assertEqual(len(post_job_status.mock_calls), 1)
+
+    def test_heartbeats(self):
+        ''' Show that heartbeats keep one row per worker with latest progress.
+        '''
+        with db_connect(self.database_url) as conn:
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+
+            with beat_Q as db:
+                send_heartbeat(db, Heartbeat('w1', 'xx/f'))
+                send_heartbeat(db, Heartbeat('w2', 'xx/g', 10, 20))
+                send_heartbeat(db, Heartbeat('w1', 'xx/f', 30, 40))
+
+            # Older workers may still send heartbeats through the queue.
+            beat_Q.put(dict(worker_id='w3'))
+            flush_heartbeat_queue(beat_Q)
+
+            with beat_Q as db:
+                db.execute('SELECT COUNT(*) FROM heartbeats')
+                self.assertEqual(db.fetchone(), (3, ))
+
+                beats = get_recent_heartbeats(db)
+                self.assertEqual(get_recent_workers(db), ['w1', 'w2', 'w3'])
+
+        self.assertEqual([beat.asdata() for beat in beats], [
+            dict(worker_id='w1', source_name='xx/f', rows_processed=30, bytes_downloaded=40),
+            dict(worker_id='w2', source_name='xx/g', rows_processed=10, bytes_downloaded=20),
+            dict(worker_id='w3', source_name=None, rows_processed=None, bytes_downloaded=None)
+            ])
+
+    def test_upgrade_db(self):
+        ''' Show that upgrade.pgsql brings an older database up to date.
+        '''
+        with db_connect(self.database_url) as conn:
+            with db_cursor(conn) as db:
+                db.execute('DROP TABLE job_updates')
+                db.execute('DROP TABLE heartbeats')
+                db.execute('CREATE TABLE heartbeats (worker_id VARCHAR(32) NOT NULL, datetime TIMESTAMP WITH TIME ZONE)')
+                db.execute('''INSERT INTO heartbeats VALUES ('w1', NOW() - INTERVAL '1 minute'),
+                              ('w1', NOW()), ('w1', NULL), ('w2', NOW())''')
+
+        # Running it twice is harmless.
+        recreate_db.upgrade(self.database_url)
+        recreate_db.upgrade(self.database_url)
+
+        with db_connect(self.database_url) as conn:
+            beat_Q = db_queue(conn, HEARTBEAT_QUEUE)
+
+            with beat_Q as db:
+                send_heartbeat(db, Heartbeat('w2', 'xx/g', 10, 20))
+                beats = get_recent_heartbeats(db)
+
+                db.execute('SELECT COUNT(*) FROM job_updates')
+                self.assertEqual(db.fetchone(), (0, ))
+
+        self.assertEqual([beat.asdata() for beat in beats], [
+            dict(worker_id='w1', source_name=None, rows_processed=None, bytes_downloaded=None),
+            dict(worker_id='w2', source_name='xx/g', rows_processed=10, bytes_downloaded=20)
+            ])
+
+    @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
+    @patch('openaddr.ci.work.do_work')
+    @patch('openaddr.ci.objects.get_completed_file_run')
+    @patch('openaddr.ci.objects.add_run')
+    def test_pop_task_from_taskqueue_failed_heartbeat(self, add_run, get_completed_file_run, do_work):
+        ''' Show that a failed heartbeat does not keep a worker from taking a task.
+        '''
+        add_run.return_value = 999
+        get_completed_file_run.return_value = None
+
+        s3, task_queue, done_queue = mock.Mock(), mock.MagicMock(), mock.Mock()
+        due_queue, heartbeat_queue = mock.Mock(), mock.MagicMock()
+        heartbeat_queue.__enter__.return_value.execute.side_effect = Exception('No such column')
+
+        task_queue.get.return_value.data = dict(job_id='J', url='U', name='N', content_b64='Qw==', commit_sha='S', file_id='F')
+        self.assertTrue(pop_task_from_taskqueue(s3, task_queue, done_queue, due_queue, heartbeat_queue, '', ''))
+
+        self.assertEqual(len(heartbeat_queue.__enter__.return_value.execute.mock_calls), 1)
+        self.assertEqual(len(task_queue.__exit__.mock_calls), 1)
+        self.assertIsNone(task_queue.__exit__.mock_calls[0][1][0], 'Task transaction should commit')
+        self.assertEqual(len(done_queue.put.mock_calls), 1)
+
     @patch('openaddr.ci.WORKER_COOLDOWN', new=timedelta(seconds=0))
     @patch('openaddr.ci.work.do_work')
     @patch('openaddr.ci.objects.get_completed_file_run')
@@ -3839,7 +4337,7 @@ class TestCollect (unittest.TestCase):
         S3, db, collected_zip = mock.Mock(), mock.Mock(), mock.Mock()
         collected_zip.filename = 'collected-local.zip'
 
-        with patch('openaddr.ci.collect.add_source_to_zipfile') as add_source_to_zipfile:
+        with patch('openaddr.ci.collect._copy_zipfile_member') as _copy_zipfile_member:
             collector_publisher = CollectorPublisher(S3, collected_zip, 'everywhere', 'yo')
 
             s1 = {'license': 'ODbL', 'attribution name': 'ABC Co.'}
@@ -3849,9 +4347,13 @@ class TestCollect (unittest.TestCase):
             r2 = LocalProcessedResult('def', 'def.zip', RunState(s2), None)
             r3 = LocalProcessedResult('ghi', 'ghi.zip', RunState(s3), None)
 
-            collector_publisher.collect(r1)
-            collector_publisher.collect(r2)
-            collector_publisher.collect(r3)
+            prepared_path = join(self.output_dir, 'prepared.zip')
+            with ZipFile(prepared_path, 'w') as prepared_zip:
+                prepared_zip.writestr('abc.csv', b'csv data')
+
+            collector_publisher.collect_prepared(r1, prepared_path)
+            collector_publisher.collect_prepared(r2, prepared_path)
+            collector_publisher.collect_prepared(r3, prepared_path)
 
             with patch('openaddr.ci.collect.write_to_s3') as write_to_s3:
                 s3_key_mock = mock.Mock()
@@ -3867,11 +4369,11 @@ class TestCollect (unittest.TestCase):
                 mock.call(S3.bucket, collected_zip.filename, collected_zip.filename)
                 ])
 
-            add_source_to_zipfile.assert_has_calls([
-                mock.call(collected_zip, r1),
-                mock.call(collected_zip, r2),
-                mock.call(collected_zip, r3)
-                ])
+            self.assertEqual(len(_copy_zipfile_member.mock_calls), 3)
+            for (_, (zip_in, zipinfo, zip_out, comment), _) in _copy_zipfile_member.mock_calls:
+                self.assertEqual(zipinfo.filename, 'abc.csv')
+                self.assertIs(zip_out, collected_zip)
+                self.assertEqual(comment, b'')
 
         self.assertEqual(len(collected_zip.writestr.mock_calls), 1)
         filename, content = collected_zip.writestr.mock_calls[0][1]
@@ -3939,6 +4441,59 @@ class TestCollect (unittest.TestCase):
         bucket.initiate_multipart_upload.assert_has_calls([mock.call('keyname.csv', headers={'Content-Type': 'text/csv'})])
         self.assertEqual(bucket.get_key.mock_calls[0][1], ('keyname.csv', ), 'Should upload a correctly-named key')
 
+    def test_collector_publisher_multipart_s3_retry_parts(self):
+        ''' Show that failed parts are retried with checksums of their contents.
+        '''
+        handle, filename1 = mkstemp(suffix='.zip')
+        close(handle)
+
+        bucket, mp_upload = mock.Mock(), mock.Mock()
+        bucket.initiate_multipart_upload.return_value = mp_upload
+        mp_upload.get_all_parts.return_value = [None, None]
+
+        # Write a sample file big enough for two parts
+        content = b''.join(bytes([n % 251]) * 1024 for n in range(2 * MULTIPART_CHUNK_SIZE // 1024))
+
+        with open(filename1, 'wb') as f:
+            f.write(content)
+
+        parts, failures = dict(), [2]
+
+        def upload_part_from_file(fp, part_num, size, md5):
+            if part_num in failures:
+                failures.remove(part_num)
+                fp.read(1000)
+                raise IOError('Dropped connection')
+
+            parts[part_num] = fp.read(size)
+            self.assertEqual(md5[0], hashlib.md5(parts[part_num]).hexdigest())
+
+        mp_upload.upload_part_from_file.side_effect = upload_part_from_file
+        write_to_s3(bucket, filename1, 'keyname.zip')
+        remove(filename1)
+
+        self.assertEqual(len(mp_upload.upload_part_from_file.mock_calls), 3, 'Should have retried one part')
+        self.assertEqual(sorted(parts.keys()), [1, 2])
+        self.assertEqual(parts[1] + parts[2], content)
+        self.assertEqual(len(bucket.get_all_multipart_uploads.mock_calls), 0)
+        self.assertEqual(len(mp_upload.cancel_upload.mock_calls), 0)
+        self.assertEqual(len(mp_upload.complete_upload.mock_calls), 1)
+
+        # A part that fails every time cancels the whole upload
+        mp_upload.reset_mock()
+        mp_upload.upload_part_from_file.side_effect = IOError('Dropped connection')
+
+        with open(filename1, 'wb') as f:
+            f.write(b'a' * 1000)
+
+        with self.assertRaises(IOError):
+            write_to_s3(bucket, filename1, 'keyname.zip')
+
+        remove(filename1)
+        self.assertEqual(len(mp_upload.upload_part_from_file.mock_calls), 3)
+        self.assertEqual(len(mp_upload.cancel_upload.mock_calls), 1)
+        self.assertEqual(len(mp_upload.complete_upload.mock_calls), 0)
+
     def test_collection_checks(self):
         '''
         '''
@@ -4034,7 +4589,118 @@ class TestCollect (unittest.TestCase):
                     if test_func is not is_north_america:
                         self.assertFalse(test_func(result), '{}("{}") should be false'.format(test_func.__name__, source_base))
 
-    def test_add_source_to_zipfile(self):
+    def test_collect_results(self):
+        ''' Show that each source is prepared once and copied to matching collections.
+        '''
+        set = mock.Mock()
+        set.owner, set.repository, set.commit_sha = 'oa', 'oa', 'ff9900'
+
+        area_tests = {'global': lambda result: True, 'us': lambda result: result.source_base.startswith('us/')}
+        sa_tests = {'': lambda result: True}
+        collections = prepare_collections(self.s3, set, self.output_dir, area_tests, sa_tests)
+
+        results = list()
+        for source_base in ('us/ca/oakland', 'de/berlin'):
+            filename = join(self.output_dir, source_base.replace('/', '-') + '.zip')
+            with ZipFile(filename, 'w') as zipfile:
+                zipfile.writestr('README.txt', b'hello world')
+                zipfile.writestr(source_base + '.csv', u'LON,LAT,NUMBER,STREET\n-122.2,37.7,85,MAITLAND DR\n13.4,52.5,1,Straße\n')
+            results.append(LocalProcessedResult(source_base, filename, RunState({}), None))
+
+        with patch('openaddr.ci.collect.COLLECT_CONCURRENCY', new=1):
+            collect_results(collections, results, self.output_dir)
+
+        for (collection, _) in collections:
+            collection.zip.close()
+
+        zips = {basename(collection.zip.filename): ZipFile(collection.zip.filename) for (collection, _) in collections}
+
+        self.assertIsNone(zips['openaddr-collected-global.zip'].testzip())
+        self.assertIsNone(zips['openaddr-collected-us.zip'].testzip())
+
+        self.assertEqual(zips['openaddr-collected-global.zip'].namelist(), [
+            'README.txt', 'us/ca/oakland.csv', 'summary/us/ca/oakland-summary.csv',
+            'summary/us/ca/oakland-summary.vrt', 'de/berlin.csv',
+            'summary/de/berlin-summary.csv', 'summary/de/berlin-summary.vrt'])
+
+        self.assertEqual(zips['openaddr-collected-us.zip'].namelist(), [
+            'README.txt', 'us/ca/oakland.csv', 'summary/us/ca/oakland-summary.csv',
+            'summary/us/ca/oakland-summary.vrt'])
+
+        self.assertEqual(zips['openaddr-collected-us.zip'].read('us/ca/oakland.csv'),
+                         zips['openaddr-collected-global.zip'].read('us/ca/oakland.csv'))
+        self.assertIn(u'Straße'.encode('utf8'), zips['openaddr-collected-global.zip'].read('de/berlin.csv'))
+
+        # Temporary source files were cleaned up.
+        self.assertEqual(sorted(os.listdir(self.output_dir)), sorted(zips.keys()))
+
+    def test_collect_previous_runs(self):
+        ''' Show that unchanged sources are copied from previous collection zips.
+        '''
+        set = mock.Mock()
+        set.owner, set.repository, set.commit_sha = 'oa', 'oa', 'ff9900'
+        area_tests = {'global': lambda result: True, 'us_west': is_us_west}
+        sa_tests = {'': lambda result: True}
+
+        runs = list()
+        for (id, source_base) in enumerate(('us/ca/oakland', 'de/berlin', 'fr/paris')):
+            filename = join(self.output_dir, source_base.replace('/', '-') + '.zip')
+            with ZipFile(filename, 'w') as zipfile:
+                zipfile.writestr(source_base + '.csv', u'LON,LAT,NUMBER,STREET\n-122.2,37.7,{},MAITLAND DR\n'.format(id))
+            state = RunState({'processed': filename, 'process hash': (None if id == 2 else 'hash-{}'.format(id))})
+            runs.append(Run(id, 'sources/{}.json'.format(source_base), None, None, None, state,
+                            None, None, None, None, None, None, None, None))
+
+        # First collection, built from scratch
+        previous_dir = join(self.output_dir, 'previous')
+        mkdir(previous_dir)
+        collections = prepare_collections(self.s3, set, previous_dir, area_tests, sa_tests)
+        results = [LocalProcessedResult(splitext(run.source_path[8:])[0], run.state.processed, run.state, None)
+                   for run in runs]
+
+        with patch('openaddr.ci.collect.COLLECT_CONCURRENCY', new=1):
+            collect_results(collections, results, previous_dir)
+
+        for (previous_collection, _) in collections:
+            previous_collection.zip.close()
+
+        (previous_global, _), (previous_west, _) = collections
+
+        # Second collection, after Berlin has changed
+        runs[1].state = RunState({'processed': runs[1].state.processed, 'process hash': 'hash-new'})
+        collections = prepare_collections(self.s3, set, self.output_dir, area_tests, sa_tests)
+
+        s3 = mock.Mock()
+        s3.bucket.get_key.return_value.get_contents_to_filename.side_effect = \
+            lambda filename: copyfile(previous_global.zip.filename, filename)
+        load_previous_collections(s3, collections, self.output_dir)
+
+        remaining_runs = collect_previous_runs(collections, runs)
+
+        for (collection, _) in collections:
+            collection.zip.close()
+
+        # Only the global zip is downloaded, and shared by both collections.
+        s3.bucket.get_key.assert_called_once_with('openaddr-collected-global.zip')
+        self.assertIs(collections[0][0].previous_zip, collections[1][0].previous_zip)
+        self.assertEqual([run.id for run in remaining_runs], [1, 2], 'Changed and unhashed runs remain')
+
+        for (collection, _) in collections:
+            self.assertEqual({result.source_base for result in collection.results}, {'us/ca/oakland'})
+
+            with ZipFile(collection.zip.filename) as zip1, ZipFile(previous_global.zip.filename) as zip2:
+                self.assertIsNone(zip1.testzip())
+                self.assertEqual(zip1.namelist(), ['README.txt', 'us/ca/oakland.csv',
+                    'summary/us/ca/oakland-summary.csv', 'summary/us/ca/oakland-summary.vrt'])
+                self.assertEqual(zip1.read('us/ca/oakland.csv'), zip2.read('us/ca/oakland.csv'))
+                self.assertEqual(zip1.getinfo('us/ca/oakland.csv').comment, zip2.getinfo('us/ca/oakland.csv').comment)
+
+        with ZipFile(previous_global.zip.filename) as zip2:
+            self.assertEqual(json.loads(zip2.getinfo('de/berlin.csv').comment.decode('utf8')),
+                             {'source': 'de/berlin', 'process hash': 'hash-1'})
+            self.assertEqual(zip2.getinfo('fr/paris.csv').comment, b'')
+
+    def test_prepare_source(self):
         '''
         '''
         handle, filename1 = mkstemp(suffix='.csv')
@@ -4050,50 +4716,69 @@ class TestCollect (unittest.TestCase):
         utime(filename2, (987654321, 987654321))
         close(handle)
 
-        output_write_contents = list()
-        def remember_write_contents(fn, _):
-            with open(fn) as file:
-                output_write_contents.append(file.read())
-        output = mock.Mock()
-        output.write.side_effect = remember_write_contents
-
         with patch('openaddr.ci.collect.add_csv_to_zipfile') as add_csv_to_zipfile:
-            add_source_to_zipfile(output, LocalProcessedResult('us/ca/oakland', 'temp', RunState({}), '2.0.0'))
-            add_source_to_zipfile(output, LocalProcessedResult('us/ca/oakland', filename1, RunState({}), '2.12.0'))
-            add_source_to_zipfile(output, LocalProcessedResult('us/ca/oakland', filename2, RunState({}), '2.13.0'))
-            add_source_to_zipfile(output, LocalProcessedResult('us/ca/oakland', filename1, RunState({}), '3'))
-            add_source_to_zipfile(output, LocalProcessedResult('ca/bc/vancouver', filename1, RunState({}), '3'))
-            add_source_to_zipfile(output, LocalProcessedResult('us/ca/oakland', filename1, RunState({}), None))
-
-        self.assertEqual(len(add_csv_to_zipfile.mock_calls), 5)
+            prepared_paths = [
+                prepare_source('us/ca/oakland', 'temp', self.output_dir),
+                prepare_source('us/ca/oakland', filename1, self.output_dir),
+                prepare_source('us/ca/oakland', filename2, self.output_dir),
+                prepare_source('ca/bc/vancouver', filename1, self.output_dir),
+                ]
+
+        self.assertEqual(len(add_csv_to_zipfile.mock_calls), 3)
         self.assertEqual(add_csv_to_zipfile.mock_calls[0][1][1], 'us/ca/oakland.csv')
         self.assertEqual(add_csv_to_zipfile.mock_calls[1][1][1], 'us/ca/oakland.csv')
-        self.assertEqual(add_csv_to_zipfile.mock_calls[3][1][1], 'ca/bc/vancouver.csv')
+        self.assertEqual(add_csv_to_zipfile.mock_calls[2][1][1], 'ca/bc/vancouver.csv')
+
+        for prepared_path in prepared_paths:
+            self.assertEqual(splitext(prepared_path)[1], '.zip')
+            self.assertEqual(basename(prepared_path)[:9], 'prepared-')
 
-        self.assertEqual(len(output.writestr.mock_calls), 1)
-        self.assertEqual(output.writestr.mock_calls[0][1][0].filename, 'us/ca/oakland.vrt')
-        self.assertEqual(output.writestr.mock_calls[0][1][1], b'vrt data')
+        with ZipFile(prepared_paths[0]) as zip0, ZipFile(prepared_paths[2]) as zip2:
+            self.assertEqual(zip0.namelist(), [])
+            self.assertEqual(zip2.namelist(), ['us/ca/oakland.vrt'])
+            self.assertEqual(zip2.read('us/ca/oakland.vrt'), b'vrt data')
 
         remove(filename1)
         remove(filename2)
 
-    def test_add_csv_to_zipfile(self):
+    def test_copy_zipfile_member(self):
         '''
         '''
-        output = mock.Mock()
-        output_write_contents = list()
-        output_writestr_contents = list()
+        input_path = join(self.output_dir, 'input.zip')
+        output_path = join(self.output_dir, 'output.zip')
+
+        with ZipFile(input_path, 'w') as zip_in:
+            zip_in.writestr('README.txt', b'hello world')
+            zip_in.getinfo('README.txt').comment = b'readme'
+            zip_in.writestr('us/ca/oakland.csv', b'LON,LAT\n' * 1000, ZIP_DEFLATED)
+
+        with ZipFile(input_path, 'r') as zip_in:
+            with ZipFile(output_path, 'w', ZIP_DEFLATED, allowZip64=True) as zip_out:
+                zip_out.writestr('first.txt', b'first')
+                _copy_zipfile_member(zip_in, zip_in.getinfo('README.txt'), zip_out)
+                _copy_zipfile_member(zip_in, zip_in.getinfo('us/ca/oakland.csv'),
+                                     zip_out, b'{"tag": 1}')
+                zip_out.writestr('last.txt', b'last')
 
-        def remember_write_contents(fn, _):
-            with open(fn) as file:
-                # Python 2.7 and 3 use different line endings in csv module:
-                output_write_contents.append([line.strip() for line in file])
+        with ZipFile(output_path, 'r') as zip_out:
+            self.assertIsNone(zip_out.testzip())
+            infos = zip_out.infolist()
 
-        def remember_writestr_contents(_, bytes):
-            output_writestr_contents.append(bytes)
+            self.assertEqual([info.filename for info in infos],
+                ['first.txt', 'README.txt', 'us/ca/oakland.csv', 'last.txt'])
+            self.assertEqual(zip_out.read('README.txt'), b'hello world')
+            self.assertEqual(zip_out.read('us/ca/oakland.csv'), b'LON,LAT\n' * 1000)
+            self.assertEqual(zip_out.read('last.txt'), b'last')
 
-        output.write.side_effect = remember_write_contents
-        output.writestr.side_effect = remember_writestr_contents
+            self.assertEqual(infos[1].comment, b'readme')
+            self.assertEqual(infos[2].comment, b'{"tag": 1}')
+            self.assertEqual(infos[2].compress_type, ZIP_DEFLATED)
+            self.assertLess(infos[2].compress_size, infos[2].file_size)
+
+    def test_add_csv_to_zipfile(self):
+        '''
+        '''
+        output = ZipFile(BytesIO(), 'w', ZIP_DEFLATED)
 
         # Addresses that should trigger expansion.
         input1 = u'LON,LAT,NUMBER,STREET,UNIT,CITY,DISTRICT,REGION,POSTCODE,ID,HASH\n-122.2359742,37.7362507,85,MAITLAND DR,A,ALAMEDA,,,94502,74-1035-77,h4sh\n-122.2353881,37.7223605,1360,S LOOP RD,,ALAMEDA,,,94502,74-1339-11,h4sh\n-122.2385597,37.7284071,3508,CATALINA AV,,ALAMEDA,,,94502,74-1033-146,h4sh\n-122.2368942,37.7305041,3512,MCSHERRY WY,,ALAMEDA,,,94502,74-1033-122,h4sh\n-122.2349371,37.7357455,514,FLOWER LA,,ALAMEDA,,,94502,74-1036-26,h4sh\n-122.2367819,37.7342157,1014,HOLLY ST,,ALAMEDA,,,94502,74-1075-222,h4sh\n'
@@ -4113,18 +4798,24 @@ class TestCollect (unittest.TestCase):
         input5 = u'LON,LAT,NUMBER,STREET,UNIT,CITY,DISTRICT,REGION,POSTCODE,ID,HASH\n-104.6843547,39.5793748,26050,E JAMISON CIR N,, CO,,,80016-2056,,629e0367e92b4c47\n-1.79769313486e+308,-1.79769313486e+308,26900,E COLFAX AVE,428,,,,,,8764a6de3c9f688c\n-104.1139093,39.6761295,2050,S PEORIA CROSSING RD,, CO,,,,,28b370f54c8e40ef\n'
         add_csv_to_zipfile(output, u'us/co/arapahoe.csv', BytesIO(input5.encode('utf8')))
 
-        self.assertEqual(len(output.write.mock_calls), 10)
-
-        self.assertEqual(output.write.mock_calls[0][1][1], u'us/ca/älameda.csv')
-        self.assertEqual(output.write.mock_calls[1][1][1], u'summary/us/ca/älameda-summary.csv')
-        self.assertEqual(output.write.mock_calls[2][1][1], output.write.mock_calls[0][1][1])
-        self.assertEqual(output.write.mock_calls[3][1][1], output.write.mock_calls[1][1][1])
-        self.assertEqual(output.write.mock_calls[4][1][1], 'de/he/frankfurt.csv')
-        self.assertEqual(output.write.mock_calls[5][1][1], 'summary/de/he/frankfurt-summary.csv')
-        self.assertEqual(output.write.mock_calls[6][1][1], output.write.mock_calls[0][1][1])
-        self.assertEqual(output.write.mock_calls[7][1][1], output.write.mock_calls[1][1][1])
-        self.assertEqual(output.write.mock_calls[8][1][1], 'us/co/arapahoe.csv')
-        self.assertEqual(output.write.mock_calls[9][1][1], 'summary/us/co/arapahoe-summary.csv')
+        zipinfos = output.infolist()
+        names = [zipinfo.filename for zipinfo in zipinfos]
+        output_write_contents = [[line.strip() for line in output.read(zipinfo).decode('utf8').splitlines()]
+                                 for zipinfo in zipinfos if zipinfo.filename.endswith('.csv')]
+        output_writestr_contents = [output.read(zipinfo)
+                                    for zipinfo in zipinfos if zipinfo.filename.endswith('.vrt')]
+
+        self.assertEqual(len(names), 15)
+
+        self.assertEqual(names[0], u'us/ca/älameda.csv')
+        self.assertEqual(names[1], u'summary/us/ca/älameda-summary.csv')
+        self.assertEqual(names[2], u'summary/us/ca/älameda-summary.vrt')
+        self.assertEqual(names[3:6], names[0:3])
+        self.assertEqual(names[6], 'de/he/frankfurt.csv')
+        self.assertEqual(names[7], 'summary/de/he/frankfurt-summary.csv')
+        self.assertEqual(names[9:12], names[0:3])
+        self.assertEqual(names[12], 'us/co/arapahoe.csv')
+        self.assertEqual(names[13], 'summary/us/co/arapahoe-summary.csv')
 
         self.assertIn(u'älameda'.encode('utf8'), output_writestr_contents[0])
         self.assertIn(u'älameda'.encode('utf8'), output_writestr_contents[1])
@@ -4252,12 +4943,19 @@ class TestTileIndex (unittest.TestCase):
             addresses1 = list(iterate_runs_points(self.runs[:1]))
             self.assertEqual(len(addresses1), 5305, 'Should equal first output')
             self.assertEqual(addresses1[0].result.source_base, 'us/ca/alameda')
+            self.assertFalse(hasattr(addresses1[0], '__dict__'), 'Should use compact slots')
+
+            # Missing HASH column is filled in to match the schema.
+            self.assertEqual(addresses1[0].line, b'-122.2371548,37.7468954,516,CENTRE CT,,ALAMEDA,,,94502,74-1332-127,')
 
         with HTTMock(self.response_content):
             addresses2 = list(iterate_runs_points(self.runs[1:]))
             self.assertEqual(len(addresses2), 4912, 'Should equal second output')
             self.assertEqual(addresses2[0].result.source_base, 'us/ca/santa_clara')
 
+            # Lines already matching the schema are used unchanged.
+            self.assertEqual(addresses2[0].line, b'-121.9085176,37.2742085,2653,MERIDIAN AVE,,SAN JOSE,,,95124,,52e696863d1c980a')
+
         with HTTMock(self.response_content):
             addresses3 = list(iterate_runs_points(self.runs))
             self.assertEqual(len(addresses3), 5305 + 4912, 'Should add up to the lengths of both outputs')
@@ -4328,12 +5026,38 @@ class TestTileIndex (unittest.TestCase):
                     self.assertEqual(result.run_state.attribution_name, 'Santa Clara County')
                     self.assertIsNone(result.run_state.attribution_flag)
 
+    @patch('openaddr.ci.tileindex.BLOCK_SIZE', new=1000)
+    def test_populate_tiles_few_open_files(self):
+        ''' Show that tiles come out whole with small blocks and few open files.
+        '''
+        for max_open_tiles in (1, 3):
+            with HTTMock(self.response_content), \
+                 patch('openaddr.ci.tileindex.MAX_OPEN_TILES', new=max_open_tiles), \
+                 patch('openaddr.ci.tileindex.Tile.open', autospec=True, side_effect=Tile.open) as tile_open:
+                addresses = iterate_runs_points(self.runs)
+                point_blocks = iterate_point_blocks(addresses)
+                tiles = populate_tiles(mkdtemp(dir=self.output_dir), point_blocks)
+
+            self.assertEqual(sorted(tiles.keys()), [(-123, 37), (-122, 36), (-122, 37)])
+
+            if max_open_tiles == 3:
+                self.assertEqual(len(tile_open.mock_calls), 3, 'Should open each tile once')
+
+            total = 0
+            for tile in tiles.values():
+                with gzip.open(tile.filename, 'rt', encoding='utf8') as file:
+                    rows = list(DictReader(file))
+                self.assertTrue(all(lonlat_key(float(row['LON']), float(row['LAT'])) == tile.key for row in rows))
+                total += len(rows)
+
+            self.assertEqual(total, 5305 + 4912, 'Should add up to the lengths of both outputs')
+
     def test_tile_publish(self):
         '''
         '''
         result, s3 = mock.Mock(), mock.Mock()
         result.source_base = 'xx/anytown'
-        point = Point(0., 0., result, dict(LAT='0.0', LON='0.0'))
+        point = Point(0., 0., result, b'0.0,0.0,1,Main St,,,,,,,')
 
         tile = Tile((0, 0), self.output_dir)
         tile.add_points([point])
@@ -4352,12 +5076,248 @@ class TestTileIndex (unittest.TestCase):
         self.assertEqual(_keyname, 'tiles/0.0/0.0.zip')
         self.assertEqual(names, ['addresses.csv', 'LICENSE.txt'])
 
-        lines = zipfile.read('addresses.csv').decode('utf8').split()
+        lines = zipfile.read('addresses.csv').decode('utf8').split('\r\n')
         self.assertEqual(lines[0], 'LON,LAT,NUMBER,STREET,UNIT,CITY,DISTRICT,REGION,POSTCODE,ID,HASH,OA:Source')
+        self.assertEqual(lines[1], '0.0,0.0,1,Main St,,,,,,,,xx/anytown')
 
         license = zipfile.read('LICENSE.txt').decode('utf8')
         self.assertEqual(license, summarize_result_licenses.return_value)
 
+    def test_split_tiles(self):
+        ''' Show that dense tiles are split into a pyramid of quadrant subtiles.
+        '''
+        result1, result2 = mock.Mock(), mock.Mock()
+        result1.source_base, result2.source_base = 'xx/anytown', 'xx/"other",town'
+
+        lonlats = [(-122.9, 37.9), (-122.8, 37.8), (-122.4, 37.6),
+                   (-122.3, 37.7), (-122.1, 37.9), (-122.9, 37.1)]
+        points = [Point(lon, lat, (result1 if i % 2 else result2), '{},{},{},"Main\nSt",,,,,,,'.format(lon, lat, i).encode('utf8'))
+                  for (i, (lon, lat)) in enumerate(lonlats)]
+
+        tile1, tile2 = Tile((-123, 37), self.output_dir), Tile((0, 0), self.output_dir)
+        tile1.add_points(points)
+        tile2.add_points([Point(0.5, 0.5, result1, b'0.5,0.5,1,Main St,,,,,,,')])
+
+        with patch('openaddr.ci.tileindex.TILE_ROW_BUDGET', new=2):
+            tiles = split_tiles([tile1, tile2])
+
+        manifest = make_tile_manifest(tiles)
+        self.assertEqual(manifest, {'-123,37': ['', '0', '2', '3', '30', '33'], '0,0': ['']})
+
+        subtiles = {tile.quadkey: tile for tile in tiles if tile.key == (-123, 37)}
+        self.assertEqual(subtiles['2'].count, 2)
+        self.assertEqual(subtiles['3'].count, 3)
+        self.assertEqual(subtiles['30'].results, {result1, result2})
+        self.assertEqual(subtiles['0'].results, {result1})
+
+        with gzip.open(subtiles['30'].filename, 'rt', newline='') as file:
+            rows = list(DictReader(file))
+
+        self.assertEqual([row['LON'] for row in rows], ['-122.4', '-122.3'])
+        self.assertEqual(rows[0]['STREET'], 'Main\nSt')
+        self.assertEqual(rows[0]['OA:Source'], 'xx/"other",town')
+
+        self.assertEqual(point_quadkey(-122.4, 37.6, 3), '300')
+        self.assertEqual(point_quadkey(0.5, 0.5, 1), '3')
+
+    def test_publish_tiles(self):
+        ''' Show that tiles are all published with complete address files.
+        '''
+        result, s3 = mock.Mock(), mock.Mock()
+        result.source_base = 'xx/anytown'
+        tiles = list()
+
+        for lon in range(-10, 10):
+            tile = Tile((lon, 0), self.output_dir)
+            tile.add_points([Point(lon + .5, .5, result, '{},0.5,{},Main St,,,,,,,'.format(lon + .5, n).encode('utf8'))
+                             for n in range(1000)])
+            tiles.append(tile)
+
+        uploads = dict()
+
+        def write_to_s3(s3_bucket, filename, keyname):
+            with ZipFile(filename, 'r') as zipfile:
+                uploads[keyname] = zipfile.read('addresses.csv').decode('utf8').split('\r\n')
+
+        with patch('openaddr.ci.collect.write_to_s3') as _write_to_s3:
+            _write_to_s3.side_effect = write_to_s3
+            with patch('openaddr.util.summarize_result_licenses') as summarize_result_licenses:
+                summarize_result_licenses.return_value = 'License'
+                publish_tiles(s3, tiles)
+
+        self.assertEqual(len(uploads), 20)
+        self.assertEqual(len(uploads['tiles/-10.0/0.0.zip']), 1002, 'Header, 1000 points, and empty last line')
+        self.assertEqual(uploads['tiles/9.0/0.0.zip'][1000], '9.5,0.5,999,Main St,,,,,,,,xx/anytown')
+
+class TestMirror (unittest.TestCase):
+
+    def setUp(self):
+        '''
+        '''
+        self.output_dir = mkdtemp(prefix='TestMirror-')
+        self.mirror_dir = join(self.output_dir, 'mirror')
+
+        self.downloads = list()
+        patcher = patch('openaddr.ci.mirror.download_processed_file')
+        self.download_processed_file = patcher.start()
+        self.download_processed_file.side_effect = self._download_processed_file
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        '''
+        '''
+        rmtree(self.output_dir)
+
+    def _download_processed_file(self, url):
+        self.downloads.append(url)
+        handle, filename = mkstemp(prefix='processed-', suffix='.zip', dir=self.output_dir)
+        os.write(handle, url.encode('utf8'))
+        close(handle)
+        return filename
+
+    def _run(self, id, process_hash):
+        url = 'http://s3.amazonaws.com/openaddresses/runs/{}/x.zip'.format(id)
+        state = RunState({'processed': url, 'process hash': process_hash})
+        return Run(id, 'sources/x.json', None, None, None, state,
+                   None, None, None, None, None, None, None, None)
+
+    def test_fetch(self):
+        ''' Show that processed files are downloaded once and keyed by hash or run ID.
+        '''
+        mirror = ProcessedMirror(self.mirror_dir)
+        run1, run2, run3 = self._run(1, 'abcdef'), self._run(2, 'abcdef'), self._run(3, None)
+
+        path1 = mirror.fetch(run1)
+        self.assertEqual(path1, join(self.mirror_dir, 'ab', 'abcdef.zip'))
+        self.assertEqual(mirror.fetch(run2), path1, 'Should share same processed file')
+
+        path3 = mirror.fetch(run3)
+        self.assertEqual(path3, join(self.mirror_dir, 'runs', '3.zip'))
+
+        self.assertEqual(self.downloads, [run1.state.processed, run3.state.processed])
+
+        # Links may be removed without affecting mirror.
+        filename = mirror.link_processed_file(run1)
+        self.assertNotEqual(filename, path1)
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), run1.state.processed.encode('utf8'))
+        remove(filename)
+        self.assertTrue(os.path.exists(path1))
+
+        # Another mirror on the same directory finds existing files.
+        self.assertEqual(ProcessedMirror(self.mirror_dir).fetch(run3), path3)
+        self.assertEqual(len(self.downloads), 2)
+
+    def test_evict(self):
+        ''' Show that least-recently used files are evicted past max_bytes.
+        '''
+        run1, run2, run3 = self._run(1, 'aaa'), self._run(2, 'bbb'), self._run(3, 'ccc')
+        size = len(run1.state.processed)
+        mirror = ProcessedMirror(self.mirror_dir, max_bytes=size * 2)
+
+        path1, path2 = mirror.fetch(run1), mirror.fetch(run2)
+        utime(path1, (1000, 1000))
+        utime(path2, (2000, 2000))
+
+        # Use the older file again so it is more recently used.
+        mirror.fetch(run1)
+        path3 = mirror.fetch(run3)
+
+        self.assertTrue(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertTrue(os.path.exists(path3))
+
+    def test_link_evicted(self):
+        ''' Show that files evicted between fetch and link are fetched again.
+        '''
+        mirror = ProcessedMirror(self.mirror_dir)
+        run1 = self._run(1, 'abcdef')
+        path1 = mirror.fetch(run1)
+        links = list()
+
+        def evicting_link(source, destination):
+            # Another process evicts the file just before the first link.
+            if not links:
+                remove(source)
+            links.append(source)
+            return os.link(source, destination)
+
+        with patch('openaddr.ci.mirror.link') as link:
+            link.side_effect = evicting_link
+            filename = mirror.link_processed_file(run1)
+
+        self.assertEqual(links, [path1, path1])
+        self.assertEqual(len(self.downloads), 2, 'Should have downloaded again')
+        with open(filename, 'rb') as file:
+            self.assertEqual(file.read(), run1.state.processed.encode('utf8'))
+        remove(filename)
+
+        # Files evicted before fetch are downloaded again.
+        remove(path1)
+        self.assertEqual(mirror.fetch(run1), path1)
+        self.assertEqual(len(self.downloads), 3)
+
+    def test_link_copied(self):
+        ''' Show that files are copied into place when they cannot be linked.
+        '''
+        mirror = ProcessedMirror(self.mirror_dir)
+        run1 = self._run(1, 'abcdef')
+
+        renames = list()
+
+        def cross_device_rename(source, destination):
+            # Downloaded file is on another filesystem from the mirror.
+            renames.append((source, destination))
+            if len(renames) == 1:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return os.rename(source, destination)
+
+        with patch('openaddr.ci.mirror.link') as link, \
+             patch('openaddr.ci.mirror.rename') as rename:
+            link.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename.side_effect = cross_device_rename
+            path1 = mirror.fetch(run1)
+            filename = mirror.link_processed_file(run1)
+
+        # Copies land beside their destinations and are then renamed into place.
+        self.assertEqual(len(renames), 3)
+        (copied1, dest1), (copied2, dest2) = renames[1:]
+        self.assertEqual((os.path.dirname(copied1), dest1), (os.path.dirname(path1), path1))
+        self.assertEqual((os.path.dirname(copied2), dest2), (os.path.dirname(filename), filename))
+        self.assertFalse(os.path.exists(renames[0][0]), 'Should have removed download')
+        self.assertEqual(os.listdir(os.path.dirname(path1)), [os.path.basename(path1)])
+
+        for path in (path1, filename):
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), run1.state.processed.encode('utf8'))
+        remove(filename)
+
+    def test_sync_and_iterate(self):
+        ''' Show that synced files are used by iterate_local_processed_files().
+        '''
+        mirror = ProcessedMirror(self.mirror_dir)
+        runs = [self._run(1, 'aaa'), self._run(2, 'bbb'), self._run(3, None)]
+        runs[2].state.processed = None
+
+        paths = sync_mirror(mirror, runs)
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(len(self.downloads), 2)
+
+        results = list()
+        for result in iterate_local_processed_files(runs, mirror=mirror):
+            with open(result.filename, 'rb') as file:
+                results.append((result.filename, file.read()))
+
+        self.assertEqual(len(self.downloads), 2, 'Should not have downloaded again')
+        self.assertEqual(sorted(content for (_, content) in results),
+                         [run.state.processed.encode('utf8') for run in runs[:2]])
+
+        for (filename, _) in results:
+            self.assertFalse(os.path.exists(filename), 'Should have removed link')
+
+        for path in paths:
+            self.assertTrue(os.path.exists(path), 'Should have kept mirror')
+
 class TestLogging (unittest.TestCase):
 
     def test_cloudwatch(self):
@@ -5,21 +5,25 @@ from sys import stderr
 from os import environ
 from shutil import rmtree
 from os.path import join
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 from urllib.parse import parse_qsl
 from zipfile import ZipFile
 from datetime import date
-import unittest
+from time import sleep
+import unittest, json, sqlite3, threading
 
 import mock
 from httmock import HTTMock, response
 
 from .. import LocalProcessedResult
-from ..ci.objects import RunState
+from ..ci.objects import RunState, Run
 
 from ..dotmap import (
-    stream_all_features, call_tippecanoe, _upload_to_s3,
-    _mapbox_get_credentials, _mapbox_create_upload
+    stream_all_feature_points, iterate_quadrant_batches, finish_quadrant_tileset,
+    call_tippecanoe, PipeWriter, build_tilesets, update_tilesets, read_state,
+    write_state, lonlat_region, lonlat_buffer_regions, region_tile_bounds,
+    stream_tracked_feature_points, point_quadrants, REGION_ZOOM, QUADRANTS,
+    _upload_to_s3, _mapbox_get_credentials, _mapbox_create_upload
     )
 
 class TestDotmap (unittest.TestCase):
@@ -43,31 +47,266 @@ class TestDotmap (unittest.TestCase):
     def tearDown(self):
         rmtree(self.test_dir)
 
-    def test_stream_all_features_no_runs(self):
-        features = list(stream_all_features(self.results[:0]))
-        self.assertEqual(len(features), 0)
-
-    def test_stream_all_features_one_run(self):
-        features = list(stream_all_features(self.results[:1]))
-
-        p1, p2 = [f['geometry']['coordinates'] for f in features]
-        self.assertAlmostEqual(p1[0],    0.0)
-        self.assertAlmostEqual(p1[1],    0.0)
-        self.assertAlmostEqual(p2[0], -122.271210)
-        self.assertAlmostEqual(p2[1],   37.804319)
-
-    def test_stream_all_features_two_runs(self):
-        features = list(stream_all_features(self.results[:2]))
-
-        p1, p2, p3, p4 = [f['geometry']['coordinates'] for f in features]
-        self.assertAlmostEqual(p1[0],    0.0)
-        self.assertAlmostEqual(p1[1],    0.0)
-        self.assertAlmostEqual(p2[0], -122.271210)
-        self.assertAlmostEqual(p2[1],   37.804319)
-        self.assertAlmostEqual(p3[0],    0.0)
-        self.assertAlmostEqual(p3[1],    0.0)
-        self.assertAlmostEqual(p4[0], -122.413729)
-        self.assertAlmostEqual(p4[1],   37.775641)
+    def test_stream_all_feature_points_no_runs(self):
+        points = list(stream_all_feature_points(self.results[:0]))
+        self.assertEqual(len(points), 0)
+
+    def test_stream_all_feature_points_two_runs(self):
+        points = list(stream_all_feature_points(self.results[:2]))
+        self.assertEqual(len(points), 4)
+
+        for (lon, lat, line) in points:
+            feature = json.loads(line)
+            self.assertEqual(feature['geometry']['coordinates'], [lon, lat])
+
+        (lon1, lat1, _), (lon2, lat2, _), (lon3, lat3, _), (lon4, lat4, line4) = points
+        self.assertAlmostEqual(lon1,    0.0)
+        self.assertAlmostEqual(lat1,    0.0)
+        self.assertAlmostEqual(lon2, -122.271210)
+        self.assertAlmostEqual(lat2,   37.804319)
+        self.assertAlmostEqual(lon3,    0.0)
+        self.assertAlmostEqual(lat3,    0.0)
+        self.assertAlmostEqual(lon4, -122.413729)
+        self.assertAlmostEqual(lat4,   37.775641)
+
+        self.assertEqual(json.loads(line4)['properties'], {'CITY': u'Wómp Wómp'})
+
+    def test_iterate_quadrant_batches(self):
+        points = [(-122.2, 37.8, 'oakland\n'), (139.8, 35.7, 'tokyo\n'),
+                  (151.2, -33.9, 'sydney\n'), (-56.2, -34.9, 'montevideo\n'),
+                  (-122.4, 37.7, 'sf\n'), (0., 0., 'null island\n')]
+
+        batches = list(iterate_quadrant_batches(iter(points), 12))
+        self.assertEqual(batches, [('northeast', b'tokyo\nnull island\n'), ('northwest', b'oakland\nsf\nnull island\n'),
+                                   ('southeast', b'sydney\nnull island\n'), ('southwest', b'montevideo\nnull island\n')],
+                         'Null Island should be in the buffer of every quadrant')
+
+        lines = [line for (_, _, line) in stream_all_feature_points(self.results[:2])]
+        batches = dict(iterate_quadrant_batches(stream_all_feature_points(self.results[:2])))
+        self.assertEqual(sorted(batches.keys()), ['northeast', 'northwest', 'southeast', 'southwest'])
+        self.assertEqual(batches['northeast'], (lines[0] + lines[2]).encode('utf8'))
+        self.assertEqual(batches['northwest'], ''.join(lines).encode('utf8'))
+
+    def test_point_quadrants(self):
+        self.assertEqual(point_quadrants(-122.2, 37.8), {'northwest'})
+        self.assertEqual(point_quadrants(151.2, -33.9), {'southeast'})
+        self.assertEqual(point_quadrants(-0.1, 51.5), {'northwest', 'northeast'}, 'London is next to the meridian')
+        self.assertEqual(point_quadrants(-78.5, -0.2), {'southwest', 'northwest'}, 'Quito is next to the equator')
+        self.assertEqual(point_quadrants(-0.2, 5.6), {'northwest', 'northeast'}, 'Accra is next to the meridian')
+        self.assertEqual(point_quadrants(1., 1.), set(QUADRANTS.keys()))
+        self.assertEqual(point_quadrants(-0.1, 51.5, 0), {'northwest'})
+        self.assertEqual(point_quadrants(5., 51.5), {'northeast'}, 'Amsterdam is outside the buffer')
+
+    def test_finish_quadrant_tileset(self):
+        filenames = [join(self.test_dir, name) for name in ('hi.mbtiles', 'lo.mbtiles', 'out.mbtiles')]
+
+        def join_tilesets(out_filename, in1_filename, in2_filename):
+            with sqlite3.connect(out_filename) as db:
+                db.execute('create table metadata (name text, value text)')
+                db.executemany('insert into metadata values (?, ?)',
+                               [('name', 'x'), ('description', 'x'), ('center', 'x'), ('bounds', 'x')])
+                db.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+
+                # Tiles on each side of the meridian and equator, from buffer points.
+                db.executemany('insert into tiles values (?, ?, ?, ?)', [(0, 0, 0, b'world'),
+                    (1, 1, 0, b'southeast'), (1, 0, 0, b'southwest'), (1, 1, 1, b'northeast'),
+                    (14, 8192, 8191, b'southeast'), (14, 8191, 8191, b'southwest'),
+                    (14, 8192, 8192, b'northeast'), (14, 8191, 8192, b'northwest')])
+
+        for filename in filenames[:2]:
+            open(filename, 'w').close()
+
+        with mock.patch('openaddr.dotmap.join_tilesets') as _join_tilesets:
+            _join_tilesets.side_effect = join_tilesets
+            out_filename = finish_quadrant_tileset('', 'southeast', *filenames)
+
+        self.assertEqual(out_filename, filenames[2])
+        self.assertEqual(_join_tilesets.mock_calls[0][1], (filenames[2], filenames[0], filenames[1]))
+
+        with sqlite3.connect(out_filename) as db:
+            metadata = dict(db.execute('select name, value from metadata'))
+
+        self.assertEqual(metadata['bounds'], '0,-85.05,180,0')
+        self.assertEqual(metadata['center'], '151.2073,-33.8686,13')
+        self.assertEqual(metadata['name'], 'OpenAddresses {} Southeast'.format(date.today()))
+
+        with sqlite3.connect(out_filename) as db:
+            tiles = sorted(db.execute('select zoom_level, tile_column, tile_row, tile_data from tiles'))
+
+        self.assertEqual(tiles, [(0, 0, 0, b'world'), (1, 1, 0, b'southeast'), (14, 8192, 8191, b'southeast')],
+                         'Tiles across the meridian or equator should be cropped')
+
+    def test_pipe_writer(self):
+        process1, process2, written = mock.Mock(), mock.Mock(), list()
+        process1.stdin.write.side_effect = lambda batch: (sleep(.01), written.append(batch))
+        process2.stdin.write.side_effect = BrokenPipeError('Exited early')
+
+        writer1 = PipeWriter(process1, 'one')
+        writer2 = PipeWriter(process2, 'two')
+
+        for batch in (b'a', b'b', b'c'):
+            writer1.write(batch)
+
+        writer2.write(b'a')
+        writer1.close()
+
+        self.assertEqual(written, [b'a', b'b', b'c'])
+        self.assertEqual(len(process1.stdin.close.mock_calls), 1)
+
+        with self.assertRaises(RuntimeError) as error:
+            for batch in [b'b'] * 100:
+                writer2.write(batch)
+            writer2.close()
+
+        self.assertIn('two', str(error.exception))
+        self.assertEqual(len(process2.stdin.write.mock_calls), 1, 'Should stop writing after an error')
+
+    def test_build_tilesets_failed(self):
+        processes = dict()
+
+        def call_tippecanoe(mbtiles_filename, include_properties):
+            process = processes[include_properties] = mock.Mock()
+            if include_properties:
+                process.stdin.write.side_effect = BrokenPipeError('Exited early')
+            return process
+
+        with mock.patch('openaddr.dotmap.call_tippecanoe') as _call_tippecanoe, \
+             mock.patch('openaddr.dotmap.iterate_quadrant_batches') as _iterate_quadrant_batches, \
+             mock.patch('openaddr.dotmap.mkstemp') as _mkstemp:
+            _call_tippecanoe.side_effect = call_tippecanoe
+            _mkstemp.side_effect = lambda **kwargs: mkstemp(dir=self.test_dir, **kwargs)
+            _iterate_quadrant_batches.return_value = iter([('northwest', b'a')] * 100)
+
+            with self.assertRaises(RuntimeError) as error:
+                build_tilesets('', [])
+
+        self.assertIn('tippecanoe northwest hi', str(error.exception))
+        self.assertEqual(len(processes[True].kill.mock_calls), 1)
+        self.assertEqual(len(processes[False].kill.mock_calls), 1)
+        self.assertEqual(len(processes[False].stdin.close.mock_calls), 1)
+
+        threads = [thread.name for thread in threading.enumerate() if thread.name.startswith('tippecanoe ')]
+        self.assertEqual(threads, [], 'Writer threads should all have exited')
+
+    def test_regions(self):
+        oakland, sydney = lonlat_region(-122.27, 37.80), lonlat_region(151.21, -33.87)
+        count = 2**REGION_ZOOM
+
+        self.assertEqual(lonlat_region(-180, 90), (0, 0))
+        self.assertEqual(lonlat_region(180, -90), (count - 1, count - 1))
+        self.assertTrue(oakland[0] < count/2 and oakland[1] < count/2)
+        self.assertTrue(sydney[0] >= count/2 and sydney[1] >= count/2)
+
+        x, y = oakland
+        self.assertEqual(region_tile_bounds(oakland, REGION_ZOOM), (x, x, count - 1 - y, count - 1 - y))
+        self.assertEqual(region_tile_bounds(oakland, REGION_ZOOM + 2),
+                         (x * 4, x * 4 + 3, (count - 1 - y) * 4, (count - 1 - y) * 4 + 3))
+
+        self.assertEqual(lonlat_buffer_regions(-121.64, 38.2), {oakland})
+        self.assertEqual(lonlat_buffer_regions(-122.27, 37.80), {oakland, (x - 1, y)})
+        self.assertEqual(lonlat_buffer_regions(-122.36, 37.80), {oakland, (x - 1, y)})
+        self.assertEqual(lonlat_buffer_regions(-180, 90), {(0, 0)})
+
+        sources = dict()
+        points = list(stream_tracked_feature_points(self.results[:2], sources))
+        self.assertEqual(len(points), 4)
+        self.assertEqual(sources['us/anytown']['regions'], sorted({lonlat_region(0, 0), oakland}))
+
+    def _make_mbtiles(self, filename, tiles):
+        with sqlite3.connect(filename) as db:
+            db.execute('create table metadata (name text, value text)')
+            db.executemany('insert into metadata values (?, ?)', [('name', 'x'), ('description', 'x'), ('center', 'x'), ('bounds', 'x')])
+            db.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+            db.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row)')
+            db.executemany('insert into tiles values (?, ?, ?, ?)', tiles)
+
+    def _read_tiles(self, filename):
+        with sqlite3.connect(filename) as db:
+            return sorted(db.execute('select zoom_level, tile_column, tile_row, tile_data from tiles'))
+
+    def test_update_tilesets(self):
+        ''' Show that only tiles in regions of changed sources are replaced.
+        '''
+        state_dir = join(self.test_dir, 'state')
+        oakland, seattle = lonlat_region(-122.27, 37.80), lonlat_region(-122.33, 47.61)
+        new_york, sydney = lonlat_region(-74.0, 40.7), lonlat_region(151.21, -33.87)
+        west_oakland = lonlat_region(-123.0, 37.80)
+        self.assertEqual(west_oakland, (oakland[0] - 1, oakland[1]))
+
+        def tile(region, zoom, data):
+            column, _, row, _ = region_tile_bounds(region, zoom)
+            return zoom, column, row, data
+
+        old_sources = {
+            'us/a': {'process hash': 'a1', 'regions': [oakland]},
+            'us/b': {'process hash': 'b1', 'regions': [seattle]},
+            'au/gone': {'process hash': 'g1', 'regions': [sydney]},
+            'us/ny': {'process hash': 'n1', 'regions': [new_york]},
+            'us/west': {'process hash': 'w1', 'regions': [west_oakland]},
+            }
+
+        mbtiles_filenames = dict()
+        for quadrant in ('northwest', 'northeast', 'southeast', 'southwest'):
+            mbtiles_filenames[quadrant] = join(self.test_dir, '{}.mbtiles'.format(quadrant))
+            self._make_mbtiles(mbtiles_filenames[quadrant], [])
+
+        with sqlite3.connect(mbtiles_filenames['northwest']) as db:
+            db.executemany('insert into tiles values (?, ?, ?, ?)', [tile(oakland, 15, b'old oakland'),
+                tile(seattle, 15, b'old seattle'), tile(new_york, 15, b'old new york'),
+                tile(west_oakland, 15, b'old west'), (5, 5, 20, b'low zoom')])
+        with sqlite3.connect(mbtiles_filenames['southeast']) as db:
+            db.execute('insert into tiles values (?, ?, ?, ?)', tile(sydney, 12, b'old sydney'))
+
+        write_state(state_dir, mbtiles_filenames, old_sources)
+        state = read_state(state_dir)
+        self.assertEqual(state['sources'], old_sources)
+
+        # Source us/b has moved from Seattle to Oakland, and au/gone is gone.
+        files = dict()
+        for (source_base, hash, content) in [('us/a', 'a1', u'LON,LAT\n-122.28,37.81\n139.77,35.68\n'),
+                                             ('us/b', 'b2', u'LON,LAT\n-122.27,37.80\n'),
+                                             ('us/ny', 'n1', u'LON,LAT\n-74.0,40.7\n'),
+                                             ('us/west', 'w1', u'LON,LAT\n-123.0,37.80\n-122.36,37.80\n')]:
+            files[source_base] = join(self.test_dir, source_base.replace('/', '-') + '.zip')
+            with ZipFile(files[source_base], 'w') as zf:
+                zf.writestr('addresses.csv', content)
+
+        runs = [Run(None, 'sources/{}.json'.format(source_base), None, None, None,
+                    RunState({'processed': files[source_base], 'process hash': hash}),
+                    None, None, None, None, None, None, None, None)
+                for (source_base, hash) in [('us/a', 'a1'), ('us/b', 'b2'), ('us/ny', 'n1'), ('us/west', 'w1')]]
+
+        def iterate_local_processed_files(runs, mirror):
+            for run in runs:
+                source_base = run.source_path[8:-5]
+                yield LocalProcessedResult(source_base, files[source_base], run.state, None)
+
+        def build_tilesets(name_prefix, points):
+            patch_filename = join(self.test_dir, 'patch.mbtiles')
+            built_points.extend(points)
+            self._make_mbtiles(patch_filename, [tile(oakland, 15, b'new oakland'), tile(oakland, 14, b'new oakland 14'),
+                                                tile(west_oakland, 15, b'clipped west')])
+            return {'northwest': patch_filename}
+
+        built_points = list()
+
+        with mock.patch('openaddr.dotmap.iterate_local_processed_files') as _iterate_local_processed_files, \
+             mock.patch('openaddr.dotmap.build_tilesets') as _build_tilesets:
+            _iterate_local_processed_files.side_effect = iterate_local_processed_files
+            _build_tilesets.side_effect = build_tilesets
+            mbtiles_filenames, sources = update_tilesets('', runs, state, state_dir, None)
+
+        self.assertEqual([(lon, lat) for (lon, lat, _) in built_points], [(-122.28, 37.81), (-122.27, 37.80), (-122.36, 37.80)],
+                         'Only points in or just outside Oakland, Seattle, and Sydney should be rebuilt')
+
+        self.assertEqual(sorted(sources.keys()), ['us/a', 'us/b', 'us/ny', 'us/west'])
+        self.assertEqual(sources['us/b'], {'process hash': 'b2', 'regions': [oakland]})
+        self.assertEqual(mbtiles_filenames['northwest'], join(state_dir, 'northwest.mbtiles'))
+
+        self.assertEqual(self._read_tiles(mbtiles_filenames['northwest']), sorted([
+            tile(oakland, 15, b'new oakland'), tile(oakland, 14, b'new oakland 14'),
+            tile(new_york, 15, b'old new york'), tile(west_oakland, 15, b'old west'), (5, 5, 20, b'low zoom')]))
+        self.assertEqual(self._read_tiles(mbtiles_filenames['southeast']), [])
 
     def test_call_tippecanoe(self):
         '''
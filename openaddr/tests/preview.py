@@ -4,11 +4,16 @@ import os
 import unittest
 import tempfile
 import subprocess
+import sqlite3
+import gzip
 
 from os.path import join, dirname
 from zipfile import ZipFile
 from shutil import rmtree
 
+import numpy
+
+from unittest import mock
 from httmock import HTTMock, response
 
 from .. import preview
@@ -41,6 +46,58 @@ class TestPreview (unittest.TestCase):
         bbox = preview.calculate_bounds(points_filename)
         self.assertEqual(bbox, (-1.04, -1.04, 1.04, 1.04), 'The two outliers are ignored')
 
+    def test_read_write_points(self):
+        points = [(n, -n) for n in range(12345)]
+        points_filename = join(self.temp_dir, 'points.bin')
+        preview.write_points(iter(points), points_filename)
+
+        array = preview.read_points(points_filename)
+        self.assertEqual(array.shape, (12345, 2))
+        self.assertEqual([tuple(point) for point in array.tolist()], points)
+
+        preview.write_points([], points_filename)
+        self.assertEqual(preview.read_points(points_filename).shape, (0, 2))
+
+    def test_project_lonlats(self):
+        lonlats = [(0, 0), (-122.2708, 37.8044), (180, 0), (0, 90), (0, -90)]
+        arrays = list(preview.project_lonlats(lonlats))
+        self.assertEqual(len(arrays), 1)
+
+        points = arrays[0].tolist()
+        self.assertEqual(len(points), 3, 'Points at the poles should be dropped')
+        self.assertAlmostEqual(points[0][0], 0)
+        self.assertAlmostEqual(points[0][1], 0)
+        self.assertAlmostEqual(points[1][0], -13611123.195, places=3)
+        self.assertAlmostEqual(points[1][1], 4551830.824, places=3)
+        self.assertAlmostEqual(points[2][0], preview.EARTH_DIAMETER / 2)
+
+    def test_density_pixels(self):
+        points = [(.5, .5)] * 9 + [(2.5, .5), (-1, .5), (.5, 3.5)]
+        matrix = 1, 0, 0, -1, 0, 3
+        pixels = preview.density_pixels(numpy.array(points), matrix, 4, 3, (1, .5, 0))
+
+        self.assertEqual(pixels.shape, (3, 4))
+        self.assertEqual(pixels.dtype, numpy.uint32)
+
+        alphas, reds, greens, blues = pixels >> 24, (pixels >> 16) & 0xFF, (pixels >> 8) & 0xFF, pixels & 0xFF
+        self.assertEqual(alphas[2,0], 0xFF, 'Densest pixel should be opaque')
+        self.assertEqual(alphas[2,2], round(preview.DENSITY_MIN_ALPHA * 0xFF))
+        self.assertEqual(alphas.astype(bool).sum(), 2, 'Points outside should be skipped')
+        self.assertEqual((reds[2,0], greens[2,0], blues[2,0]), (0xFF, 0x80, 0x00))
+        self.assertEqual((reds[2,2], greens[2,2], blues[2,2]), (0x66, 0x33, 0x00))
+
+    def test_draw_density(self):
+        points = [(.5, .5)] * 9 + [(2.5, .5), (-1, .5), (.5, 3.5)]
+        surface, context, _ = preview.make_context(0, 0, 4, 3, width=4)
+        preview.draw_density(context, numpy.array(points), (1, .5, 0))
+
+        surface.flush()
+        data = numpy.frombuffer(bytes(surface.get_data()), dtype=numpy.uint32)
+        pixels = data.reshape(3, surface.get_stride() // 4)[:,:4]
+
+        expected = preview.density_pixels(numpy.array(points), (1, 0, 0, -1, 0, 3), 4, 3, (1, .5, 0))
+        self.assertEqual(pixels.tolist(), expected.tolist())
+
     def test_render_zip(self):
         '''
         '''
@@ -125,4 +182,65 @@ class TestPreview (unittest.TestCase):
         self.assertEqual(len(water_geoms), 1, 'Should have 1 water geometry')
         self.assertEqual(len(roads_geoms), 792, 'Should have 792 road geometries')
 
+    def test_get_map_features_cached_and_local(self):
+        ''' Show that cached, directory, and MBTiles tiles match tiles from Mapbox.
+        '''
+        requested = list()
+
+        def response_content(url, request):
+            if url.hostname == 'a.tiles.mapbox.com' and url.path.startswith('/v4/mapbox.mapbox-streets-v7'):
+                requested.append(url.path)
+                with open(join(dirname(__file__), 'data', 'mapbox-tile.mvt'), 'rb') as file:
+                    data = file.read()
+                return response(200, data, headers={'Content-Type': 'application/vnd.mapbox-vector-tile'})
+            raise Exception("Unknown URL")
+
+        def offline_content(url, request):
+            raise Exception("Offline")
+
+        xmin, ymin, xmax, ymax = -13611952, 4551290, -13609564, 4553048
+        scale = 100 / (xmax - xmin)
+        cache_dir = join(self.temp_dir, 'cache')
+
+        with HTTMock(response_content):
+            features1 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX', cache_dir=cache_dir)
+
+        self.assertEqual(requested, ['/v4/mapbox.mapbox-streets-v7/12/656/1582.mvt'])
+        tile_path = join(cache_dir, '12', '656', '1582.mvt')
+        self.assertTrue(os.path.exists(tile_path))
+
+        # Cached tiles and a directory of the same tiles need no network.
+        with HTTMock(offline_content):
+            features2 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX', cache_dir=cache_dir)
+            features3 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, None, tile_source=cache_dir)
+
+        # Build an MBTiles file with gzipped tile data and TMS rows.
+        mbtiles_filename = join(self.temp_dir, 'tiles.mbtiles')
+
+        with sqlite3.connect(mbtiles_filename) as db, open(tile_path, 'rb') as file:
+            db.execute('CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+            db.execute('INSERT INTO tiles VALUES (?, ?, ?, ?)', (12, 656, 2**12 - 1 - 1582, gzip.compress(file.read())))
+
+        with HTTMock(offline_content):
+            features4 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, None, tile_source=mbtiles_filename)
+
+        for features in (features1, features2, features3, features4):
+            self.assertEqual([len(geoms) for geoms in features], [90, 1, 792])
+
+        # Expired cache tiles are requested again.
+        with mock.patch('openaddr.preview.time') as time, HTTMock(response_content):
+            time.return_value = os.path.getmtime(tile_path) + preview.TILE_CACHE_TTL
+            preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX', cache_dir=cache_dir)
+
+        self.assertEqual(len(requested), 2)
+
+        # Failed cache writes leave no temporary files behind.
+        with mock.patch('openaddr.preview.time') as time, HTTMock(response_content), \
+             mock.patch('os.rename') as rename:
+            time.return_value = os.path.getmtime(tile_path) + preview.TILE_CACHE_TTL
+            rename.side_effect = OSError('Disk full')
+
+            with self.assertRaises(OSError):
+                preview.get_tile_data(12, 656, 1582, 'mapbox-XXXX', cache_dir=cache_dir)
 
+        self.assertEqual(os.listdir(dirname(tile_path)), ['1582.mvt'])
@@ -7,6 +7,7 @@ import tempfile
 import subprocess
 
 from os.path import join, dirname
+from shutil import rmtree
 
 from .. import render
 from mock import patch, Mock
@@ -46,6 +47,63 @@ class TestRender (unittest.TestCase):
         finally:
             os.remove(filename)
 
+    def test_load_coverages(self):
+        sources = join(dirname(__file__), 'sources')
+        coverages = render.load_coverages(sources)
+
+        self.assertEqual(set(coverages.keys()), set(render.iterate_sources_dir(sources)))
+        self.assertEqual(render.load_geoids(sources, set(), coverages), render.load_geoids(sources, set()))
+        self.assertEqual(render.load_iso3166s(sources, set(), coverages), render.load_iso3166s(sources, set()))
+
+        # Coverage is read from the given objects instead of the directory.
+        good_geoids, bad_geoids = render.load_geoids(sources, {'x.json'}, {'x.json': {'US Census': {'geoid': '06'}}})
+        self.assertEqual(good_geoids, {'06': {'x.json'}})
+        self.assertEqual(bad_geoids, {})
+
+    def test_index_features(self):
+        features = [Mock(), Mock(), Mock()]
+        for (feature, geoid) in zip(features, ('06', '41', '06')):
+            feature.GetFieldAsString.side_effect = {'GEOID': geoid}.get
+
+        index = render.index_features(features, 'GEOID')
+        self.assertEqual(dict(index), {'06': [features[0], features[2]], '41': [features[1]]})
+        self.assertEqual(render.select_features(index, {'06', '53'}), [features[0], features[2]])
+        self.assertEqual(render.select_features(index, []), [])
+
+    def test_load_state_borders(self):
+        cache_dir = tempfile.mkdtemp(prefix='test_load_state_borders-')
+        us_state_features = render.open_datasources(render.USA)[7]
+
+        try:
+            with patch.dict(render._state_borders, clear=True):
+                borders1 = render.load_state_borders(render.USA, us_state_features, cache_dir)
+
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertGreater(len(borders1), 50)
+
+            # Borders come from the disk cache without any state features.
+            with patch.dict(render._state_borders, clear=True):
+                borders2 = render.load_state_borders(render.USA, [], cache_dir)
+
+            self.assertEqual([b.ExportToWkt() for b in borders2], [b.ExportToWkt() for b in borders1])
+        finally:
+            rmtree(cache_dir)
+
+    def test_preload_geodata(self):
+        geodata = {area: [Mock() for i in range(9)] for area in (render.USA, render.WORLD)}
+
+        with patch('openaddr.render.open_datasources') as open_datasources, \
+             patch('openaddr.render.load_state_borders') as load_state_borders:
+            open_datasources.side_effect = lambda area: geodata[render.USA if area == render.USA else render.WORLD]
+            render.preload_geodata({render.WORLD, render.USA, render.EUROPE})
+
+        self.assertEqual({call[1][0] for call in open_datasources.mock_calls},
+                         {render.WORLD, render.USA, render.EUROPE})
+        self.assertEqual(len(load_state_borders.mock_calls), 3)
+        load_state_borders.assert_any_call(render.WORLD, geodata[render.WORLD][7])
+        load_state_borders.assert_any_call(render.USA, geodata[render.USA][7])
+        load_state_borders.assert_any_call(render.EUROPE, geodata[render.WORLD][7])
+
     def test_load_live_state(self):
         def response_state_txt(url, request):
             if (url.hostname, url.path) == ('results.openaddresses.io', '/state.txt'):
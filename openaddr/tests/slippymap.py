@@ -1,6 +1,7 @@
 from __future__ import division
 
 import os
+import json
 import unittest
 import tempfile
 import mock
@@ -30,7 +31,13 @@ class TestSlippyMap (unittest.TestCase):
             with mock.patch('subprocess.Popen') as Popen:
                 slippymap.generate(mbtiles_filename, zip_filename)
 
-            self.assertEqual(len(Popen.return_value.stdin.write.mock_calls), 2 * 5305)
+            written = b''.join(call[1][0] for call in Popen.return_value.stdin.write.mock_calls)
+            features = [json.loads(line) for line in written.decode('utf8').splitlines()]
+            self.assertEqual(len(Popen.return_value.stdin.write.mock_calls), 1, 'Should write one batch')
+            self.assertEqual(len(features), 5305)
+            self.assertEqual(features[0]['type'], 'Feature')
+            self.assertEqual(features[0]['geometry']['type'], 'Point')
+            self.assertNotIn('LON', features[0]['properties'])
             self.assertEqual(len(Popen.return_value.stdin.close.mock_calls), 1)
             self.assertEqual(Popen.mock_calls[0][1][0],
                 ('tippecanoe', '-l', 'dots', '-r', '3', '-n', 'OpenAddresses Dots',
@@ -56,7 +63,8 @@ class TestSlippyMap (unittest.TestCase):
             with mock.patch('subprocess.Popen') as Popen:
                 slippymap.generate(mbtiles_filename, csv_filename)
 
-            self.assertEqual(len(Popen.return_value.stdin.write.mock_calls), 2 * 767)
+            written = b''.join(call[1][0] for call in Popen.return_value.stdin.write.mock_calls)
+            self.assertEqual(len(written.splitlines()), 767)
             self.assertEqual(len(Popen.return_value.stdin.close.mock_calls), 1)
             self.assertEqual(Popen.mock_calls[0][1][0],
                 ('tippecanoe', '-l', 'dots', '-r', '3', '-n', 'OpenAddresses Dots',
@@ -65,3 +73,32 @@ class TestSlippyMap (unittest.TestCase):
             os.remove(mbtiles_filename)
             os.remove(csv_filename)
             os.rmdir(temp_dir)
+
+    def test_iterate_feature_lines(self):
+        ''' Show that feature lines match JSON-encoded features.
+        '''
+        rows = iter([
+            ['LON', 'LAT', 'NUMBER', 'STREET', 'UNIT'],
+            ['-122.2359742', '37.7362507', '85', u'MAITLAND "DR" Wómp', ''],
+            ['-122.2353881', '37.7223605', '1360'],
+            ['yo', '37.7223605', '1360', 'S LOOP RD', ''],
+            ['-200', '37.7', '1', 'OFF EARTH', ''],
+            ['nan', '37.7', '1', 'NOT A NUMBER', ''],
+            ])
+
+        lines = list(slippymap.iterate_feature_lines(rows))
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [-122.2359742, 37.7362507]},
+            'properties': {'NUMBER': '85', 'STREET': u'MAITLAND "DR" Wómp', 'UNIT': ''}})
+        self.assertEqual(json.loads(lines[1])['properties'], {'NUMBER': '1360', 'STREET': None, 'UNIT': None})
+        self.assertEqual(json.loads(lines[2])['geometry']['coordinates'], [-200., 37.7])
+        self.assertEqual(lines[0], json.dumps(json.loads(lines[0])) + '\n')
+
+        rows = iter([['LON', 'LAT'], ['-200', '37.7'], ['-122', '37.7']])
+        lines = list(slippymap.iterate_feature_lines(rows, on_earth=True))
+        self.assertEqual(len(lines), 1)
+
+        batches = list(slippymap.iterate_line_batches(['a\n', 'b\n', 'c\n', u'ó\n', 'e\n'], 4))
+        self.assertEqual(batches, [b'a\nb\n', b'c\n\xc3\xb3\n', b'e\n'])
@@ -18,12 +18,14 @@ setup(
             'openaddr-preview-source = openaddr.preview:main',
             'openaddr-process-one = openaddr.process_one:main',
             'openaddr-ci-recreate-db = openaddr.ci.recreate_db:main',
+            'openaddr-ci-upgrade-db = openaddr.ci.recreate_db:upgrade_main',
             'openaddr-ci-run-dequeue = openaddr.ci.run_dequeue:main',
             'openaddr-ci-worker = openaddr.ci.worker:main',
             'openaddr-enqueue-sources = openaddr.ci.enqueue:main',
             'openaddr-collect-extracts = openaddr.ci.collect:main',
             'openaddr-index-tiles = openaddr.ci.tileindex:main',
             'openaddr-update-dotmap = openaddr.dotmap:main',
+            'openaddr-sync-mirror = openaddr.ci.mirror:main',
             'openaddr-sum-up-data = openaddr.ci.sum_up:main',
             'openaddr-calculate-coverage = openaddr.ci.coverage.calculate:main',
         ]
@@ -34,7 +36,7 @@ setup(
             'geodata/*.cpg', 'VERSION',
         ],
         'openaddr.ci': [
-            'schema.pgsql', 'templates/*.*', 'static/*.*'
+            'schema.pgsql', 'upgrade.pgsql', 'templates/*.*', 'static/*.*'
         ],
         'openaddr.ci.coverage': [
             'schema.pgsql'
@@ -121,5 +123,9 @@ setup(
         'pyclipper==1.1.0',
         'six==1.11.0',
 
+        # Used in openaddr.preview for vectorized point handling
+        # https://numpy.org
+        'numpy == 1.18.1',
+
         ]
 )